@@ -1,7 +1,33 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from msfun_ica_log import msfun_ica_print
+from msfun_ica_render import msfun_ica_render, msfun_ica_render_envelope
 
-def msfun_ica_artifactrejection(data, IC, list=None, flag=True):
+def msfun_ica_artifactrejection(data, IC, list=None, flag=True, out=None, chunk=None, dtype=None):
+    '''
+    Removes artifactual ICs from [N x T] or epoched [K x N x T] data.
+
+    The cleaned data are written into out, which may be the input array itself
+    for in-place cleaning, or a memory map. Data are processed in chunks of
+    samples (2D) or trials (3D, one batched matmul per chunk), so memory-mapped
+    files can be cleaned without loading them whole.
+
+    Parameters:
+    - data: numpy.ndarray or numpy.memmap, [N x T] or [K x N x T]
+    - IC: dict with 'A' [N x numofic] and 'S' [numofic x T] or [K x numofic x T]; only
+      the rows of S in list are read, so S may be a memory map or the lazy sources
+      of msfun_ica_load (msfun_ica_sources)
+    - list: artifactual IC indices (default IC['artdetect']['list'])
+    - flag: bool, plot original and cleaned channels (default True), as min/max
+      envelopes at screen resolution, without blocking (see msfun_ica_render)
+    - out: output array of the same shape as data, or data itself for in-place
+      cleaning (default: a new array)
+    - chunk: samples (2D) or trials (3D) per chunk (default: about 16M values per chunk)
+    - dtype: computation and output dtype (default: dtype of data, float64 for integer
+      data), so that float32 recordings are cleaned in float32
+
+    Returns:
+    - out: cleaned data
+    '''
     if list is None or len(list) == 0:
         if isinstance(IC, dict) and "artdetect" in IC and isinstance(IC["artdetect"], dict) and "list" in IC["artdetect"]:
             list = IC["artdetect"]["list"]
@@ -18,41 +44,62 @@ def msfun_ica_artifactrejection(data, IC, list=None, flag=True):
     else:
         raise ValueError("remartIC - ERROR : First input data must be array with 2 or 3 dimensions.")
 
-    data2 = np.copy(data)
-    print(f"remartIC - Removing {len(list)} ICs...")
+    if dtype is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    A = IC["A"][:, list].astype(dtype)
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    elif out.shape != data.shape:
+        raise ValueError("remartIC - ERROR : Output array inconsistent with input data.")
+
+    # Keep the envelopes of the traces to plot before the data may be overwritten in place
+    traces = []
+    if flag:
+        for ic in list:
+            chan = np.argmax(np.abs(IC["A"][:, ic]))
+            if data.ndim == 2:
+                traces.append((ic, chan, None, msfun_ica_render_envelope(data[chan, :])))
+            else:
+                diff = data[:, chan, :] - IC["S"][:, ic, :]
+                trial = np.argmax(np.sum(diff**2, axis=1))
+                traces.append((ic, chan, trial, msfun_ica_render_envelope(data[trial, chan, :])))
+
+    msfun_ica_print(f"remartIC - Removing {len(list)} ICs...")
 
     if data.ndim == 2:
-        data2 = data - IC["A"][:, list] @ IC["S"][list, :]
+        N, T = data.shape
+        if chunk is None:
+            chunk = max(1, (1 << 24) // N)
+        for ti in range(0, T, chunk):
+            sl = slice(ti, ti + chunk)
+            np.subtract(data[:, sl], A @ IC["S"][list, sl].astype(dtype, copy=False), out=out[:, sl], casting="same_kind")
     else:
-        for k in range(data.shape[0]):
-            data2[k, :, :] = data[k, :, :] - IC["A"][:, list] @ IC["S"][k, list, :]
+        K, N, T = data.shape
+        if chunk is None:
+            chunk = max(1, (1 << 24) // (N * T))
+        for k in range(0, K, chunk):
+            sl = slice(k, k + chunk)
+            # One batched matmul over the trials of the chunk: [c x N x r] @ [c x r x T]
+            np.subtract(data[sl], np.matmul(A, IC["S"][sl, list, :].astype(dtype, copy=False)), out=out[sl], casting="same_kind")
 
     if flag:
-        print("remartIC - Generating comparative plots...")
+        msfun_ica_print("remartIC - Generating comparative plots...")
         nfig = len(list)
-        plt.figure(figsize=(10, 3 * nfig))
-        if data.ndim == 2:
-            for idx, ic in enumerate(list):
-                chan = np.argmax(np.abs(IC["A"][:, ic]))
-                plt.subplot(nfig, 1, idx + 1)
-                plt.plot(data[chan, :], label="Original")
-                plt.plot(data2[chan, :], 'r', label="Cleaned")
-                plt.title(f"Channel {chan + 1} with maximal mixing for IC {ic + 1}")
-                plt.axis("tight")
-                plt.axis("off")
-        else:
-            for idx, ic in enumerate(list):
-                chan = np.argmax(np.abs(IC["A"][:, ic]))
-                diff = data[:, chan, :] - IC["S"][:, ic, :]
-                trial = np.argmax(np.sum(diff**2, axis=1))
-                plt.subplot(nfig, 1, idx + 1)
-                plt.plot(data[trial, chan, :], label="Original")
-                plt.plot(data2[trial, chan, :], 'r', label="Cleaned")
-                plt.title(f"Channel {chan + 1}, trial {trial + 1} with max mixing for IC {ic + 1}")
-                plt.axis("tight")
-                plt.axis("off")
-        plt.tight_layout()
-        plt.show()
-
-    print("remartIC - ICs removed from data.")
-    return data2
+        cleaned = [msfun_ica_render_envelope(out[chan, :] if trial is None else out[trial, chan, :]) for _, chan, trial, _ in traces]
+
+        def draw(fig):
+            for idx, ((ic, chan, trial, orig), clean) in enumerate(zip(traces, cleaned)):
+                ax = fig.add_subplot(nfig, 1, idx + 1)
+                ax.plot(*orig, label="Original")
+                ax.plot(*clean, 'r', label="Cleaned")
+                if trial is None:
+                    ax.set_title(f"Channel {chan + 1} with maximal mixing for IC {ic + 1}")
+                else:
+                    ax.set_title(f"Channel {chan + 1}, trial {trial + 1} with max mixing for IC {ic + 1}")
+                ax.axis("tight")
+                ax.axis("off")
+            fig.tight_layout()
+        msfun_ica_render(draw, "artifactrejection", (10, 3 * nfig))
+
+    msfun_ica_print("remartIC - ICs removed from data.")
+    return out
@@ -0,0 +1,114 @@
+import time
+import numpy as np
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_artifactrejection_online_init(IC, list=None, cfg=None):
+    '''
+    Builds a streaming artifact cleaner for real-time acquisition.
+
+    The artifactual ICs are removed from each incoming [N x t] block x as
+    x - A[:, list] @ W[list, :] @ x, applied either as a fixed [N x N] projector
+    or in low-rank form, into preallocated buffers so that no memory is
+    allocated per block.
+
+    Parameters:
+    - IC: dict with 'A' [N x numofic] and 'W' [numofic x N] (IC['S'] is not needed)
+    - list: artifactual IC indices (default IC['artdetect']['list'])
+    - cfg: dict with optional keys:
+        - 'block': maximal number of samples per block (default 10)
+        - 'lowrank': bool, apply U @ (V @ x) instead of the [N x N] projector
+          (default: when 2 * len(list) < N)
+        - 'dtype': computation and output dtype (default float64); incoming blocks
+          should have this dtype to avoid casting
+        - 'history': number of block latencies kept (default 10000)
+
+    Returns:
+    - cleaner: dict to pass to msfun_ica_artifactrejection_online_apply
+    '''
+    if cfg is None:
+        cfg = {}
+    if list is None or len(list) == 0:
+        if isinstance(IC, dict) and "artdetect" in IC and isinstance(IC["artdetect"], dict) and "list" in IC["artdetect"]:
+            list = IC["artdetect"]["list"]
+        else:
+            raise ValueError("msfun_ica_artifactrejection_online_init - ERROR : A list of artifactual ICs must be given either in IC.artdetect.list or in a second input vector list...")
+    if "A" not in IC or "W" not in IC or IC["A"].shape[1] != IC["W"].shape[0] or IC["A"].shape[0] != IC["W"].shape[1]:
+        raise ValueError("msfun_ica_artifactrejection_online_init - ERROR : IC structure missing mixing/unmixing matrices or inconsistent.")
+
+    list = np.asarray(list, dtype=int)
+    N = IC["A"].shape[0]
+    r = len(list)
+    block = cfg.get("block", 10)
+    dtype = np.dtype(cfg.get("dtype", np.float64))
+    lowrank = cfg.get("lowrank", 2 * r < N)
+    if not isinstance(block, int) or block <= 0:
+        raise ValueError("msfun_ica_artifactrejection_online_init - ERROR : Block length must be a positive integer.")
+
+    U = IC["A"][:, list]
+    V = IC["W"][list, :]
+    cleaner = {
+        "N": N,
+        "block": block,
+        "list": list,
+        "lowrank": lowrank,
+        "out": np.empty((N, block), dtype=dtype),
+        "latency": np.zeros(cfg.get("history", 10000)),
+        "nblock": 0
+    }
+    if lowrank:
+        cleaner["U"] = np.ascontiguousarray(U, dtype=dtype)
+        cleaner["V"] = np.ascontiguousarray(V, dtype=dtype)
+        cleaner["tmp"] = np.empty((r, block), dtype=dtype)
+        cleaner["rem"] = np.empty((N, block), dtype=dtype)
+    else:
+        cleaner["P"] = np.ascontiguousarray(np.eye(N) - U @ V, dtype=dtype)
+
+    msfun_ica_print(f"msfun_ica_artifactrejection_online_init - Cleaner removing {r} ICs from {N} channels, "
+          f"{'low-rank' if lowrank else 'projector'} form, blocks of {block} samples...")
+    return cleaner
+
+def msfun_ica_artifactrejection_online_apply(cleaner, x):
+    '''
+    Cleans the [N x t] block x (t <= cleaner['block']).
+
+    Returns:
+    - y: cleaned block [N x t], a view of the cleaner output buffer that is
+      overwritten by the next call (copy it to keep it)
+    '''
+    t0 = time.perf_counter()
+    if x.ndim != 2 or x.shape[0] != cleaner["N"] or x.shape[1] > cleaner["block"]:
+        raise ValueError("msfun_ica_artifactrejection_online_apply - ERROR : Block inconsistent with cleaner.")
+    t = x.shape[1]
+    full = t == cleaner["block"]
+    out = cleaner["out"] if full else cleaner["out"][:, :t]
+
+    if cleaner["lowrank"]:
+        tmp = cleaner["tmp"] if full else cleaner["tmp"][:, :t]
+        rem = cleaner["rem"] if full else cleaner["rem"][:, :t]
+        np.matmul(cleaner["V"], x, out=tmp)
+        np.matmul(cleaner["U"], tmp, out=rem)
+        np.subtract(x, rem, out=out)
+    else:
+        np.matmul(cleaner["P"], x, out=out)
+
+    lat = cleaner["latency"]
+    lat[cleaner["nblock"] % len(lat)] = time.perf_counter() - t0
+    cleaner["nblock"] += 1
+    return out
+
+def msfun_ica_artifactrejection_online_stats(cleaner):
+    '''
+    Returns the per-block latency statistics (in ms) over the kept history:
+    dict with keys 'nblock', 'mean', 'median', 'p99' and 'max'.
+    '''
+    n = min(cleaner["nblock"], len(cleaner["latency"]))
+    lat = cleaner["latency"][:n] * 1e3
+    if n == 0:
+        return {"nblock": 0, "mean": np.nan, "median": np.nan, "p99": np.nan, "max": np.nan}
+    return {
+        "nblock": cleaner["nblock"],
+        "mean": float(np.mean(lat)),
+        "median": float(np.median(lat)),
+        "p99": float(np.percentile(lat, 99)),
+        "max": float(np.max(lat))
+    }
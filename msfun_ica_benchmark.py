@@ -0,0 +1,446 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from msfun_sig_epoch import msfun_sig_epoch_concat, msfun_sig_epoch_split
+from msfun_ica_log import msfun_ica_log_rss, msfun_ica_log_rss_reset
+
+# numeric result metrics of the post-hoc stages: compared with a relative
+# tolerance between reduced precision cases and their reference, and not
+# against the baseline (they depend on the machine's floating point path)
+_values = ["kurt", "power", "residual"]
+
+_suites = {
+    "quick": [
+        {"name": "meg306_1min", "N": 306, "n": 20, "seconds": 60},
+        {"name": "meg306_1min_epoched", "N": 306, "n": 20, "seconds": 60, "epoch": 1.0},
+        {"name": "eeg64_1min", "N": 64, "n": 20, "seconds": 60},
+        {"name": "meg306_1min_float32", "N": 306, "n": 20, "seconds": 60, "dtype": "float32", "reference": "meg306_1min"}
+    ],
+    "full": [
+        {"name": "meg306_1min", "N": 306, "n": 20, "seconds": 60},
+        {"name": "meg306_1min_epoched", "N": 306, "n": 20, "seconds": 60, "epoch": 1.0},
+        {"name": "eeg64_1min", "N": 64, "n": 20, "seconds": 60},
+        {"name": "meg306_10min", "N": 306, "n": 30, "seconds": 600},
+        {"name": "meg306_10min_epoched", "N": 306, "n": 30, "seconds": 600, "epoch": 2.0},
+        {"name": "eeg64_10min", "N": 64, "n": 30, "seconds": 600},
+        {"name": "meg306_10min_float32", "N": 306, "n": 30, "seconds": 600, "dtype": "float32", "reference": "meg306_10min"},
+        {"name": "meg306_2h", "N": 306, "n": 40, "seconds": 7200, "mmap": True}
+    ]
+}
+
+_block = 1 << 16
+
+def msfun_ica_benchmark_sources(n, t0, t, sfreq, seed):
+    '''
+    Deterministic synthetic sources [n x t] for samples t0 .. t0+t (t0 a multiple
+    of 65536): a cardiac-like pulse train, intermittent blinks, modulated alpha,
+    50 Hz line noise, then alternating Laplacian, uniform and binary sources.
+    '''
+    tt = (t0 + np.arange(t)) / sfreq
+    rng = np.random.default_rng([seed, t0 // _block])
+    S = np.empty((n, t))
+    S[0] = np.exp(-0.5 * ((tt % 0.9 - 0.45) / 0.012) ** 2)
+    S[1] = np.exp(-0.5 * ((tt % 3.7 - 1.85) / 0.08) ** 2) * (np.floor(tt / 3.7) % 3 != 1)
+    S[2] = np.sin(2 * np.pi * 10 * tt) * (1 + 0.5 * np.sin(2 * np.pi * 0.1 * tt))
+    S[3] = np.sin(2 * np.pi * 50 * tt)
+    for k in range(4, n):
+        kind = k % 3
+        if kind == 0:
+            S[k] = rng.laplace(size=t)
+        elif kind == 1:
+            S[k] = rng.uniform(-1, 1, t)
+        else:
+            S[k] = np.sign(rng.standard_normal(t))
+    return S
+
+def msfun_ica_benchmark_mixture(case, seed=0, workdir=None):
+    '''
+    Builds the synthetic recording of a benchmark case.
+
+    Parameters:
+    - case: dict with keys 'N' (channels), 'n' (sources), 'seconds', optional
+      'sfreq' (default 1000), 'epoch' (epoch length in seconds, 3D output),
+      'dtype' (default float64) and 'mmap' (bool, write the data to a float32 .npy
+      memory map in workdir); 'reference' names a case of the same mixture in
+      another precision whose accuracy bounds the one of this case
+    - seed: random seed of the mixing matrix and of the random sources
+    - workdir: directory of the memory-mapped data
+
+    Returns:
+    - mix: dict with 'data' [N x T] or [K x N x T], 'extdata' (ECG- and EOG-like
+      references, [2 x T] or [K x 2 x T]), 'A' [N x n], 'sources' (first 100000
+      samples of the true sources) and 'sfreq'
+    '''
+    N, n = case["N"], case["n"]
+    sfreq = case.get("sfreq", 1000)
+    T = int(case["seconds"] * sfreq)
+    A = np.random.default_rng(seed).standard_normal((N, n))
+    if case.get("mmap", False):
+        data = np.lib.format.open_memmap(os.path.join(workdir, f"{case['name']}.npy"), mode="w+", dtype=np.float32, shape=(N, T))
+    else:
+        data = np.empty((N, T), dtype=case.get("dtype", "float64"))
+    extdata = np.empty((2, T), dtype=data.dtype)
+    for t0 in range(0, T, _block):
+        t = min(_block, T - t0)
+        S = msfun_ica_benchmark_sources(n, t0, t, sfreq, seed)
+        rng = np.random.default_rng([seed, t0 // _block, 1])
+        data[:, t0:t0 + t] = A @ S + 0.1 * rng.standard_normal((N, t))
+        extdata[:, t0:t0 + t] = S[:2] + 0.2 * rng.standard_normal((2, t))
+        if t0 == 0:
+            sources = S[:, :100000]
+    if isinstance(data, np.memmap):
+        data.flush()
+
+    if case.get("epoch", None):
+        Te = int(case["epoch"] * sfreq)
+        K = T // Te
+        data = np.ascontiguousarray(msfun_sig_epoch_split(data[:, :K * Te], K))
+        extdata = np.ascontiguousarray(msfun_sig_epoch_split(extdata[:, :K * Te], K))
+    return {"data": data, "extdata": extdata, "A": A, "sources": sources, "sfreq": sfreq}
+
+def msfun_ica_benchmark_stage(stages, name, fn):
+    '''
+    Runs fn() as stage name and records its status, wall time, CPU time and
+    peak RSS in stages[name]. Returns the output of fn, or None on failure;
+    stages whose dependency is missing are recorded as 'missing' and reported
+    by msfun_ica_benchmark.
+    '''
+    print(f"msfun_ica_benchmark -       {name}...")
+    msfun_ica_log_rss_reset()
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    out = None
+    try:
+        out = fn()
+        status = "ok"
+    except ImportError as err:
+        status = f"missing: {err}"
+    except Exception as err:
+        status = f"error: {err!r}"
+        traceback.print_exc()
+    stages[name] = {
+        "status": status,
+        "wall": time.perf_counter() - t0,
+        "cpu": time.process_time() - c0,
+        "peakrss": msfun_ica_log_rss()[1],
+        "metrics": {}
+    }
+    return out
+
+def msfun_ica_benchmark_accuracy(sources, S):
+    '''
+    Mean over the true sources of their maximal absolute correlation with the
+    estimated ICs (1 for a perfect recovery).
+    '''
+    t = sources.shape[1]
+    n = sources.shape[0]
+    C = np.corrcoef(np.vstack([sources, np.asarray(S[:, :t])]))[:n, n:]
+    return float(np.mean(np.max(np.abs(C), axis=1)))
+
+def msfun_ica_benchmark_case(case, cfg):
+    '''
+    Runs all pipeline stages on one synthetic case (in a fresh worker process)
+    and returns the per-stage records.
+    '''
+    import matplotlib
+    matplotlib.use("Agg")
+    from msfun_ica_meg_decomp import msfun_ica_meg_decomp
+    from msfun_ica_eeg_estimate import msfun_ica_eeg_estimate
+    from msfun_ica_meg_dofestimate import msfun_ica_meg_dofestimate
+    from msfun_ica_meg_nongaussanalysis import msfun_ica_meg_nongaussanalysis
+    from msfun_ica_meg_spectraldensity import msfun_ica_meg_spectraldensity
+    from msfun_ica_meg_spectralfit import msfun_ica_meg_spectralfit
+    from msfun_ica_artifactrejection import msfun_ica_artifactrejection
+
+    stages = {}
+    mix = msfun_ica_benchmark_stage(stages, "mixture", lambda: msfun_ica_benchmark_mixture(case, cfg.get("seed", 0), cfg["workdir"]))
+    data, extdata, sfreq, n = mix["data"], mix["extdata"], mix["sfreq"], case["n"]
+    epoching = data.ndim == 3
+    if epoching:
+        K = data.shape[0]
+        data2d = msfun_sig_epoch_concat(data)
+    else:
+        data2d = data
+    fastica = {"fun": "logcosh", "n_components": n, "max_iter": 400, "random_state": 0}
+    filt = {"sfreq": sfreq, "win": "boxcar", "par": ["high", "low"], "freq": [1, 25], "width": [0.5, 5]}
+
+    dof = msfun_ica_benchmark_stage(stages, "dofestimate", lambda: msfun_ica_meg_dofestimate(
+        data, {"interactive": False, "plot": False, "method": "maxrel", "param": 1e3}))
+    if dof is not None:
+        stages["dofestimate"]["metrics"]["ndof"] = dof["ndof"]
+
+    IC = msfun_ica_benchmark_stage(stages, "decomp", lambda: msfun_ica_meg_decomp(data2d, {"fastica": fastica}))
+    if IC is None:
+        return {"shape": list(data.shape), "stages": stages}
+    stages["decomp"]["metrics"]["accuracy"] = msfun_ica_benchmark_accuracy(mix["sources"], IC["S"])
+
+    if isinstance(data2d, np.memmap):
+        stages["eeg_estimate"] = {"status": "skipped: out of core", "wall": 0.0, "cpu": 0.0, "peakrss": 0.0, "metrics": {}}
+    else:
+        ICe = msfun_ica_benchmark_stage(stages, "eeg_estimate", lambda: msfun_ica_eeg_estimate(data2d, {"fastica": fastica}))
+        if ICe is not None:
+            stages["eeg_estimate"]["metrics"]["accuracy"] = msfun_ica_benchmark_accuracy(mix["sources"], ICe["S"])
+            del ICe
+
+    if epoching:
+        IC["S"] = msfun_sig_epoch_split(IC["S"], K)
+
+    out = msfun_ica_benchmark_stage(stages, "nongaussanalysis", lambda: msfun_ica_meg_nongaussanalysis(IC, {}))
+    if out is not None:
+        stages["nongaussanalysis"]["metrics"]["nflagged"] = len(IC["cumulant"]["list"])
+        stages["nongaussanalysis"]["metrics"]["kurt"] = sorted(float(k) for k in IC["cumulant"]["kurt"])
+
+    def corr():
+        from msfun_ica_meg_signalcorrestimate import msfun_ica_meg_signalcorrestimate
+        return msfun_ica_meg_signalcorrestimate(IC, extdata, {"filt": dict(filt)})
+    if msfun_ica_benchmark_stage(stages, "signalcorrestimate", corr) is not None:
+        stages["signalcorrestimate"]["metrics"]["nflagged"] = len(IC["corr"]["list"])
+
+    def trialwise():
+        from msfun_ica_meg_signalcorrestimate_trialwise import msfun_ica_meg_signalcorrestimate_trialwise
+        return msfun_ica_meg_signalcorrestimate_trialwise(IC, extdata, {"filt": dict(filt)})
+    if msfun_ica_benchmark_stage(stages, "signalcorrestimate_trialwise", trialwise) is not None:
+        stages["signalcorrestimate_trialwise"]["metrics"]["nflagged"] = len(IC["corr"]["list"])
+
+    # correlation kernels without the external filter design, so that they are
+    # always timed even where msfun_filt_preparecosine is not installed
+    def corr_unfiltered():
+        from msfun_ica_meg_signalcorrestimate import msfun_ica_meg_signalcorrestimate
+        return msfun_ica_meg_signalcorrestimate(IC, extdata, {"filter": False})
+    if msfun_ica_benchmark_stage(stages, "signalcorrestimate_unfiltered", corr_unfiltered) is not None:
+        stages["signalcorrestimate_unfiltered"]["metrics"]["nflagged"] = len(IC["corr"]["list"])
+
+    def trialwise_unfiltered():
+        from msfun_ica_meg_signalcorrestimate_trialwise import msfun_ica_meg_signalcorrestimate_trialwise
+        return msfun_ica_meg_signalcorrestimate_trialwise(IC, extdata, {"filter": False})
+    if msfun_ica_benchmark_stage(stages, "signalcorrestimate_trialwise_unfiltered", trialwise_unfiltered) is not None:
+        stages["signalcorrestimate_trialwise_unfiltered"]["metrics"]["nflagged"] = len(IC["corr"]["list"])
+
+    epoch = min(2 * sfreq, IC["S"].shape[-1])
+    out = msfun_ica_benchmark_stage(stages, "spectraldensity", lambda: msfun_ica_meg_spectraldensity(IC, {"sfreq": sfreq, "epoch": epoch}))
+    if out is not None:
+        # total power of each IC, sorted so that the metric does not depend on the IC order
+        stages["spectraldensity"]["metrics"]["power"] = sorted(float(p) for p in np.sum(IC["powspctrm"], axis=-1))
+        fit = ["powlaw", [2, 40], "linear", [60, 200]]
+        if msfun_ica_benchmark_stage(stages, "spectralfit", lambda: msfun_ica_meg_spectralfit(IC, {"fit": fit, "visual": False})) is not None:
+            stages["spectralfit"]["metrics"]["nflagged"] = len(IC["spectral"]["list"])
+
+    outfile = None
+    if isinstance(data, np.memmap):
+        outfile = np.lib.format.open_memmap(os.path.join(cfg["workdir"], f"{case['name']}_clean.npy"), mode="w+", dtype=data.dtype, shape=data.shape)
+    clean = msfun_ica_benchmark_stage(stages, "artifactrejection", lambda: msfun_ica_artifactrejection(data, IC, [0, 1], flag=False, out=outfile))
+    if clean is not None:
+        stages["artifactrejection"]["metrics"]["residual"] = float(np.std(np.asarray(clean[..., :100000])))
+
+    return {"shape": list(data.shape), "dtype": str(data.dtype), "reference": case.get("reference", None), "stages": stages}
+
+def msfun_ica_benchmark_precision(results, cfg=None):
+    '''
+    Bounds the accuracy loss of reduced precision: every case with a
+    'reference' (e.g. a float32 run of a float64 case) must reach the source
+    recovery accuracy of its reference within cfg['dtypetol'] (default 0.01)
+    in every stage, and the sorted kurtosis (nongaussanalysis), IC powers
+    (spectraldensity) and cleaned data deviation (artifactrejection) of its
+    reference within the relative error cfg['valuetol'] (default 1e-4).
+
+    Returns:
+    - regressions: list of messages, empty if the bound holds
+    '''
+    if cfg is None:
+        cfg = {}
+    dtypetol = cfg.get("dtypetol", 0.01)
+    valuetol = cfg.get("valuetol", 1e-4)
+    regressions = []
+    for case, res in results["cases"].items():
+        ref = results["cases"].get(res.get("reference", None) or "", None)
+        if ref is None:
+            continue
+        for stage, rec in ref["stages"].items():
+            metrics = res["stages"].get(stage, {}).get("metrics", {})
+            value = rec["metrics"].get("accuracy", None)
+            if value is not None:
+                new = metrics.get("accuracy", None)
+                if new is None or new < value - dtypetol:
+                    regressions.append(f"{case}/{stage}: accuracy {new} in {res['dtype']}, {value:.3f} in {ref['dtype']} ({res['reference']})")
+            for key in _values:
+                if key not in rec["metrics"]:
+                    continue
+                value = np.atleast_1d(rec["metrics"][key])
+                new = metrics.get(key, None)
+                if new is None or np.atleast_1d(new).shape != value.shape:
+                    regressions.append(f"{case}/{stage}: {key} missing in {res['dtype']} ({res['reference']})")
+                    continue
+                err = float(np.max(np.abs(np.atleast_1d(new) - value)) / max(np.max(np.abs(value)), np.finfo(float).tiny))
+                if err > valuetol:
+                    regressions.append(f"{case}/{stage}: {key} relative error {err:.2e} in {res['dtype']} against {ref['dtype']} ({res['reference']})")
+    return regressions
+
+def msfun_ica_benchmark_compare(results, baseline, cfg=None):
+    '''
+    Compares benchmark results with a baseline of the same form.
+
+    Parameters:
+    - results, baseline: outputs of msfun_ica_benchmark
+    - cfg: dict with optional keys:
+        - 'timetol': relative wall time increase reported as a regression (default 0.25)
+        - 'timemin': wall time increase in seconds below which changes are ignored (default 0.1)
+        - 'memtol': relative peak RSS increase reported as a regression (default 0.10)
+        - 'acctol': accuracy decrease reported as a regression (default 0.02)
+        - 'dtypetol': accuracy loss allowed to reduced precision cases against their
+          reference case (default 0.01, see msfun_ica_benchmark_precision)
+        - 'valuetol': relative error allowed to the kurtosis, IC power and cleaned data
+          metrics of reduced precision cases (default 1e-4, see msfun_ica_benchmark_precision)
+
+    Returns:
+    - regressions: list of messages, empty if no regression
+    '''
+    if cfg is None:
+        cfg = {}
+    timetol = cfg.get("timetol", 0.25)
+    timemin = cfg.get("timemin", 0.1)
+    memtol = cfg.get("memtol", 0.10)
+    acctol = cfg.get("acctol", 0.02)
+
+    regressions = []
+    for case, res in results["cases"].items():
+        base = baseline.get("cases", {}).get(case, None)
+        if base is None:
+            continue
+        for stage, rec in res["stages"].items():
+            ref = base["stages"].get(stage, None)
+            if ref is None or ref["status"] != "ok":
+                continue
+            if rec["status"] != "ok":
+                regressions.append(f"{case}/{stage}: {rec['status']} (ok in baseline)")
+                continue
+            if rec["wall"] > ref["wall"] * (1 + timetol) and rec["wall"] - ref["wall"] > timemin:
+                regressions.append(f"{case}/{stage}: wall time {ref['wall']:.2f} s -> {rec['wall']:.2f} s")
+            if rec["peakrss"] > ref["peakrss"] * (1 + memtol):
+                regressions.append(f"{case}/{stage}: peak RSS {ref['peakrss']:.0f} MB -> {rec['peakrss']:.0f} MB")
+            for key, value in ref["metrics"].items():
+                new = rec["metrics"].get(key, None)
+                if key == "accuracy":
+                    if new is None or new < value - acctol:
+                        regressions.append(f"{case}/{stage}: accuracy {value:.3f} -> {new}")
+                elif key not in _values and new != value:
+                    regressions.append(f"{case}/{stage}: {key} {value} -> {new}")
+    return regressions
+
+def msfun_ica_benchmark(cfg=None):
+    '''
+    Benchmarks every stage of the MEG/EEG ICA pipeline on synthetic mixtures
+    with known sources, offline and with plotting disabled.
+
+    Each case runs in a fresh process so that its peak memory is measured in
+    isolation. For every stage, wall time, CPU time, peak RSS (per stage when
+    /proc allows resetting the high-water mark, cumulative otherwise) and a few
+    result metrics (source recovery accuracy, number of flagged ICs, ...) are
+    recorded and compared against a stored baseline. Float32 cases are also
+    checked against their float64 reference case (source recovery accuracy, and
+    relative error of the kurtosis, IC power and cleaned data metrics).
+
+    From the command line, `python msfun_ica_benchmark.py --suite quick --save
+    baseline.json` records a baseline and `--baseline baseline.json` checks
+    against it. The exit status is 1 for regressions, 2 when stages could not
+    run for lack of a dependency (e.g. the external msfun_filt_preparecosine;
+    the correlation kernels are then still timed unfiltered) and 0 otherwise.
+
+    Parameters:
+    - cfg: dict with optional keys:
+        - 'suite': 'quick' (default, 1 min recordings) or 'full' (up to 2 h at 1 kHz,
+          the longest one memory-mapped)
+        - 'cases': explicit list of case dicts (see msfun_ica_benchmark_mixture)
+        - 'seed': random seed (default 0)
+        - 'workdir': directory for memory-mapped data (default: a temporary directory)
+        - 'baseline': path of a baseline JSON file to compare against
+        - 'save': path where the results are written as JSON (e.g. a new baseline)
+        - 'compare': tolerances of msfun_ica_benchmark_compare
+
+    Returns:
+    - results: dict with 'machine' information, per-case 'cases' records, the
+      'regressions' against the baseline, if given, and of the reduced precision
+      cases against their reference cases, and the 'missing' stages that could not
+      run for lack of a dependency
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_benchmark - ERROR: Configuration not a structure... Try again.")
+    cases = cfg.get("cases", None) or _suites.get(cfg.get("suite", "quick"), None)
+    if cases is None:
+        raise ValueError("msfun_ica_benchmark - ERROR: Unknown benchmark suite... Try again.")
+
+    tmpdir = None
+    if cfg.get("workdir", None) is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="msfun_ica_benchmark_")
+        cfg = dict(cfg, workdir=tmpdir.name)
+    os.makedirs(cfg["workdir"], exist_ok=True)
+
+    results = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpus": os.cpu_count()
+        },
+        "cases": {}
+    }
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        for case in cases:
+            print(f"msfun_ica_benchmark - Case {case['name']}...")
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                results["cases"][case["name"]] = pool.submit(msfun_ica_benchmark_case, case, cfg).result()
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    print("msfun_ica_benchmark - Results:")
+    print(f"{'case':<24} {'stage':<30} {'status':<8} {'wall (s)':>9} {'cpu (s)':>9} {'peak (MB)':>10}  metrics")
+    for name, res in results["cases"].items():
+        for stage, rec in res["stages"].items():
+            metrics = {k: f"[{len(v)} values]" if isinstance(v, list) else v for k, v in rec["metrics"].items()}
+            print(f"{name:<24} {stage:<30} {rec['status'][:8]:<8} {rec['wall']:9.2f} {rec['cpu']:9.2f} {rec['peakrss']:10.0f}  {metrics}")
+
+    results["regressions"] = msfun_ica_benchmark_precision(results, cfg.get("compare", None))
+    print(f"msfun_ica_benchmark - {len(results['regressions'])} accuracy losses of reduced precision cases...")
+    if cfg.get("baseline", None) and os.path.exists(cfg["baseline"]):
+        with open(cfg["baseline"]) as f:
+            baseline = json.load(f)
+        regressions = msfun_ica_benchmark_compare(results, baseline, cfg.get("compare", None))
+        print(f"msfun_ica_benchmark - {len(regressions)} regressions against {cfg['baseline']}...")
+        results["regressions"] += regressions
+    for msg in results["regressions"]:
+        print(f"msfun_ica_benchmark -       {msg}")
+    results["missing"] = [f"{name}/{stage}: {rec['status']}" for name, res in results["cases"].items()
+                          for stage, rec in res["stages"].items() if rec["status"].startswith("missing")]
+    if results["missing"]:
+        print(f"msfun_ica_benchmark - WARNING: {len(results['missing'])} stages not benchmarked for lack of a dependency...")
+        for msg in results["missing"]:
+            print(f"msfun_ica_benchmark -       {msg}")
+
+    if cfg.get("save", None):
+        with open(cfg["save"], "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"msfun_ica_benchmark - Results written to {cfg['save']}...")
+
+    print("msfun_ica_benchmark - Done.")
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the msfun ICA pipeline stages on synthetic data.")
+    parser.add_argument("--suite", default="quick", choices=sorted(_suites))
+    parser.add_argument("--baseline", default=None, help="baseline JSON file to compare against")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file")
+    parser.add_argument("--workdir", default=None, help="directory for memory-mapped data")
+    args = parser.parse_args()
+    res = msfun_ica_benchmark({"suite": args.suite, "baseline": args.baseline, "save": args.save, "workdir": args.workdir})
+    sys.exit(1 if res.get("regressions", []) else 2 if res.get("missing", []) else 0)
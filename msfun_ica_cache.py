@@ -0,0 +1,161 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_stage, msfun_ica_log_note, msfun_ica_log_describe
+
+def msfun_ica_cache_hasher():
+    try:
+        import xxhash
+        return xxhash.xxh3_128()
+    except ImportError:
+        return hashlib.blake2b(digest_size=16)
+
+def msfun_ica_cache_feed(h, item, chunk=1 << 24):
+    if isinstance(item, np.ndarray):
+        h.update(f"ndarray{item.shape}{item.dtype.str}".encode())
+        if item.ndim == 0 or item.flags.c_contiguous:
+            flat = item.reshape(-1)
+            step = max(chunk // max(item.itemsize, 1), 1)
+            for i in range(0, flat.size, step):
+                h.update(memoryview(flat[i:i + step]).cast("B"))
+            return
+        # other layouts: C-ordered copies of slabs along the first axis, so that
+        # the hashed byte stream (and the key) does not depend on the memory layout
+        slab = max(item.itemsize * (item.size // max(item.shape[0], 1)), 1)
+        step = max(chunk // slab, 1)
+        for i in range(0, item.shape[0], step):
+            h.update(memoryview(np.ascontiguousarray(item[i:i + step])).cast("B"))
+    elif isinstance(item, dict):
+        h.update(b"dict{")
+        for k in sorted(item, key=str):
+            msfun_ica_cache_feed(h, str(k), chunk)
+            msfun_ica_cache_feed(h, item[k], chunk)
+        h.update(b"}")
+    elif isinstance(item, (list, tuple)):
+        h.update(b"list[")
+        for x in item:
+            msfun_ica_cache_feed(h, x, chunk)
+        h.update(b"]")
+    else:
+        h.update(f"{type(item).__name__}:{item!r};".encode())
+
+def msfun_ica_cache_hash(*items):
+    '''
+    Content hash of arrays (data bytes, shape and dtype) and of nested
+    configuration dicts/lists. Uses xxhash when installed, blake2b otherwise.
+
+    Returns:
+    - key: hexadecimal string
+    '''
+    h = msfun_ica_cache_hasher()
+    for item in items:
+        msfun_ica_cache_feed(h, item)
+    return h.hexdigest()
+
+def msfun_ica_cache_open(cfg):
+    '''
+    Opens (and creates if needed) an on-disk result cache.
+
+    Parameters:
+    - cfg: dict with keys:
+        - 'dir': cache directory
+        - 'maxsize': maximal total size in bytes before least recently used
+          entries are evicted (default 10 GB)
+
+    Returns:
+    - cache: dict handle with the hit/miss counters of this session in cache['stats']
+    '''
+    if not isinstance(cfg, dict) or "dir" not in cfg:
+        raise ValueError("msfun_ica_cache_open - ERROR: Cache configuration must give a directory... Try again.")
+    os.makedirs(cfg["dir"], exist_ok=True)
+    return {
+        "dir": cfg["dir"],
+        "maxsize": cfg.get("maxsize", 10 * 1024 ** 3),
+        "stats": {"hits": {}, "misses": {}, "evictions": 0}
+    }
+
+def msfun_ica_cache_file(cache, stage, key):
+    return os.path.join(cache["dir"], f"{stage}-{key}.pkl")
+
+def msfun_ica_cache_get(cache, stage, key):
+    '''
+    Returns the cached output of stage for key, or None on a miss.
+    A hit marks the entry as most recently used.
+    '''
+    fname = msfun_ica_cache_file(cache, stage, key)
+    try:
+        with open(fname, "rb") as f:
+            value = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        cache["stats"]["misses"][stage] = cache["stats"]["misses"].get(stage, 0) + 1
+        return None
+    os.utime(fname)
+    cache["stats"]["hits"][stage] = cache["stats"]["hits"].get(stage, 0) + 1
+    return value
+
+def msfun_ica_cache_put(cache, stage, key, value):
+    '''
+    Stores the output of stage for key, then evicts least recently used
+    entries until the cache fits in cache['maxsize'].
+    '''
+    fname = msfun_ica_cache_file(cache, stage, key)
+    tmp = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+    msfun_ica_cache_evict(cache)
+
+def msfun_ica_cache_evict(cache):
+    entries = []
+    for name in os.listdir(cache["dir"]):
+        if name.endswith(".pkl"):
+            st = os.stat(os.path.join(cache["dir"], name))
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for _, size, name in entries:
+        if total <= cache["maxsize"]:
+            break
+        try:
+            os.remove(os.path.join(cache["dir"], name))
+        except FileNotFoundError:
+            pass
+        total -= size
+        cache["stats"]["evictions"] += 1
+
+def msfun_ica_cache_stats(cache):
+    '''
+    Returns a dict with the session hit/miss counters per stage, the number
+    of evictions, and the current number of entries and total size on disk.
+    '''
+    names = [n for n in os.listdir(cache["dir"]) if n.endswith(".pkl")]
+    return {
+        "hits": dict(cache["stats"]["hits"]),
+        "misses": dict(cache["stats"]["misses"]),
+        "evictions": cache["stats"]["evictions"],
+        "entries": len(names),
+        "size": sum(os.path.getsize(os.path.join(cache["dir"], n)) for n in names)
+    }
+
+def msfun_ica_cache_run(cache, stage, key, fn, IC, keys, apply=None, inputs=None):
+    '''
+    Runs IC = fn(IC) through the cache. Only the IC entries listed in keys are
+    stored; on a hit they are merged back into IC (or passed to apply(IC, value)).
+    The stage is instrumented with msfun_ica_log_stage (inputs: the IC arrays and
+    the optional dict inputs; outputs: the IC entries listed in keys).
+    '''
+    with msfun_ica_log_stage(stage, dict(IC, **(inputs or {}))):
+        value = msfun_ica_cache_get(cache, stage, key) if cache is not None else None
+        if value is not None:
+            msfun_ica_print(f"msfun_ica_cache - {stage} restored from cache...")
+            if apply is not None:
+                IC = apply(IC, value)
+            else:
+                IC.update(value)
+        else:
+            IC = fn(IC)
+            if cache is not None:
+                msfun_ica_cache_put(cache, stage, key, {k: IC[k] for k in keys if k in IC})
+        msfun_ica_log_note(cached=value is not None, outputs=msfun_ica_log_describe({k: IC[k] for k in keys if k in IC}))
+    return IC
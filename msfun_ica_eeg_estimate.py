@@ -1,5 +1,7 @@
 import numpy as np
 from sklearn.decomposition import FastICA
+from msfun_ica_fastica import msfun_ica_fastica_params, msfun_ica_fastica_whiten
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
 
 def msfun_ica_eeg_estimate(sig, cfg=None):
     """
@@ -10,6 +12,11 @@ def msfun_ica_eeg_estimate(sig, cfg=None):
     - cfg: dict with optional keys:
         - 'normalize': numpy.ndarray of shape [N] for normalization factors
         - 'fastica': dict of parameters to pass to FastICA (e.g., {'fun': 'tanh', 'n_components': 30})
+        - 'engine': 'sklearn' (default) or 'native' for msfun_ica_fastica
+        - 'W0': initial unmixing matrix [numOfIC x N] in original units, e.g. a previous IC['W'] (with the
+          sklearn engine, the data are then whitened here and W0 is passed as w_init)
+        - 'dtype': computation dtype of the normalized data, of the ICA and of S
+          (default: float32 for float32 data, float64 otherwise)
 
     Returns:
     - IC: dict with keys:
@@ -23,32 +30,69 @@ def msfun_ica_eeg_estimate(sig, cfg=None):
     N, T = sig.shape
     cfg = cfg or {}
     normalize = cfg.get("normalize", None)
-    fastica_params = cfg.get("fastica", {'fun': 'tanh', 'n_components': min(N, 30)})
+    fastica_params = msfun_ica_fastica_params(cfg.get("fastica", {'fun': 'tanh', 'n_components': min(N, 30)}), "msfun_ica_eeg_estimate")
 
     # Signal normalization
-    print("msfun_ica_eeg_estimate - Normalizing data units...")
+    msfun_ica_print("msfun_ica_eeg_estimate - Normalizing data units...")
     if normalize is None:
-        print("msfun_ica_eeg_estimate -       using temporal standard deviation of data...")
-        normalize = np.std(sig, axis=1)
+        msfun_ica_print("msfun_ica_eeg_estimate -       using temporal standard deviation of data...")
+        normalize = np.std(sig, axis=1, dtype=np.float64)
     else:
         normalize = np.asarray(normalize)
         if normalize.ndim != 1 or normalize.shape[0] != N or np.any(normalize <= 0):
             raise ValueError("normalize must be a positive vector of length N")
 
-    sig_norm = sig / normalize[:, np.newaxis]
+    engine = cfg.get("engine", "sklearn")
+    if engine not in ["sklearn", "native"]:
+        raise ValueError("engine must be 'sklearn' or 'native'")
 
-    # Run FastICA
-    print("msfun_ica_eeg_estimate - FASTICA running ...")
-    ica = FastICA(**fastica_params)
-    S = ica.fit_transform(sig_norm.T).T  # components x time
-    A = ica.mixing_                      # N x components
-    W = ica.components_                  # components x N
+    dtype = np.dtype(cfg.get("dtype", None) or (np.float32 if sig.dtype == np.float32 else np.float64))
+    if engine == "native":
+        from msfun_ica_fastica import msfun_ica_fastica
+        sig_norm = np.divide(sig, normalize[:, np.newaxis], dtype=dtype)
+
+        # Run native FastICA on the [N x T] layout
+        msfun_ica_print("msfun_ica_eeg_estimate - native FASTICA running ...")
+        native_cfg = {k: fastica_params[k] for k in ["fun", "max_iter", "tol", "random_state", "n_components"] if k in fastica_params}
+        native_cfg["alpha"] = fastica_params.get("fun_args", {}).get("alpha", 1.0)
+        native_cfg["dtype"] = dtype
+        if cfg.get("W0", None) is not None:
+            native_cfg["W0"] = np.asarray(cfg["W0"]) * normalize[np.newaxis, :]
+        ica = msfun_ica_fastica(sig_norm, native_cfg)
+        del sig_norm
+        S = ica["S"]                     # components x time
+        A = ica["A"]                     # N x components
+        W = ica["W"]                     # components x N
+    else:
+        sig_norm = np.divide(sig, normalize[:, np.newaxis], dtype=dtype)
+
+        # Run FastICA
+        msfun_ica_print("msfun_ica_eeg_estimate - FASTICA running ...")
+        if cfg.get("W0", None) is None:
+            ica = FastICA(**fastica_params)
+            S = ica.fit_transform(sig_norm.T).T  # components x time
+            A = ica.mixing_                      # N x components
+            W = ica.components_                  # components x N
+        else:
+            # Warm start: whiten here and give W0 to sklearn in whitened coordinates
+            wh = msfun_ica_fastica_whiten(sig_norm, fastica_params.get("n_components", None))
+            W0 = np.asarray(cfg["W0"]) * normalize[np.newaxis, :]
+            if W0.shape != (wh["K"].shape[0], N):
+                raise ValueError("W0 must be a [numOfIC x N] unmixing matrix")
+            params = {k: v for k, v in fastica_params.items() if k not in ["n_components", "whiten", "whiten_solver"]}
+            Z = wh["K"].astype(dtype) @ sig_norm - (wh["K"] @ wh["mean"]).astype(dtype)[:, np.newaxis]
+            del sig_norm
+            ica = FastICA(whiten=False, w_init=W0 @ wh["Kinv"], **params)
+            S = ica.fit_transform(Z.T).T
+            A = wh["Kinv"] @ ica.components_.T
+            W = ica.components_ @ wh["K"]
+        msfun_ica_log_note(fastica_niter=int(ica.n_iter_), fastica_converged=bool(ica.n_iter_ < ica.max_iter))
 
     # Restore original units
-    print("msfun_ica_eeg_estimate - Restoring data to original units ...")
+    msfun_ica_print("msfun_ica_eeg_estimate - Restoring data to original units ...")
     A_scaled = A * normalize[:, np.newaxis]
     W_scaled = W / normalize[np.newaxis, :]
 
-    print("msfun_ica_eeg_estimate - Done.")
+    msfun_ica_print("msfun_ica_eeg_estimate - Done.")
 
     return {'A': A_scaled, 'W': W_scaled, 'S': S}
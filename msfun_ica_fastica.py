@@ -0,0 +1,208 @@
+import numpy as np
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_covstats import msfun_sig_covstats_init, msfun_sig_covstats_update, msfun_sig_covstats_finalize
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
+
+def msfun_ica_fastica_whiten(X, n_components=None, chunk=65536):
+    '''
+    Computes the PCA whitening operator of the [N x T] signal X.
+
+    The covariance is accumulated over column blocks in float64, so float32
+    input is never upcast as a whole.
+
+    Returns:
+    - wh: dict with keys:
+        - 'mean': channel means [N]
+        - 'D': leading covariance eigenvalues [n], decreasing
+        - 'V': corresponding eigenvectors [N x n]
+        - 'K': whitening matrix [n x N], K = D^(-1/2) V'
+        - 'Kinv': dewhitening matrix [N x n], Kinv = V D^(1/2)
+    '''
+    N = X.shape[0]
+    if n_components is None:
+        n_components = N
+    if not 0 < n_components <= N:
+        raise ValueError("msfun_ica_fastica_whiten - ERROR: Number of components inconsistent... Try again.")
+
+    stats = msfun_sig_covstats_init(N)
+    for block in msfun_sig_chunks(X, chunk):
+        msfun_sig_covstats_update(stats, block)
+    stats = msfun_sig_covstats_finalize(stats)
+
+    D, V = np.linalg.eigh(stats['cov'])
+    return msfun_ica_fastica_whitening(D, V, stats['mean'], n_components)
+
+def msfun_ica_fastica_whitening(D, V, mean, n_components):
+    '''
+    Builds the whitening operator dict of msfun_ica_fastica_whiten from a
+    precomputed covariance eigendecomposition (eigenvalues D in any order,
+    eigenvectors in the columns of V), keeping the n_components largest.
+    '''
+    order = np.argsort(D)[::-1][:n_components]
+    D = np.asarray(D)[order]
+    V = np.asarray(V)[:, order]
+    if len(D) < n_components or np.any(D <= 0):
+        raise ValueError("msfun_ica_fastica_whitening - ERROR: Covariance rank deficient, reduce n_components... Try again.")
+
+    return {
+        'mean': np.asarray(mean, dtype=np.float64),
+        'D': D,
+        'V': V,
+        'K': (V / np.sqrt(D)).T,
+        'Kinv': V * np.sqrt(D)
+    }
+
+def msfun_ica_fastica_params(params, caller):
+    '''
+    Copy of a FastICA parameter dict in which the 'tanh' contrast of the default
+    configurations is mapped to 'logcosh', its sklearn name (tanh is the
+    derivative of the logcosh contrast), so that one dict serves both engines.
+    '''
+    if not isinstance(params, dict):
+        raise ValueError(f"{caller} - ERROR: FastICA parameters must be given in a dictionary... Try again.")
+    params = dict(params)
+    if params.get("fun", None) == "tanh":
+        params["fun"] = "logcosh"
+    return params
+
+def msfun_ica_fastica_symdecorr(W):
+    '''
+    Symmetric decorrelation W <- (W W')^(-1/2) W.
+    '''
+    D, E = np.linalg.eigh(W @ W.T)
+    D = np.maximum(D, np.finfo(D.dtype).tiny)
+    return (E / np.sqrt(D)) @ E.T @ W
+
+def msfun_ica_fastica(X, cfg=None):
+    '''
+    Symmetric fixed-point FastICA on the [N x T] signal matrix X.
+
+    The fixed-point updates are computed as [n x T] matrix products directly on
+    the channel-by-time layout (no transposed copy of the data) and in the data
+    dtype, so float32 signals stay float32 end to end. Only the small [n x n]
+    decorrelation is done in float64.
+
+    Parameters:
+    - X: numpy.ndarray [N x T], float32 or float64
+    - cfg: dict with optional keys:
+        - 'fun': contrast function, 'tanh'/'logcosh' (default), 'exp' or 'cube'
+        - 'alpha': tanh slope (default 1.0)
+        - 'max_iter': maximal number of fixed-point iterations (default 200)
+        - 'tol': convergence tolerance on the unmixing vectors (default 1e-4)
+        - 'random_state': seed of the random initial unmixing matrix (default 0)
+        - 'n_components': number of ICs (default N)
+        - 'whiten': bool, whether X must be centered and whitened first (default True)
+        - 'whitening': precomputed output of msfun_ica_fastica_whiten, used instead of estimating it
+        - 'W0': initial unmixing matrix [n x N] in the units of X (e.g. a previous IC['W'],
+          scaled to normalized units), or [n x n] when 'whiten' is False
+        - 'dtype': computation dtype (default: float32 for float32 input, float64 otherwise)
+        - 'sources': bool, whether to return the IC time courses (default True)
+
+    Returns:
+    - ica: dict with keys:
+        - 'W': unmixing matrix [n x N], applying to centered X
+        - 'A': mixing matrix [N x n]
+        - 'S': independent components [n x T], unit variance (None if 'sources' is False)
+        - 'mean': channel means removed before unmixing [N]
+        - 'niter': number of fixed-point iterations run
+        - 'converged': bool
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(X, np.ndarray) or X.ndim != 2:
+        raise ValueError("msfun_ica_fastica - ERROR: Signal matrix inconsistent... Try again.")
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_fastica - ERROR: Configuration not a structure... Try again.")
+
+    N, T = X.shape
+    fun = cfg.get('fun', 'logcosh')
+    if fun not in ['tanh', 'logcosh', 'exp', 'cube']:
+        raise ValueError("msfun_ica_fastica - ERROR: Contrast function not recognized... Try again.")
+    alpha = cfg.get('alpha', 1.0)
+    max_iter = cfg.get('max_iter', 200)
+    tol = cfg.get('tol', 1e-4)
+    dtype = np.dtype(cfg.get('dtype', None) or (np.float32 if X.dtype == np.float32 else np.float64))
+
+    if cfg.get('whiten', True):
+        wh = cfg.get('whitening', None)
+        if wh is None:
+            wh = msfun_ica_fastica_whiten(X, cfg.get('n_components', None))
+        elif wh['K'].shape[1] != N:
+            raise ValueError("msfun_ica_fastica - ERROR: Whitening operator inconsistent with data... Try again.")
+        K = wh['K']
+        Z = (K.astype(X.dtype) @ X).astype(dtype, copy=False)
+        Z -= (K @ wh['mean']).astype(dtype)[:, np.newaxis]
+        mean = wh['mean']
+    else:
+        Z = X if X.dtype == dtype else X.astype(dtype)
+        mean = np.zeros(N)
+    n = Z.shape[0]
+
+    W0 = cfg.get('W0', None)
+    if W0 is not None:
+        W0 = np.asarray(W0, dtype=np.float64)
+        if cfg.get('whiten', True):
+            if W0.shape != (n, N):
+                raise ValueError("msfun_ica_fastica - ERROR: Initial unmixing matrix inconsistent... Try again.")
+            W0 = W0 @ wh['Kinv']
+        elif W0.shape != (n, n):
+            raise ValueError("msfun_ica_fastica - ERROR: Initial unmixing matrix inconsistent... Try again.")
+    else:
+        W0 = np.random.default_rng(cfg.get('random_state', 0)).standard_normal((n, n))
+    W = msfun_ica_fastica_symdecorr(W0)
+
+    Y = np.empty((n, T), dtype=dtype)
+    G = np.empty((n, T), dtype=dtype) if fun == 'exp' else None
+    converged = False
+    it = 0
+    for it in range(1, max_iter + 1):
+        np.matmul(W.astype(dtype), Z, out=Y)
+        if fun in ['tanh', 'logcosh']:
+            if alpha != 1.0:
+                Y *= alpha
+            np.tanh(Y, out=Y)
+            gp = alpha * (1 - np.einsum('ij,ij->i', Y, Y, dtype=np.float64) / T)
+            GZ = Y @ Z.T
+        elif fun == 'exp':
+            np.square(Y, out=G)
+            G *= -0.5
+            np.exp(G, out=G)
+            gp = (np.sum(G, axis=1, dtype=np.float64) - np.einsum('ij,ij,ij->i', Y, Y, G, dtype=np.float64)) / T
+            Y *= G
+            GZ = Y @ Z.T
+        else:
+            gp = 3 * np.einsum('ij,ij->i', Y, Y, dtype=np.float64) / T
+            Y **= 3
+            GZ = Y @ Z.T
+        Wnew = msfun_ica_fastica_symdecorr(GZ.astype(np.float64) / T - gp[:, np.newaxis] * W)
+        lim = np.max(np.abs(np.abs(np.einsum('ij,ij->i', Wnew, W)) - 1))
+        W = Wnew
+        if lim < tol:
+            converged = True
+            break
+
+    if not converged:
+        msfun_ica_print(f"msfun_ica_fastica - WARNING: FastICA did not converge after {max_iter} iterations...")
+    msfun_ica_log_note(fastica_niter=it, fastica_converged=converged)
+
+    if cfg.get('sources', True):
+        np.matmul(W.astype(dtype), Z, out=Y)
+    else:
+        Y = None
+    del Z, G
+
+    if cfg.get('whiten', True):
+        Wx = W @ wh['K']
+        Ax = wh['Kinv'] @ W.T
+    else:
+        Wx = W
+        Ax = W.T
+
+    return {
+        'W': Wx,
+        'A': Ax,
+        'S': Y,
+        'mean': mean,
+        'niter': it,
+        'converged': converged
+    }
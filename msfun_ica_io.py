@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import numpy as np
+from msfun_ica_log import msfun_ica_print
+
+class msfun_ica_sources:
+    '''
+    IC time courses computed on demand from the unmixing matrix and the data,
+    S = W @ data with each IC centered as in the decomposition (over the whole
+    recording for [N x T] data, per epoch for [K x N x T] data).
+
+    Behaves as a read-only [numofic x T] or [K x numofic x T] array for indexing:
+    S[list] or S[list, t1:t2] (S[:, list, :] for epochs) only computes the
+    requested rows and reads the requested samples, so memory-mapped recordings
+    are never loaded whole. numpy.asarray(S) materializes all sources.
+    '''
+
+    def __init__(self, W, data):
+        W = np.asarray(W)
+        if data.ndim not in [2, 3] or W.ndim != 2 or W.shape[1] != data.shape[-2]:
+            raise ValueError("msfun_ica_sources - ERROR: Unmixing matrix and data inconsistent... Try again.")
+        self.W = W
+        self.data = data
+        self.ndim = data.ndim
+        self.dtype = np.result_type(W, data)
+        if self.ndim == 2:
+            self.shape = (W.shape[0], data.shape[1])
+        else:
+            self.shape = (data.shape[0], W.shape[0], data.shape[2])
+        self.mean = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def datamean(self, chunk=1 << 16):
+        # channel means over time [N], or per epoch [K x N], computed once in chunks
+        if self.mean is None:
+            if self.ndim == 2:
+                N, T = self.data.shape
+                self.mean = np.zeros(N)
+                for ti in range(0, T, chunk):
+                    self.mean += np.sum(self.data[:, ti:ti + chunk], axis=1, dtype=np.float64)
+                self.mean /= T
+            else:
+                K = self.data.shape[0]
+                step = max(1, chunk // self.data.shape[2])
+                self.mean = np.concatenate([np.mean(self.data[k:k + step], axis=2, dtype=np.float64) for k in range(0, K, step)])
+        return self.mean
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError("msfun_ica_sources - ERROR: Too many indices... Try again.")
+
+        # integer indices are turned into length-1 selections and squeezed at the end
+        squeeze = tuple(ax for ax, k in enumerate(key) if isinstance(k, (int, np.integer)))
+        key = tuple([k] if isinstance(k, (int, np.integer)) else k for k in key)
+        m = self.datamean()
+        if self.ndim == 2:
+            rows, t = key
+            Wr = self.W[rows]
+            S = Wr @ self.data[:, t] - (Wr @ m)[:, np.newaxis]
+        else:
+            trials, rows, t = key
+            Wr = self.W[rows]
+            X = self.data[trials]
+            S = np.matmul(Wr, X[:, :, t]) - (m[trials] @ Wr.T)[:, :, np.newaxis]
+        return np.squeeze(S, axis=squeeze) if squeeze else S
+
+    def __array__(self, dtype=None, copy=None):
+        S = self[...]
+        return S if dtype is None else S.astype(dtype)
+
+def msfun_ica_io_name(path):
+    return re.sub(r'[^\w.-]', '_', '.'.join(str(p) for p in path))
+
+def msfun_ica_io_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"msfun_ica_save - ERROR: Cannot store object of type {type(obj).__name__}... Try again.")
+
+def msfun_ica_io_pack(value, path, dirname):
+    # nested dicts and lists are kept in JSON, arrays (and long numeric lists,
+    # reloaded as arrays) are written to .npy files
+    if isinstance(value, np.ndarray) and value.ndim == 0:
+        return value.item()
+    if isinstance(value, np.ndarray):
+        fname = msfun_ica_io_name(path) + '.npy'
+        np.save(os.path.join(dirname, fname), np.ascontiguousarray(value))
+        return {'__npy__': fname}
+    if isinstance(value, dict):
+        return {str(k): msfun_ica_io_pack(v, path + [k], dirname) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and len(value) > 256 and all(isinstance(v, (int, float, np.number)) for v in value):
+        return msfun_ica_io_pack(np.asarray(value), path, dirname)
+    if isinstance(value, (list, tuple)):
+        return [msfun_ica_io_pack(v, path + [i], dirname) for i, v in enumerate(value)]
+    return value
+
+def msfun_ica_io_unpack(value, dirname, mmap):
+    if isinstance(value, dict):
+        if '__npy__' in value:
+            return np.load(os.path.join(dirname, value['__npy__']), mmap_mode='r' if mmap else None)
+        return {k: msfun_ica_io_unpack(v, dirname, mmap) for k, v in value.items()}
+    if isinstance(value, list):
+        return [msfun_ica_io_unpack(v, dirname, mmap) for v in value]
+    return value
+
+def msfun_ica_save(IC, dirname, cfg=None):
+    '''
+    Saves an IC result to the directory dirname, as .npy files for the arrays
+    (A, W, metrics, ...) and one IC.json file for everything else (thresholds,
+    artifact lists, fit descriptions), so that it can be reloaded in milliseconds
+    with msfun_ica_load without unpickling.
+
+    Parameters:
+    - IC: dict with at least 'A' and 'W'
+    - dirname: output directory (created if needed)
+    - cfg: dict with optional keys:
+        - 'sources': 'store' (default) to write IC['S'] to S.npy, copied in chunks
+          so that memory-mapped sources are not loaded; 'lazy' or 'none' to skip it
+          (sources are then recomputed from W and the data, see msfun_ica_load)
+        - 'dtype': storage dtype of S (default: dtype of IC['S'], e.g. float32 to halve it)
+        - 'datafile': path of the recording (.npy) recorded in IC.json for lazy sources
+
+    Returns:
+    - dirname
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(IC, dict) or 'A' not in IC or 'W' not in IC:
+        raise ValueError("msfun_ica_save - ERROR: IC structure missing mixing/unmixing matrices... Try again.")
+    sources = cfg.get('sources', 'store')
+    if sources not in ['store', 'lazy', 'none']:
+        raise ValueError("msfun_ica_save - ERROR: Sources mode not recognized... Try again.")
+    os.makedirs(dirname, exist_ok=True)
+
+    meta = {'version': 1, 'sources': 'none' if 'S' not in IC else sources}
+    if sources == 'store' and 'S' in IC:
+        S = IC['S']
+        dtype = np.dtype(cfg.get('dtype', None) or S.dtype)
+        msfun_ica_print(f"msfun_ica_save - Writing {S.shape} IC time courses as {dtype}...")
+        out = np.lib.format.open_memmap(os.path.join(dirname, 'S.npy'), mode='w+', dtype=dtype, shape=S.shape)
+        step = max(1, (1 << 24) // int(np.prod(S.shape[:-1])))
+        for ti in range(0, S.shape[-1], step):
+            out[..., ti:ti + step] = S[..., ti:ti + step]
+        out.flush()
+        del out
+    if cfg.get('datafile', None) is not None:
+        meta['datafile'] = os.path.abspath(cfg['datafile'])
+
+    msfun_ica_print(f"msfun_ica_save - Writing IC result to {dirname}...")
+    meta['IC'] = msfun_ica_io_pack({k: v for k, v in IC.items() if k != 'S'}, [], dirname)
+    with open(os.path.join(dirname, 'IC.json'), 'w') as f:
+        json.dump(meta, f, indent=1, default=msfun_ica_io_json)
+
+    msfun_ica_print("msfun_ica_save - Done.")
+    return dirname
+
+def msfun_ica_load(dirname, cfg=None):
+    '''
+    Loads an IC result written by msfun_ica_save.
+
+    Parameters:
+    - dirname: result directory
+    - cfg: dict with optional keys:
+        - 'mmap': bool, memory-map the stored arrays, including S (default True)
+        - 'data': recording [N x T] or [K x N x T] (array, memory map or .npy path)
+          from which lazy sources are computed; defaults to the stored 'datafile'
+
+    Returns:
+    - IC: dict with the stored entries; 'S' is a read-only memory map when it was
+      stored, a msfun_ica_sources computing W @ data rows on demand when data are
+      available, and absent otherwise
+    '''
+    if cfg is None:
+        cfg = {}
+    mmap = cfg.get('mmap', True)
+    fname = os.path.join(dirname, 'IC.json')
+    if not os.path.exists(fname):
+        raise ValueError("msfun_ica_load - ERROR: No IC result found in directory... Try again.")
+    with open(fname) as f:
+        meta = json.load(f)
+
+    IC = msfun_ica_io_unpack(meta['IC'], dirname, mmap)
+    if meta['sources'] == 'store':
+        IC['S'] = np.load(os.path.join(dirname, 'S.npy'), mmap_mode='r' if mmap else None)
+    else:
+        data = cfg.get('data', None)
+        if data is None:
+            data = meta.get('datafile', None)
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        if data is not None:
+            IC['S'] = msfun_ica_sources(IC['W'], data)
+    return IC
@@ -0,0 +1,164 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+
+_log = {
+    'sinks': [],
+    'quiet': False,
+    'stack': []
+}
+
+def msfun_ica_log_config(cfg=None):
+    '''
+    Configures the stage instrumentation and the progress messages.
+
+    Parameters:
+    - cfg: dict with optional keys:
+        - 'sink': where stage events go, a callable taking the event dict, the path
+          of a JSON lines file (appended to), or a list of those (default: none)
+        - 'quiet': bool, silence the progress messages of msfun_ica_print (default False)
+
+    Returns:
+    - previous: the previous configuration, to restore it with msfun_ica_log_config(previous)
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_log_config - ERROR: Configuration not a structure... Try again.")
+    previous = {'sink': list(_log['sinks']), 'quiet': _log['quiet']}
+    sinks = cfg.get('sink', None)
+    if sinks is None:
+        sinks = []
+    elif not isinstance(sinks, list):
+        sinks = [sinks]
+    for sink in sinks:
+        if not callable(sink) and not isinstance(sink, str):
+            raise ValueError("msfun_ica_log_config - ERROR: Sinks must be callables or file paths... Try again.")
+    _log['sinks'] = sinks
+    _log['quiet'] = bool(cfg.get('quiet', False))
+    return previous
+
+def msfun_ica_print(*args, **kwargs):
+    '''
+    Progress message, printed unless the quiet mode is on.
+    '''
+    if not _log['quiet']:
+        print(*args, **kwargs)
+
+def msfun_ica_log_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+def msfun_ica_log_emit(event):
+    for sink in _log['sinks']:
+        if callable(sink):
+            sink(event)
+        else:
+            with open(sink, 'a') as f:
+                f.write(json.dumps(event, default=msfun_ica_log_json) + '\n')
+
+def msfun_ica_log_describe(arrays):
+    '''
+    Shapes and dtypes of a dict of arrays (other entries are ignored).
+    '''
+    return {k: {'shape': list(v.shape), 'dtype': str(v.dtype)} for k, v in arrays.items() if isinstance(v, np.ndarray)}
+
+def msfun_ica_log_rss():
+    '''
+    Returns (current, peak) resident set size in MB. On Linux the peak is the
+    high-water mark since the last msfun_ica_log_rss_reset; elsewhere the
+    current size is unknown (NaN) and the peak covers the whole process (NaN
+    as well where the resource module is missing, e.g. on Windows).
+    '''
+    rss = hwm = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if hwm is None:
+        try:
+            import resource
+        except ImportError:
+            # no getrusage (Windows): both sizes unknown
+            return (np.nan if rss is None else rss), np.nan
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        hwm = maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+    return (np.nan if rss is None else rss), hwm
+
+def msfun_ica_log_rss_reset():
+    '''
+    Resets the peak resident set size to the current one (Linux only).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def msfun_ica_log_note(**info):
+    '''
+    Adds information (e.g. FastICA iterations, output shapes) to the end event
+    of the innermost running stage. Ignored outside of a stage.
+    '''
+    if _log['stack']:
+        _log['stack'][-1]['info'].update(info)
+
+@contextmanager
+def msfun_ica_log_stage(stage, inputs=None):
+    '''
+    Instruments a pipeline stage:
+
+        with msfun_ica_log_stage('decomp', {'data': data}):
+            ...
+
+    emits a 'start' event with the shapes and dtypes of inputs, and an 'end'
+    event with the wall and CPU times, the peak memory increase over the stage
+    start (MB, children stages included), the status ('ok' or the error) and
+    everything added with msfun_ica_log_note. Nothing is measured when no sink
+    is configured.
+    '''
+    if not _log['sinks']:
+        yield
+        return
+
+    depth = len(_log['stack'])
+    if depth:
+        # fold the parent's peak so far before resetting the high-water mark
+        _log['stack'][-1]['peak'] = max(_log['stack'][-1]['peak'], msfun_ica_log_rss()[1])
+    msfun_ica_log_emit({'event': 'start', 'stage': stage, 'depth': depth, 'time': time.time(),
+                        'inputs': msfun_ica_log_describe(inputs or {})})
+    msfun_ica_log_rss_reset()
+    rss0, _ = msfun_ica_log_rss()
+    frame = {'info': {}, 'peak': 0.0}
+    _log['stack'].append(frame)
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException as err:
+        status = f'error: {err!r}'
+        raise
+    finally:
+        wall = time.perf_counter() - t0
+        cpu = time.process_time() - c0
+        _log['stack'].pop()
+        rss, hwm = msfun_ica_log_rss()
+        peak = max(hwm, frame['peak'])
+        if _log['stack']:
+            _log['stack'][-1]['peak'] = max(_log['stack'][-1]['peak'], peak)
+        event = {'event': 'end', 'stage': stage, 'depth': depth, 'time': time.time(), 'status': status,
+                 'wall': wall, 'cpu': cpu, 'rss': rss, 'peakrss_delta': peak - rss0 if rss0 == rss0 else np.nan}
+        event.update(frame['info'])
+        msfun_ica_log_emit(event)
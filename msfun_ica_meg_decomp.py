@@ -1,13 +1,63 @@
 import numpy as np
 from sklearn.decomposition import FastICA
+from msfun_ica_fastica import msfun_ica_fastica_params, msfun_ica_fastica_whiten
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
 
 def msfun_ica_meg_decomp(sig, cfg=None):
+    '''
+    Decomposes the [N x T] MEG signal matrix using temporal ICA.
+
+    Parameters:
+    - sig: numpy.ndarray [N x T]; numpy.memmap input or a chunk source (callable
+      returning an iterator, or an iterator of [N x t] blocks) is handled out of core
+      by msfun_ica_meg_decomp_outofcore
+    - cfg: dict with optional keys:
+        - 'normalize': numpy.ndarray of shape [N] for normalization factors
+        - 'fastica': dict of parameters to pass to FastICA
+        - 'engine': 'sklearn' (default) or 'native' for msfun_ica_fastica
+        - 'W0': initial unmixing matrix [numofic x N], e.g. a previous IC['W'] (with the sklearn
+          engine, the data are then whitened here and W0 is passed as w_init)
+        - 'dtype': computation dtype of the normalized data, of the ICA and of S
+          (default: float32 for float32 data, float64 otherwise); covariance and
+          moment sums stay in float64
+        - 'dof': non-interactive output of msfun_ica_meg_dofestimate; ICA then runs in the
+          subspace of its ndof leading eigendirections, without re-estimating the covariance
+        - 'whitening': precomputed whitening operator, dict with 'K' [n x N] acting on
+          normalized data and optional 'Kinv' and 'mean'
+        - 'stability': dict to run the multi-seed analysis of msfun_ica_meg_stability
+        - 'chunk': samples per block, forces the out-of-core path
+        - 'incremental': state of msfun_ica_meg_decomp_incremental_init; sig is then the
+          new segment of a growing recording and the previous decomposition is updated
+          by msfun_ica_meg_decomp_incremental
+
+    Returns:
+    - IC: dict with keys 'S' [numofic x T], 'A' [N x numofic] and 'W' [numofic x N],
+      with A and W in sensor space
+    '''
     if cfg is None:
         cfg = {}
 
+    if cfg.get("incremental", None) is not None:
+        from msfun_ica_meg_decomp_incremental import msfun_ica_meg_decomp_incremental
+        msfun_ica_print("msfun_ica_meg_decomp - Incremental update with a new segment...")
+        return msfun_ica_meg_decomp_incremental(sig, cfg)
+
+    chunked = callable(sig) or (not isinstance(sig, np.ndarray) and hasattr(sig, "__next__"))
+    if isinstance(sig, np.memmap) or chunked or "chunk" in cfg:
+        if cfg.get("stability", None) or cfg.get("whitening", None) is not None:
+            raise ValueError("msfun_ica_meg_decomp - ERROR: Stability analysis and given whitening operators need an in-memory signal, not memory-mapped or chunked data... Try again.")
+        from msfun_ica_meg_decomp_outofcore import msfun_ica_meg_decomp_outofcore
+        msfun_ica_print("msfun_ica_meg_decomp - Out-of-core decomposition of memory-mapped or chunked data...")
+        return msfun_ica_meg_decomp_outofcore(sig, cfg)
+
     if not isinstance(sig, np.ndarray) or sig.ndim != 2:
         raise ValueError("msfun_ica_meg_decomp - ERROR: Signal matrix inconsistent... Try again.")
 
+    if cfg.get("stability", None):
+        from msfun_ica_meg_stability import msfun_ica_meg_stability
+        msfun_ica_print("msfun_ica_meg_decomp - Multi-run stability analysis...")
+        return msfun_ica_meg_stability(sig, cfg)
+
     N, T = sig.shape
 
     if not isinstance(cfg, dict):
@@ -20,24 +70,76 @@ def msfun_ica_meg_decomp(sig, cfg=None):
             raise ValueError("msfun_ica_meg_decomp - ERROR: Normalization factors inconsistent... Try again.")
         if normalize.shape[0] != N:
             normalize = normalize.T
+    elif cfg.get("dof", None) is not None and cfg["dof"].get("normalize", None) is not None:
+        msfun_ica_print("msfun_ica_meg_decomp - using normalization of the degrees of freedom estimate...")
+        normalize = np.asarray(cfg["dof"]["normalize"])
     else:
-        print("msfun_ica_meg_decomp - using temporal standard deviation of data...")
-        normalize = np.std(sig, axis=1)
+        msfun_ica_print("msfun_ica_meg_decomp - using temporal standard deviation of data...")
+        normalize = np.std(sig, axis=1, dtype=np.float64)
+
+    fastica_params = msfun_ica_fastica_params(cfg.get("fastica", {"fun": "tanh", "max_iter": 200, "random_state": 0}), "msfun_ica_meg_decomp")
+
+    engine = cfg.get("engine", "sklearn")
+    if engine not in ["sklearn", "native"]:
+        raise ValueError("msfun_ica_meg_decomp - ERROR: FastICA engine not recognized... Try again.")
 
-    fastica_params = cfg.get("fastica", {"fun": "tanh", "max_iter": 200, "random_state": 0})
-    if not isinstance(fastica_params, dict):
-        raise ValueError("msfun_ica_meg_decomp - ERROR: FastICA parameters must be given in a dictionary... Try again.")
+    wh = msfun_ica_meg_decomp_whitening(sig, normalize, cfg, fastica_params.get("n_components", None))
 
-    print("msfun_ica_meg_decomp - Normalizing data units...")
-    sig_norm = sig / normalize[:, np.newaxis]
+    dtype = np.dtype(cfg.get("dtype", None) or (np.float32 if sig.dtype == np.float32 else np.float64))
+    if engine == "native":
+        from msfun_ica_fastica import msfun_ica_fastica
 
-    print("msfun_ica_meg_decomp - FASTICA in action...")
-    ica = FastICA(**fastica_params)
-    S = ica.fit_transform(sig_norm.T).T
-    A = ica.mixing_
-    W = ica.components_
+        msfun_ica_print("msfun_ica_meg_decomp - Normalizing data units...")
+        sig_norm = np.divide(sig, normalize[:, np.newaxis], dtype=dtype)
 
-    print("msfun_ica_meg_decomp - Restoring original data units...")
+        msfun_ica_print("msfun_ica_meg_decomp - native FASTICA in action...")
+        native_cfg = {k: fastica_params[k] for k in ["fun", "max_iter", "tol", "random_state", "n_components"] if k in fastica_params}
+        native_cfg["alpha"] = fastica_params.get("fun_args", {}).get("alpha", 1.0)
+        native_cfg["dtype"] = dtype
+        native_cfg["whitening"] = wh
+        if cfg.get("W0", None) is not None:
+            msfun_ica_print("msfun_ica_meg_decomp -       warm start from given unmixing matrix...")
+            native_cfg["W0"] = np.asarray(cfg["W0"]) * normalize[np.newaxis, :]
+        ica = msfun_ica_fastica(sig_norm, native_cfg)
+        del sig_norm
+        S = ica["S"]
+        A = ica["A"]
+        W = ica["W"]
+        msfun_ica_print(f"msfun_ica_meg_decomp -       {ica['niter']} fixed-point iterations...")
+    else:
+        msfun_ica_print("msfun_ica_meg_decomp - Normalizing data units...")
+        sig_norm = np.divide(sig, normalize[:, np.newaxis], dtype=dtype)
+
+        W0 = cfg.get("W0", None)
+        if W0 is not None and wh is None:
+            # warm start: whiten here so that W0 can be given to sklearn in whitened coordinates
+            wh = msfun_ica_fastica_whiten(sig_norm, fastica_params.get("n_components", None))
+
+        if wh is None:
+            msfun_ica_print("msfun_ica_meg_decomp - FASTICA in action...")
+            ica = FastICA(**fastica_params)
+            S = ica.fit_transform(sig_norm.T).T
+            msfun_ica_log_note(fastica_niter=int(ica.n_iter_), fastica_converged=bool(ica.n_iter_ < ica.max_iter))
+            A = ica.mixing_
+            W = ica.components_
+        else:
+            msfun_ica_print("msfun_ica_meg_decomp - FASTICA in action on whitened subspace...")
+            Z = wh["K"].astype(dtype) @ sig_norm - (wh["K"] @ wh["mean"]).astype(dtype)[:, np.newaxis]
+            del sig_norm
+            params = {k: v for k, v in fastica_params.items() if k not in ["n_components", "whiten", "whiten_solver"]}
+            if W0 is not None:
+                msfun_ica_print("msfun_ica_meg_decomp -       warm start from given unmixing matrix...")
+                W0 = np.asarray(W0) * normalize[np.newaxis, :]
+                if W0.shape != (wh["K"].shape[0], N):
+                    raise ValueError("msfun_ica_meg_decomp - ERROR: Initial unmixing matrix inconsistent... Try again.")
+                params["w_init"] = W0 @ wh["Kinv"]
+            ica = FastICA(whiten=False, **params)
+            S = ica.fit_transform(Z.T).T
+            msfun_ica_log_note(fastica_niter=int(ica.n_iter_), fastica_converged=bool(ica.n_iter_ < ica.max_iter))
+            A = wh["Kinv"] @ ica.components_.T
+            W = ica.components_ @ wh["K"]
+
+    msfun_ica_print("msfun_ica_meg_decomp - Restoring original data units...")
     A = A * normalize[:, np.newaxis]
     W = W / normalize[np.newaxis, :]
 
@@ -47,5 +149,36 @@ def msfun_ica_meg_decomp(sig, cfg=None):
         "W": W
     }
 
-    print("msfun_ica_meg_decomp - Done.")
+    msfun_ica_print("msfun_ica_meg_decomp - Done.")
     return IC
+
+def msfun_ica_meg_decomp_whitening(sig, normalize, cfg, n_components=None):
+    '''
+    Whitening operator of the normalized [N x T] signal given by cfg['dof'] (the
+    n_components, by default ndof, leading eigendirections of the degrees of
+    freedom estimate) or cfg['whitening'], in the dict format of
+    msfun_ica_fastica_whiten.
+
+    Returns:
+    - wh: whitening dict, or None when neither is given
+    '''
+    N = sig.shape[0]
+    if cfg.get("dof", None) is not None:
+        from msfun_ica_fastica import msfun_ica_fastica_whitening
+        dof = cfg["dof"]
+        if not isinstance(dof, dict) or any(k not in dof for k in ["ndof", "D", "V"]) or dof["V"].shape[0] != N:
+            raise ValueError("msfun_ica_meg_decomp - ERROR: Degrees of freedom estimate inconsistent... Try again.")
+        ndof = n_components or dof["ndof"]
+        msfun_ica_print(f"msfun_ica_meg_decomp - Whitening in the {ndof} leading eigendirections of the degrees of freedom estimate...")
+        mean = dof["mean"] if "mean" in dof else np.mean(sig, axis=1)
+        return msfun_ica_fastica_whitening(dof["D"], dof["V"], mean / normalize, ndof)
+    if cfg.get("whitening", None) is not None:
+        wh = dict(cfg["whitening"])
+        if "K" not in wh or wh["K"].ndim != 2 or wh["K"].shape[1] != N:
+            raise ValueError("msfun_ica_meg_decomp - ERROR: Whitening operator inconsistent... Try again.")
+        msfun_ica_print(f"msfun_ica_meg_decomp - Whitening with given [{wh['K'].shape[0]} x {N}] operator...")
+        wh.setdefault("Kinv", np.linalg.pinv(wh["K"]))
+        if "mean" not in wh:
+            wh["mean"] = np.mean(sig, axis=1) / normalize
+        return wh
+    return None
@@ -0,0 +1,169 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from msfun_ica_fastica import msfun_ica_fastica, msfun_ica_fastica_params
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_covstats import msfun_sig_covstats_init, msfun_sig_covstats_update, msfun_sig_covstats_finalize
+from msfun_sig_reservoir import msfun_sig_reservoir_init, msfun_sig_reservoir_update, msfun_sig_reservoir_get
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
+
+def msfun_ica_meg_decomp_incremental_init():
+    '''
+    Creates an empty state for msfun_ica_meg_decomp_incremental, to be passed
+    as cfg['incremental'] with every new segment of the recording.
+
+    Returns:
+    - state: dict with the running statistics ('stats'), the reservoir of older
+      samples ('res'), the previous unmixing/mixing matrices ('W', 'A'), the
+      number of updates ('update') and of samples seen ('T')
+    '''
+    return {
+        'stats': None,
+        'res': None,
+        'W': None,
+        'A': None,
+        'update': 0,
+        'T': 0
+    }
+
+def msfun_ica_meg_decomp_incremental(sig, cfg):
+    '''
+    Updates a temporal ICA decomposition with a new [N x t] segment of a growing
+    recording, without refitting on the whole history.
+
+    The channel means, standard deviations and covariance are running statistics
+    updated with the new segment only, and the normalization and whitening are
+    recomputed from them (an [N x N] eigendecomposition). FastICA is fit on the
+    new segment plus a bounded reservoir sample of the older data, starting from
+    the previous unmixing matrix, so an update costs O(t + fitsamples) and
+    usually converges in a few iterations. The new components are matched to
+    the previous ones (Hungarian assignment on the absolute correlation of the
+    IC time courses, estimated from the whitened covariance) and reordered and
+    sign-flipped accordingly, so IC indices are stable across updates.
+
+    Parameters:
+    - sig: numpy.ndarray or numpy.memmap [N x t], the new segment
+    - cfg: dict with keys:
+        - 'incremental': state of msfun_ica_meg_decomp_incremental_init, updated in place
+        - 'normalize': numpy.ndarray of shape [N] for fixed normalization factors
+          (default: running temporal standard deviation)
+        - 'fastica': dict of FastICA parameters ('n_components' is fixed by the first update)
+        - 'fitsamples': size of the reservoir of older samples (default 200000)
+        - 'chunk': samples per block for the statistics update (default 65536)
+        - 'dtype': dtype of the fit sample and of S (default: float32 for float32 data,
+          float64 otherwise); statistics are always accumulated in float64
+
+    Returns:
+    - IC: dict with keys 'S' [numofic x t] (sources of the new segment only, centered
+      with the running means), 'A' [N x numofic], 'W' [numofic x N] and 'incremental',
+      a dict with the 'update' number, the total number of samples 'T', the FastICA
+      'niter' and 'converged', the absolute correlation 'corr' [numofic] of each IC
+      with its previous estimate and the 'drift' 1 - corr with its 'max' and 'mean'
+      (zeros at the first update)
+    '''
+    state = cfg.get("incremental", None)
+    if not isinstance(state, dict) or "stats" not in state:
+        raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Incremental state missing, see msfun_ica_meg_decomp_incremental_init... Try again.")
+    if not isinstance(sig, np.ndarray) or sig.ndim != 2:
+        raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Signal matrix inconsistent... Try again.")
+    N, t = sig.shape
+    if state["stats"] is not None and state["stats"]["sum"].shape[0] != N:
+        raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Number of channels changed between updates... Try again.")
+
+    fastica_params = msfun_ica_fastica_params(cfg.get("fastica", {"fun": "tanh", "max_iter": 200, "random_state": 0}), "msfun_ica_meg_decomp_incremental")
+    dtype = np.dtype(cfg.get("dtype", None) or (np.float32 if sig.dtype == np.float32 else np.float64))
+
+    if state["stats"] is None:
+        state["stats"] = msfun_sig_covstats_init(N)
+        state["res"] = msfun_sig_reservoir_init(N, cfg.get("fitsamples", 200000), fastica_params.get("random_state", 0))
+    state["update"] += 1
+
+    msfun_ica_print(f"msfun_ica_meg_decomp_incremental - Update {state['update']}: adding {t} samples to the running statistics...")
+    for X in msfun_sig_chunks(sig, cfg.get("chunk", 65536)):
+        msfun_sig_covstats_update(state["stats"], X)
+    stats = msfun_sig_covstats_finalize(state["stats"])
+    state["T"] = stats["n"]
+
+    normalize = cfg.get("normalize", None)
+    if normalize is not None:
+        normalize = np.asarray(normalize).ravel()
+        if len(normalize) != N or np.any(normalize <= 0):
+            raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Normalization factors inconsistent... Try again.")
+    else:
+        normalize = stats["std"]
+
+    n_components = fastica_params.get("n_components", None) or N
+    if state["W"] is not None:
+        n_components = state["W"].shape[0]
+    if not 0 < n_components <= N:
+        raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Number of components inconsistent... Try again.")
+
+    C = stats["cov"] / np.outer(normalize, normalize)
+    D, V = np.linalg.eigh(C)
+    D = D[::-1][:n_components]
+    V = V[:, ::-1][:, :n_components]
+    if np.any(D <= 0):
+        raise ValueError("msfun_ica_meg_decomp_incremental - ERROR: Normalized covariance rank deficient, reduce n_components or add data... Try again.")
+    K = (V / np.sqrt(D)).T
+
+    # fit sample: older data from the reservoir, then the new segment
+    older = msfun_sig_reservoir_get(state["res"])
+    mean = stats["mean"].astype(dtype)[:, np.newaxis]
+    scale = normalize.astype(dtype)[:, np.newaxis]
+    Kd = K.astype(dtype)
+    Z = np.empty((n_components, older.shape[1] + t), dtype=dtype)
+    Z[:, :older.shape[1]] = Kd @ ((older - mean) / scale)
+    Z[:, older.shape[1]:] = Kd @ ((sig - mean) / scale)
+    msfun_ica_print(f"msfun_ica_meg_decomp_incremental - FASTICA on {t} new and {older.shape[1]} older of {state['T']} samples...")
+    for X in msfun_sig_chunks(sig, cfg.get("chunk", 65536)):
+        msfun_sig_reservoir_update(state["res"], X, dtype)
+
+    native_cfg = {k: fastica_params[k] for k in ["fun", "max_iter", "tol", "random_state"] if k in fastica_params}
+    native_cfg["alpha"] = fastica_params.get("fun_args", {}).get("alpha", 1.0)
+    native_cfg["whiten"] = False
+    native_cfg["dtype"] = dtype
+    W0 = None
+    if state["W"] is not None:
+        # previous unmixing in the current whitened coordinates
+        W0 = state["W"] * normalize[np.newaxis, :] @ (V * np.sqrt(D))
+        native_cfg["W0"] = W0
+    ica = msfun_ica_fastica(Z, native_cfg)
+    del Z
+    Wica = ica["W"]
+
+    corr = np.ones(n_components)
+    if W0 is not None:
+        # IC correlations new x previous under the (unit) whitened covariance
+        R = Wica @ W0.T / np.linalg.norm(W0, axis=1)[np.newaxis, :]
+        _, perm = linear_sum_assignment(np.abs(R).T, maximize=True)
+        Wica = Wica[perm] * np.sign(R[perm, np.arange(n_components)])[:, np.newaxis]
+        corr = np.minimum(np.abs(R[perm, np.arange(n_components)]), 1)
+    drift = 1 - corr
+    msfun_ica_log_note(incremental_update=state["update"], incremental_drift=float(drift.max()))
+    msfun_ica_print(f"msfun_ica_meg_decomp_incremental - {ica['niter']} iterations, IC drift max {drift.max():.4f}, mean {drift.mean():.4f}...")
+
+    A = (V * np.sqrt(D) @ Wica.T) * normalize[:, np.newaxis]
+    W = (Wica @ K) / normalize[np.newaxis, :]
+    state["W"] = W
+    state["A"] = A
+
+    S = np.empty((n_components, t), dtype=dtype)
+    np.subtract(W.astype(dtype) @ sig, (W @ stats["mean"]).astype(dtype)[:, np.newaxis], out=S, casting="same_kind")
+
+    IC = {
+        "S": S,
+        "A": A,
+        "W": W,
+        "incremental": {
+            "update": state["update"],
+            "T": state["T"],
+            "niter": ica["niter"],
+            "converged": ica["converged"],
+            "corr": corr,
+            "drift": drift,
+            "max": float(drift.max()),
+            "mean": float(drift.mean())
+        }
+    }
+
+    msfun_ica_print("msfun_ica_meg_decomp_incremental - Done.")
+    return IC
@@ -0,0 +1,198 @@
+import os
+import weakref
+import tempfile
+import numpy as np
+from sklearn.decomposition import FastICA
+from msfun_ica_fastica import msfun_ica_fastica, msfun_ica_fastica_params
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_covstats import msfun_sig_covstats_init, msfun_sig_covstats_update, msfun_sig_covstats_finalize
+from msfun_sig_reservoir import msfun_sig_reservoir_init, msfun_sig_reservoir_update, msfun_sig_reservoir_get
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
+
+def msfun_ica_meg_decomp_outofcore(sig, cfg=None):
+    '''
+    Temporal ICA of an [N x T] signal that does not fit in memory.
+
+    One chunked pass accumulates channel means, standard deviations and the
+    covariance, and keeps a bounded random subset of samples. FastICA is fit on
+    that subset after normalization and whitening with the full-data statistics,
+    and a second chunked pass writes the sources to a memory-mapped .npy file.
+
+    Parameters:
+    - sig: numpy.memmap / numpy.ndarray [N x T], or a chunk source accepted by
+      msfun_sig_chunks. One-shot iterators are rejected since two passes are needed;
+      pass a callable returning a fresh iterator instead.
+    - cfg: dict with optional keys:
+        - 'normalize': numpy.ndarray of shape [N] for normalization factors
+        - 'fastica': dict of parameters to pass to FastICA ('n_components' sets the whitening dimension)
+        - 'engine': 'sklearn' (default) or 'native' for msfun_ica_fastica
+        - 'W0': initial unmixing matrix [numofic x N] in original units, e.g. a previous IC['W']
+        - 'dof': non-interactive output of msfun_ica_meg_dofestimate; ICA then runs in the
+          subspace of its ndof leading eigendirections instead of those of the data covariance
+        - 'chunk': samples per block (default 65536)
+        - 'fitsamples': maximal number of samples used to fit the unmixing (default 200000)
+        - 'Sfile': path of the .npy file receiving the sources, kept after the run and owned
+          by the caller (default: a temporary file, deleted once IC['S'] and all its views
+          are garbage collected)
+        - 'dtype': dtype of the fit sample, of the whitened data and of the sources
+          (default: float32 for float32 data, float64 otherwise); statistics are
+          always accumulated in float64
+
+    Returns:
+    - IC: dict with keys 'A' [N x numofic], 'W' [numofic x N] and 'S', a read-write
+      memory map of shape [numofic x T] backed by IC['Sfile'] (see 'Sfile' for its lifetime)
+    '''
+    if cfg is None:
+        cfg = {}
+
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Configuration not a structure... Try again.")
+    if not isinstance(sig, np.ndarray) and not callable(sig) and iter(sig) is sig:
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: One-shot chunk iterator cannot be read twice, give a callable returning a fresh iterator... Try again.")
+
+    chunk = cfg.get("chunk", 65536)
+    fitsamples = cfg.get("fitsamples", 200000)
+
+    fastica_params = msfun_ica_fastica_params(cfg.get("fastica", {"fun": "tanh", "max_iter": 200, "random_state": 0}), "msfun_ica_meg_decomp_outofcore")
+    n_components = fastica_params.pop("n_components", None)
+    fastica_params.pop("whiten", None)
+    fastica_params.pop("whiten_solver", None)
+
+    msfun_ica_print("msfun_ica_meg_decomp_outofcore - Accumulating data statistics in chunks...")
+    stats = None
+    res = None
+    for X in msfun_sig_chunks(sig, chunk):
+        if stats is None:
+            N = X.shape[0]
+            dtype = np.dtype(cfg.get("dtype", None) or (np.float32 if X.dtype == np.float32 else np.float64))
+            stats = msfun_sig_covstats_init(N)
+            res = msfun_sig_reservoir_init(N, fitsamples, fastica_params.get("random_state", 0))
+        msfun_sig_covstats_update(stats, X)
+        msfun_sig_reservoir_update(res, X, dtype)
+    if stats is None:
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Signal is empty... Try again.")
+    stats = msfun_sig_covstats_finalize(stats)
+    T = stats["n"]
+
+    dof = cfg.get("dof", None)
+    if dof is not None and (not isinstance(dof, dict) or any(k not in dof for k in ["ndof", "D", "V"]) or dof["V"].shape[0] != N):
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Degrees of freedom estimate inconsistent... Try again.")
+
+    normalize = cfg.get("normalize", None)
+    if normalize is not None:
+        normalize = np.asarray(normalize).ravel()
+        if len(normalize) != N or np.any(normalize <= 0):
+            raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Normalization factors inconsistent... Try again.")
+    elif dof is not None and dof.get("normalize", None) is not None:
+        msfun_ica_print("msfun_ica_meg_decomp_outofcore - using normalization of the degrees of freedom estimate...")
+        normalize = np.asarray(dof["normalize"])
+    else:
+        msfun_ica_print("msfun_ica_meg_decomp_outofcore - using temporal standard deviation of data...")
+        normalize = stats["std"]
+
+    if n_components is None:
+        n_components = dof["ndof"] if dof is not None else N
+    if not 0 < n_components <= N:
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Number of components inconsistent... Try again.")
+
+    if dof is not None:
+        from msfun_ica_fastica import msfun_ica_fastica_whitening
+        msfun_ica_print(f"msfun_ica_meg_decomp_outofcore - Whitening in the {n_components} leading eigendirections of the degrees of freedom estimate...")
+        wh = msfun_ica_fastica_whitening(dof["D"], dof["V"], stats["mean"] / normalize, n_components)
+        D, V = wh["D"], wh["V"]
+    else:
+        msfun_ica_print("msfun_ica_meg_decomp_outofcore - Whitening from normalized data covariance...")
+        C = stats["cov"] / np.outer(normalize, normalize)
+        D, V = np.linalg.eigh(C)
+        D = D[::-1][:n_components]
+        V = V[:, ::-1][:, :n_components]
+        if np.any(D <= 0):
+            raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Normalized covariance rank deficient, reduce n_components... Try again.")
+    K = (V / np.sqrt(D)).T
+
+    msfun_ica_print(f"msfun_ica_meg_decomp_outofcore - FASTICA in action on {res['fill']} of {T} samples...")
+    Z = K.astype(dtype) @ ((msfun_sig_reservoir_get(res) - stats["mean"].astype(dtype)[:, np.newaxis]) / normalize.astype(dtype)[:, np.newaxis])
+    del res
+    W0 = None
+    if cfg.get("W0", None) is not None:
+        # initial unmixing in whitened coordinates
+        W0 = np.asarray(cfg["W0"]) * normalize[np.newaxis, :] @ (V * np.sqrt(D))
+    if cfg.get("engine", "sklearn") == "native":
+        native_cfg = {k: fastica_params[k] for k in ["fun", "max_iter", "tol", "random_state"] if k in fastica_params}
+        native_cfg["alpha"] = fastica_params.get("fun_args", {}).get("alpha", 1.0)
+        native_cfg["whiten"] = False
+        native_cfg["dtype"] = dtype
+        native_cfg["W0"] = W0
+        Wica = msfun_ica_fastica(Z, native_cfg)["W"]
+    else:
+        if W0 is not None:
+            fastica_params["w_init"] = W0
+        ica = FastICA(whiten=False, **fastica_params)
+        ica.fit(Z.T)
+        msfun_ica_log_note(fastica_niter=int(ica.n_iter_), fastica_converged=bool(ica.n_iter_ < ica.max_iter))
+        Wica = ica.components_
+    del Z
+    Wnorm = Wica @ K
+    Anorm = V * np.sqrt(D) @ Wica.T
+
+    msfun_ica_print("msfun_ica_meg_decomp_outofcore - Restoring original data units...")
+    A = Anorm * normalize[:, np.newaxis]
+    W = Wnorm / normalize[np.newaxis, :]
+    b = W @ stats["mean"]
+
+    S, Sfile = msfun_ica_meg_decomp_outofcore_sources(sig, W, b, T, dtype, chunk, cfg.get("Sfile", None))
+
+    IC = {
+        "S": S,
+        "A": A,
+        "W": W,
+        "Sfile": Sfile
+    }
+
+    msfun_ica_print("msfun_ica_meg_decomp_outofcore - Done.")
+    return IC
+
+def msfun_ica_meg_decomp_outofcore_sources(sig, W, b, T, dtype, chunk=65536, Sfile=None):
+    '''
+    Writes the sources W @ x - b of the [N x T] signal sig (array or chunk source
+    of msfun_sig_chunks) to a memory-mapped .npy file, one chunk at a time.
+
+    Parameters:
+    - sig: numpy.memmap / numpy.ndarray [N x T], or a chunk source of msfun_sig_chunks
+    - W: unmixing matrix [numofic x N]
+    - b: offsets [numofic], W @ channel means for centered sources
+    - T: number of samples of sig
+    - dtype: dtype of the sources
+    - chunk: samples per block (default 65536)
+    - Sfile: path of the .npy file, kept and owned by the caller (default: a temporary
+      file, deleted once the memory map and all its views are garbage collected)
+
+    Returns:
+    - S: read-write memory map [numofic x T]
+    - Sfile: its path
+    '''
+    temporary = Sfile is None
+    if temporary:
+        fd, Sfile = tempfile.mkstemp(suffix=".npy", prefix="msfun_ica_S_")
+        os.close(fd)
+    msfun_ica_print(f"msfun_ica_meg_decomp_outofcore - Writing IC time courses to {Sfile}...")
+    S = np.lib.format.open_memmap(Sfile, mode="w+", dtype=dtype, shape=(W.shape[0], T))
+    Wd = W.astype(dtype)
+    bd = np.asarray(b).astype(dtype)[:, np.newaxis]
+    ti = 0
+    for X in msfun_sig_chunks(sig, chunk):
+        t = X.shape[1]
+        np.subtract(Wd @ X, bd, out=S[:, ti:ti + t], casting="same_kind")
+        ti += t
+    if ti != T:
+        raise ValueError("msfun_ica_meg_decomp_outofcore - ERROR: Chunk source changed between passes... Try again.")
+    S.flush()
+    if temporary:
+        weakref.finalize(S, msfun_ica_meg_decomp_outofcore_remove, Sfile)
+    return S, Sfile
+
+def msfun_ica_meg_decomp_outofcore_remove(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
@@ -1,7 +1,37 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.linalg import eigh
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_epoch import msfun_sig_epoch_chunks
+from msfun_sig_covstats import msfun_sig_covstats_init, msfun_sig_covstats_update, msfun_sig_covstats_finalize
+from msfun_ica_log import msfun_ica_print
 
 def msfun_ica_meg_dofestimate(data, cfg):
+    '''
+    Estimates the number of degrees of freedom (ndof) of MEG data from the
+    eigenvalues of the normalized data covariance.
+
+    The covariance is accumulated over chunks of baseline corrected epochs (see
+    msfun_sig_epoch_chunks), or block by block for continuous (possibly
+    memory-mapped) data, so no concatenated copy of the whole data is built.
+
+    Parameters:
+    - data: numpy.ndarray or numpy.memmap, shape [N x T] or [K x N x T]
+    - cfg: dict with optional keys:
+        - 'normalize': numpy.ndarray of shape [N] for normalization factors
+        - 'method': 'abs', 'maxrel' or 'rel' (default) eigenvalue cutoff rule
+        - 'param': cutoff parameter (default 1e3)
+        - 'chunk': samples per block for continuous data (default 65536)
+        - 'neig': compute only the neig leading eigenvalues (default: all N)
+        - 'interactive': bool, show the eigenvalue plot and ask for confirmation (default True)
+        - 'plot': bool, draw the eigenvalue figure (default: same as 'interactive')
+
+    Returns:
+    - ndof: int, if cfg['interactive'] is True
+    - dof: dict with keys 'ndof', 'D' (increasing eigenvalues), 'V' (corresponding
+      eigenvectors [N x len(D)]), 'mean' (channel means), 'normalize', 'method' and 'param',
+      if cfg['interactive'] is False; it can be given to msfun_ica_meg_decomp as cfg['dof']
+    '''
     if not isinstance(data, np.ndarray) or data.ndim not in [2, 3]:
         raise ValueError("msfun_ica_meg_dofestimate - ERROR: data must be a numeric array... Try again.")
 
@@ -29,23 +59,39 @@ def msfun_ica_meg_dofestimate(data, cfg):
 
     param = cfg.get("param", 1e3)
 
+    interactive = cfg.get("interactive", True)
+    plot = cfg.get("plot", interactive)
+    neig = cfg.get("neig", None)
+    if neig is not None and (not isinstance(neig, int) or not 1 < neig <= N):
+        raise ValueError("msfun_ica_meg_dofestimate - ERROR: Number of eigenvalues inconsistent... Try again.")
+
+    msfun_ica_print("msfun_ica_meg_dofestimate - Accumulating data covariance in chunks...")
+    stats = msfun_sig_covstats_init(N)
     if epoching:
-        print("msfun_ica_meg_dofestimate - Baseline correcting and concatenating epochs...")
-        X = np.zeros((N, K*T))
-        for k in range(K):
-            av = np.mean(data[k, :, :], axis=1, keepdims=True)
-            X[:, k*T:(k+1)*T] = data[k, :, :] - av
-        data = X
-
-    print("msfun_ica_meg_dofestimate - Normalizing data...")
+        msfun_ica_print("msfun_ica_meg_dofestimate -   baseline correcting epochs...")
+        for _, X in msfun_sig_epoch_chunks(data, baseline=True, concat=True):
+            msfun_sig_covstats_update(stats, X)
+    else:
+        for X in msfun_sig_chunks(data, cfg.get("chunk", 65536)):
+            msfun_sig_covstats_update(stats, X)
+    stats = msfun_sig_covstats_finalize(stats)
+
+    msfun_ica_print("msfun_ica_meg_dofestimate - Normalizing data covariance...")
     if normalize is None:
-        normalize = np.std(data, axis=1)
-        print("msfun_ica_meg_dofestimate -   using data standard deviation...")
-    data = data / normalize[:, np.newaxis]
+        normalize = stats["std"]
+        msfun_ica_print("msfun_ica_meg_dofestimate -   using data standard deviation...")
+    C = stats["cov"] / np.outer(normalize, normalize)
 
-    print("msfun_ica_meg_dofestimate - Computing normalized data covariance and its eigenvalues...")
-    D = np.linalg.eigvalsh(np.cov(data))
-    D = np.sort(D)
+    if neig is None:
+        msfun_ica_print("msfun_ica_meg_dofestimate - Computing normalized data covariance eigenvalues...")
+        D, V = np.linalg.eigh(C)
+    else:
+        msfun_ica_print(f"msfun_ica_meg_dofestimate - Computing {neig} leading normalized data covariance eigenvalues...")
+        D, V = eigh(C, subset_by_index=[N - neig, N - 1])
+    order = np.argsort(D)
+    D = D[order]
+    V = V[:, order]
+    M = len(D)
 
     if method == "abs":
         cutoff = param
@@ -57,33 +103,51 @@ def msfun_ica_meg_dofestimate(data, cfg):
         R = D[1:] / D[:-1]
         n = np.where(R >= param)[0][-1]
 
-    ndof = N - n
-    print(f"msfun_ica_meg_dofestimate - Estimated {ndof} largest eigendirections...")
+    ndof = M - n
+    msfun_ica_print(f"msfun_ica_meg_dofestimate - Estimated {ndof} largest eigendirections...")
+
+    if plot:
+        msfun_ica_meg_dofestimate_plot(D, n, method, cutoff if method != "rel" else param)
+
+    if not interactive:
+        return {
+            "ndof": int(ndof),
+            "D": D,
+            "V": V,
+            "mean": stats["mean"],
+            "normalize": normalize,
+            "method": method,
+            "param": param
+        }
+
+    if plot:
+        plt.show()
+
+    go = input(f"Keep {ndof} largest eigendirections? [y/n] ")
+    if go.lower() in ["n", "no"]:
+        ndof = int(input("Enter number of eigendirections to keep: "))
+
+    return ndof
 
-    # Plot eigenvalues
+def msfun_ica_meg_dofestimate_plot(D, n, method, cutoff):
+    M = len(D)
     plt.figure("msfun_ica_meg_dofestimate - Normalized data covariance eigenvalues")
     if method in ["abs", "maxrel"]:
         plt.plot(D, "r")
         plt.xlabel("n")
         plt.ylabel("eigenvalue(n)")
-        plt.plot(range(n+1, N), D[n+1:], "b")
+        plt.plot(range(n+1, M), D[n+1:], "b")
         plt.axhline(y=cutoff, color="g")
     else:
+        R = D[1:] / D[:-1]
         plt.subplot(1, 2, 1)
         plt.plot(D, "r")
         plt.xlabel("n")
         plt.ylabel("eigenvalue(n)")
-        plt.plot(range(n+1, N), D[n+1:], "b")
+        plt.plot(range(n+1, M), D[n+1:], "b")
         plt.subplot(1, 2, 2)
         plt.plot(R, "r")
         plt.xlabel("n")
         plt.ylabel("eigenvalue(n+1)/eigenvalue(n)")
-        plt.plot(range(n+1, N-1), R[n+1:], "b")
-        plt.axhline(y=param, color="g")
-    plt.show()
-
-    go = input(f"Keep {ndof} largest eigendirections? [y/n] ")
-    if go.lower() in ["n", "no"]:
-        ndof = int(input("Enter number of eigendirections to keep: "))
-
-    return ndof
+        plt.plot(range(n+1, M-1), R[n+1:], "b")
+        plt.axhline(y=cutoff, color="g")
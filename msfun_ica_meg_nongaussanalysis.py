@@ -1,7 +1,52 @@
 import numpy as np
-from scipy.stats import skew, kurtosis
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_epoch import msfun_sig_epoch_chunks
+from msfun_sig_moments import msfun_sig_moments_init, msfun_sig_moments_update, msfun_sig_moments_finalize
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_meg_nongaussanalysis_reorder(IC, order, chunk=65536):
+    '''
+    Permutes the ICs of IC ('S', 'A' and 'W') by order. Memory-mapped sources
+    are reordered in place block by block, others are replaced by a copy.
+    '''
+    S = IC['S']
+    if isinstance(S, np.memmap) and S.flags.writeable:
+        for ti in range(0, S.shape[-1], chunk):
+            S[..., ti:ti + chunk] = S[..., order, ti:ti + chunk]
+    elif S.ndim == 3:
+        IC['S'] = S[:, order, :]
+    else:
+        IC['S'] = S[order, :]
+    if 'A' in IC:
+        IC['A'] = IC['A'][:, order]
+    if 'W' in IC:
+        IC['W'] = IC['W'][order, :]
+    return IC
 
 def msfun_ica_meg_nongaussanalysis(IC, cfg):
+    '''
+    Skewness and excess kurtosis of the ICs, and IC sorting by decreasing kurtosis.
+
+    Moments are accumulated in one pass over chunks of baseline corrected epochs
+    (see msfun_sig_epoch_chunks) or over blocks of continuous sources, so no
+    concatenated copy of the whole epoched sources is made and IC['S'] keeps its layout. Memory-mapped sources
+    are reordered in place block by block.
+
+    Parameters:
+    - IC: dict with 'S' [numofic x T] or [K x numofic x T], and optionally 'A' and 'W'
+    - cfg: dict with optional keys:
+        - 'Tskew': threshold on absolute skewness (default nan, unused)
+        - 'Tkurt': threshold on excess kurtosis (default 15)
+        - 'chunk': samples per block for continuous sources (default 65536)
+        - 'reorder': bool, sort the ICs (default True); with False, IC['S'], 'A' and 'W'
+          are only read, e.g. while other analyses use the sources concurrently, and
+          the sorting is left to the caller (msfun_ica_meg_nongaussanalysis_reorder)
+
+    Returns:
+    - IC: sorted by decreasing kurtosis, with 'cumulant' dict holding 'skew', 'kurt',
+      'order' (sorting permutation), 'Tskew', 'Tkurt' and 'list' of flagged ICs,
+      all given in the sorted order
+    '''
     if 'S' not in IC or not isinstance(IC['S'], np.ndarray) or IC['S'].ndim not in [2, 3]:
         raise ValueError('msfun_ica_meg_nongaussanalysis - ERROR : IC structure missing elements or inconsistent.')
 
@@ -16,30 +61,28 @@ def msfun_ica_meg_nongaussanalysis(IC, cfg):
 
     Tskew = cfg.get('Tskew', np.nan)
     Tkurt = cfg.get('Tkurt', 15)
+    chunk = cfg.get('chunk', 65536)
 
+    msfun_ica_print('msfun_ica_meg_nongaussanalysis - Computing IC skewness and kurtosis...')
+    mom = msfun_sig_moments_init(numofic)
     if epoching:
-        print('msfun_ica_meg_nongaussanalysis - Baseline correcting and concatenating epochs...')
-        X = np.zeros((numofic, K * T))
-        for k in range(K):
-            av = np.mean(IC['S'][k, :, :], axis=1, keepdims=True)
-            X[:, k*T:(k+1)*T] = IC['S'][k, :, :] - av
-        IC['S'] = X
-
-    print('msfun_ica_meg_nongaussanalysis - Computing IC skewness and kurtosis...')
-    skew_vals = skew(IC['S'], axis=1, bias=False)
-    kurt_vals = kurtosis(IC['S'], axis=1, bias=False)  # excess kurtosis by default is True
-
-    print('msfun_ica_meg_nongaussanalysis - Classifying ICs using their kurtosis...')
+        msfun_ica_print('msfun_ica_meg_nongaussanalysis -       accumulating baseline corrected epochs...')
+        for _, X in msfun_sig_epoch_chunks(IC['S'], baseline=True, concat=True):
+            msfun_sig_moments_update(mom, X)
+    else:
+        for X in msfun_sig_chunks(IC['S'], chunk):
+            msfun_sig_moments_update(mom, X)
+    skew_vals, kurt_vals = msfun_sig_moments_finalize(mom)
+
+    msfun_ica_print('msfun_ica_meg_nongaussanalysis - Classifying ICs using their kurtosis...')
     sorted_indices = np.argsort(-kurt_vals)
-    IC['S'] = IC['S'][sorted_indices, :]
-    if 'A' in IC:
-        IC['A'] = IC['A'][:, sorted_indices]
-    if 'W' in IC:
-        IC['W'] = IC['W'][sorted_indices, :]
+    if cfg.get('reorder', True):
+        msfun_ica_meg_nongaussanalysis_reorder(IC, sorted_indices, chunk)
 
     IC['cumulant'] = {
         'skew': skew_vals[sorted_indices],
         'kurt': kurt_vals[sorted_indices],
+        'order': sorted_indices,
         'Tskew': Tskew,
         'Tkurt': Tkurt
     }
@@ -48,5 +91,5 @@ def msfun_ica_meg_nongaussanalysis(IC, cfg):
     list_kurt = np.where(IC['cumulant']['kurt'] > Tkurt)[0] if not np.isnan(Tkurt) else np.array([], dtype=int)
     IC['cumulant']['list'] = np.sort(np.unique(np.concatenate((list_skew, list_kurt))))
 
-    print('msfun_ica_meg_nongaussanalysis - Done.')
+    msfun_ica_print('msfun_ica_meg_nongaussanalysis - Done.')
     return IC
@@ -1,7 +1,16 @@
 import numpy as np
-import matplotlib.pyplot as plt
+from msfun_ica_log import msfun_ica_print
+from msfun_ica_render import msfun_ica_render
 
 def msfun_ica_meg_plot(IC):
+    '''
+    Summary figure of the cumulant, correlation and spectral analyses, with the
+    rejected ICs circled, rendered without blocking (see msfun_ica_render).
+
+    Returns:
+    - keep, reject: kept and rejected IC indices
+    - figure: pyplot figure, file path or Future of the file path
+    '''
     reject = []
 
     # Handle cumulant analysis rejections
@@ -14,14 +23,15 @@ def msfun_ica_meg_plot(IC):
     Ncorr = 0
     corrnames = []
     if 'corr' in IC:
-        corrnames = [k for k in IC['corr'].keys() if k not in ['list', 'Tcorr']]
+        corrnames = [k for k, v in IC['corr'].items()
+                     if k not in ['list', 'Tcorr'] and not k.endswith('_lag') and isinstance(v, np.ndarray)]
         Ncorr = len(corrnames)
         reject.extend(IC['corr'].get('list', []))
 
     # Handle spectral analysis rejections
     Nspectral = 0
     if 'spectral' in IC and 'gof' in IC['spectral']:
-        Nspectral = IC['spectral']['gof'].shape[1]
+        Nspectral = np.shape(IC['spectral']['gof'])[1]
         reject.extend(IC['spectral'].get('list', []))
 
     reject = sorted(set(reject))
@@ -33,49 +43,51 @@ def msfun_ica_meg_plot(IC):
     ncol = int(np.floor(np.sqrt(Ntot)))
     nrow = int(np.ceil(Ntot / ncol))
 
-    print("msfun_ica_meg_plot - Generating plots...")
-    fig, axs = plt.subplots(nrow, ncol, figsize=(4 * ncol, 3 * nrow))
-    axs = axs.flatten()
-    n = 0
+    msfun_ica_print("msfun_ica_meg_plot - Generating plots...")
 
-    # Cumulant analysis plots
-    if 'cumulant' in IC:
-        if 'skew' in IC['cumulant']:
-            ax = axs[n]; n += 1
-            ax.plot(IC['cumulant']['skew'], 'x')
-            ax.plot(reject, [IC['cumulant']['skew'][i] for i in reject], 'or')
-            ax.axhline(IC['cumulant']['Tskew'], linestyle='--', color='g')
-            ax.axhline(-IC['cumulant']['Tskew'], linestyle='--', color='g')
-            ax.set_title("CUMULANT ANALYSIS : SKEWNESS")
-            ax.set_xlabel("IC index"); ax.set_ylabel("skew"); ax.grid(True)
-        if 'kurt' in IC['cumulant']:
+    def draw(fig):
+        axs = fig.subplots(nrow, ncol, squeeze=False).flatten()
+        n = 0
+
+        # Cumulant analysis plots
+        if 'cumulant' in IC:
+            if 'skew' in IC['cumulant']:
+                ax = axs[n]; n += 1
+                ax.plot(IC['cumulant']['skew'], 'x')
+                ax.plot(reject, [IC['cumulant']['skew'][i] for i in reject], 'or')
+                ax.axhline(IC['cumulant']['Tskew'], linestyle='--', color='g')
+                ax.axhline(-IC['cumulant']['Tskew'], linestyle='--', color='g')
+                ax.set_title("CUMULANT ANALYSIS : SKEWNESS")
+                ax.set_xlabel("IC index"); ax.set_ylabel("skew"); ax.grid(True)
+            if 'kurt' in IC['cumulant']:
+                ax = axs[n]; n += 1
+                ax.plot(IC['cumulant']['kurt'], 'x')
+                ax.plot(reject, [IC['cumulant']['kurt'][i] for i in reject], 'or')
+                ax.axhline(IC['cumulant']['Tkurt'], linestyle='--', color='g')
+                ax.set_title("CUMULANT ANALYSIS : KURTOSIS")
+                ax.set_xlabel("IC index"); ax.set_ylabel("kurt"); ax.grid(True)
+
+        # Correlation analysis plots
+        for k, name in enumerate(corrnames):
             ax = axs[n]; n += 1
-            ax.plot(IC['cumulant']['kurt'], 'x')
-            ax.plot(reject, [IC['cumulant']['kurt'][i] for i in reject], 'or')
-            ax.axhline(IC['cumulant']['Tkurt'], linestyle='--', color='g')
-            ax.set_title("CUMULANT ANALYSIS : KURTOSIS")
-            ax.set_xlabel("IC index"); ax.set_ylabel("kurt"); ax.grid(True)
+            ax.plot(IC['corr'][name], 'x')
+            ax.plot(reject, [IC['corr'][name][i] for i in reject], 'or')
+            ax.axhline(IC['corr']['Tcorr'], linestyle='--', color='g')
+            ax.axhline(-IC['corr']['Tcorr'], linestyle='--', color='g')
+            ax.set_title(f"CORR ANALYSIS : IC/{name}")
+            ax.set_xlabel("IC index"); ax.set_ylabel("corr"); ax.grid(True)
 
-    # Correlation analysis plots
-    for k, name in enumerate(corrnames):
-        ax = axs[n]; n += 1
-        ax.plot(IC['corr'][name], 'x')
-        ax.plot(reject, [IC['corr'][name][i] for i in reject], 'or')
-        ax.axhline(IC['corr']['Tcorr'], linestyle='--', color='g')
-        ax.axhline(-IC['corr']['Tcorr'], linestyle='--', color='g')
-        ax.set_title(f"CORR ANALYSIS : IC/{name}")
-        ax.set_xlabel("IC index"); ax.set_ylabel("corr"); ax.grid(True)
+        # Spectral analysis plots
+        for k in range(Nspectral):
+            ax = axs[n]; n += 1
+            ax.plot(IC['spectral']['gof'][:, k], 'x')
+            ax.plot(reject, [IC['spectral']['gof'][i, k] for i in reject], 'or')
+            ax.axhline(IC['spectral']['Tgof'][k], linestyle='--', color='g')
+            label = IC['spectral']['fit'][2*k]
+            rng = IC['spectral']['fit'][2*k + 1]
+            ax.set_title(f"SPECTRAL ANALYSIS : {label} on [{rng[0]},{rng[-1]}]")
+            ax.set_xlabel("IC index"); ax.set_ylabel("gof"); ax.grid(True)
 
-    # Spectral analysis plots
-    for k in range(Nspectral):
-        ax = axs[n]; n += 1
-        ax.plot(IC['spectral']['gof'][:, k], 'x')
-        ax.plot(reject, [IC['spectral']['gof'][i, k] for i in reject], 'or')
-        ax.axhline(IC['spectral']['Tgof'][k], linestyle='--', color='g')
-        label = IC['spectral']['fit'][2*k - 1]
-        rng = IC['spectral']['fit'][2*k]
-        ax.set_title(f"SPECTRAL ANALYSIS : {label} on [{rng[0]},{rng[1]}]")
-        ax.set_xlabel("IC index"); ax.set_ylabel("gof"); ax.grid(True)
+        fig.tight_layout()
 
-    plt.tight_layout()
-    return keep, reject, fig
+    return keep, reject, msfun_ica_render(draw, "msfun_ica_meg_plot", (4 * ncol, 3 * nrow))
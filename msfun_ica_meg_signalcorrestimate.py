@@ -0,0 +1,122 @@
+import numpy as np
+from msfun_filt_cosine import msfun_filt_cosine_blocks
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_epoch import msfun_sig_epoch_concat
+from msfun_sig_crosscorr import msfun_sig_crosscorr_init, msfun_sig_crosscorr_update, msfun_sig_crosscorr_finalize, msfun_sig_crosscorr_lagged
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_meg_signalcorrestimate(IC, extdata, cfg):
+    '''
+    Correlation of the IC time courses with external signals (EOG, ECG, ...).
+
+    ICs and external signals are optionally band-pass filtered with the cosine
+    filter cfg['filt'] (response cached across calls, real-FFT overlap-save in
+    bounded-memory blocks), and only the [S x numofic] cross-correlation block is
+    accumulated from the filtered blocks, so no full-length filtered copy of the
+    ICs is ever allocated.
+
+    With cfg['maxlag'] > 0, the maximal absolute correlation over lags in
+    [-maxlag, maxlag] is kept instead of the zero-lag correlation, computed by
+    batched FFT cross-correlation over blocks of ICs (see
+    msfun_sig_crosscorr_lagged), together with the corresponding lag.
+
+    Parameters:
+    - IC: dict with 'S' [numofic x T] or [K x numofic x T]
+    - extdata: external signals [S x T] or [K x S x T]
+    - cfg: dict with optional keys:
+        - 'extname': names of the external signals (default 'ext1', 'ext2', ...)
+        - 'filter': bool, whether to filter before correlating (default True)
+        - 'filt': msfun_filt_preparecosine configuration (default 1-25 Hz band-pass at 1000 Hz)
+        - 'Tcorr': absolute correlation threshold (default 0.15)
+        - 'nfft': overlap-save FFT length (default: sized from the filter, see msfun_filt_cosine_nfft)
+        - 'chunk': block length when not filtering (default 65536)
+        - 'workers': number of scipy.fft workers (default 1)
+        - 'maxlag': maximal lag in samples for the lagged mode (default 0, zero-lag only)
+        - 'icblock': number of ICs per FFT batch in the lagged mode (default: automatic)
+
+    Returns:
+    - IC: with 'corr' holding one correlation vector [numofic] per external
+      signal name, 'list' of ICs above threshold and 'Tcorr'; in the lagged mode
+      also the best lags in samples [numofic] under name + '_lag' and 'maxlag'
+    '''
+    if extdata is None or len(extdata) == 0:
+        msfun_ica_print("msfun_ica_meg_signalcorrestimate - WARNING : No external data supplied... Skipping the correlation analysis.")
+        return IC
+
+    if "S" not in IC or not isinstance(IC["S"], np.ndarray):
+        raise ValueError("IC structure missing or inconsistent")
+
+    epoching = IC["S"].ndim == 3
+    if epoching:
+        K, numofic, T = IC["S"].shape
+    else:
+        numofic, T = IC["S"].shape
+
+    extdata = np.array(extdata)
+    if extdata.shape[-1] != T:
+        raise ValueError("External data not consistent with IC shape")
+
+    if epoching:
+        if extdata.shape[0] != K:
+            raise ValueError("Epoch count mismatch between IC and extdata")
+        S = extdata.shape[1]
+    else:
+        S = extdata.shape[0]
+
+    cfg = cfg or {}
+    cfg.setdefault("extname", [f"ext{k+1}" for k in range(S)])
+    cfg.setdefault("filter", True)
+    cfg.setdefault("Tcorr", 0.15)
+    cfg.setdefault("maxlag", 0)
+
+    if cfg["filter"]:
+        cfg.setdefault("filt", {
+            "sfreq": 1000,
+            "win": "boxcar",
+            "par": ["high", "low"],
+            "freq": [1, 25],
+            "width": [0.5, 5]
+        })
+
+    if epoching:
+        msfun_ica_print("msfun_ica_meg_signalcorrestimate - Baseline correcting and concatenating epochs...")
+        icasig = msfun_sig_epoch_concat(IC["S"], baseline=True)
+        extdata = msfun_sig_epoch_concat(extdata, baseline=True)
+    else:
+        icasig = IC["S"]
+
+    if cfg["filter"]:
+        msfun_ica_print("msfun_ica_meg_signalcorrestimate - Filtering ICs and external data...")
+        blocks = lambda x: (y for _, y in msfun_filt_cosine_blocks(x, cfg["filt"], cfg.get("nfft", None), cfg.get("workers", None)))
+    else:
+        blocks = lambda x: msfun_sig_chunks(x, cfg.get("chunk", None))
+
+    if cfg["maxlag"] > 0:
+        msfun_ica_print(f"msfun_ica_meg_signalcorrestimate - Performing lagged correlation analysis, lags up to {cfg['maxlag']} samples...")
+        prepare = (lambda x: np.concatenate(list(blocks(x)), axis=1)) if cfg["filter"] else None
+        rho, lag = msfun_sig_crosscorr_lagged(prepare(extdata) if prepare else extdata, icasig, cfg["maxlag"],
+                                              {"block": cfg.get("icblock", None), "prepare": prepare, "workers": cfg.get("workers", None)})
+    else:
+        msfun_ica_print("msfun_ica_meg_signalcorrestimate - Performing correlation analysis...")
+        acc = msfun_sig_crosscorr_init(S, numofic)
+        for y, x in zip(blocks(extdata), blocks(icasig)):
+            msfun_sig_crosscorr_update(acc, y, x)
+        rho = msfun_sig_crosscorr_finalize(acc)
+
+    if "corr" not in IC:
+        IC["corr"] = {}
+    IC["corr"]["list"] = []
+
+    for k in range(S):
+        IC["corr"][cfg["extname"][k]] = rho[k]
+        if cfg["maxlag"] > 0:
+            IC["corr"][cfg["extname"][k] + "_lag"] = lag[k]
+        IC["corr"]["list"].extend(np.where(np.abs(rho[k]) >= cfg["Tcorr"])[0])
+
+    IC["corr"]["list"] = sorted(set(IC["corr"]["list"]))
+    IC["corr"]["Tcorr"] = cfg["Tcorr"]
+    if cfg["maxlag"] > 0:
+        IC["corr"]["maxlag"] = cfg["maxlag"]
+
+    msfun_ica_print("msfun_ica_meg_signalcorrestimate - Done.")
+    return IC
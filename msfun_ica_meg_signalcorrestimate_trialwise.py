@@ -1,41 +1,90 @@
 import numpy as np
-from scipy.fft import fft, ifft
-from scipy.stats import pearsonr
-from msfun_filt_preparecosine import msfun_filt_preparecosine
+from scipy.fft import rfft, irfft
+from msfun_filt_cosine import msfun_filt_cosine_response
+from msfun_sig_epoch import msfun_sig_epoch_chunks
+from msfun_sig_crosscorr import msfun_sig_crosscorr_init, msfun_sig_crosscorr_update, msfun_sig_crosscorr_finalize
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_meg_signalcorrestimate_trialwise_corr(Y, X):
+    '''
+    Per-trial Pearson correlations between the rows of Y [k x S x T] and of
+    X [k x n x T], as one batched product. Returns rho [k x S x n].
+    '''
+    Y = Y - np.mean(Y, axis=2, keepdims=True)
+    X = X - np.mean(X, axis=2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Y /= np.linalg.norm(Y, axis=2, keepdims=True)
+        X /= np.linalg.norm(X, axis=2, keepdims=True)
+    return np.clip(np.matmul(Y, X.transpose(0, 2, 1)), -1, 1)
 
 def msfun_ica_meg_signalcorrestimate_trialwise(IC, extdata, cfg):
+    '''
+    Trial-by-trial correlation of the IC time courses with external signals.
+
+    Signal and power (squared signal) correlations are computed for every trial
+    separately, as batched products over chunks of trials of the [K x numofic x T]
+    and [K x S x T] arrays (baseline corrected and, optionally, filtered per trial
+    with one batched real FFT), without concatenating the epochs. The per-trial
+    correlations are then summarized per IC and an IC is flagged when the
+    fraction of trials over threshold reaches cfg['Tfrac'], so that components
+    correlated in part of the trials only (e.g. intermittent blinks) can be
+    detected by lowering 'Tfrac'. IC['S'] is left untouched.
+
+    Parameters:
+    - IC: dict with 'S' [K x numofic x T] (or [numofic x T], treated as one trial)
+    - extdata: external signals [K x S x T] (or [S x T])
+    - cfg: dict with optional keys:
+        - 'extname': names of the external signals (default 'ext1', 'ext2', ...)
+        - 'filter': bool, whether to filter each trial (default True)
+        - 'filt': msfun_filt_preparecosine configuration (default 1-25 Hz band-pass at 1000 Hz)
+        - 'Tsigcorr': per-trial absolute signal correlation threshold (default 0.1)
+        - 'Tpowcorr': per-trial power correlation threshold (default 0.2)
+        - 'Tfrac': fraction of trials over threshold to flag an IC (default 0.5,
+          i.e. median absolute correlation over threshold)
+        - 'percentiles': percentiles of the per-trial correlations (default [10, 90])
+        - 'chunk': number of trials per batch (default: about 16M samples per batch)
+        - 'workers': number of scipy.fft workers (default 1)
+
+    Returns:
+    - IC: with 'corr' holding, for each external signal name,
+        - 'sig_IC_<name>', 'pow_IC_<name>': correlation over the whole (concatenated)
+          signal [numofic], accumulated over the chunks of trials
+        - 'sigtrial_IC_<name>', 'powtrial_IC_<name>': median per-trial correlation [numofic]
+      and
+        - 'trialwise': dict with, for each of 'sig' and 'pow', the per-trial
+          correlations 'rho' [K x S x numofic], their 'median' and 'percentiles'
+          [len(percentiles) x S x numofic], and the fraction 'frac' [S x numofic]
+          of trials over threshold
+        - 'list': flagged ICs, and 'Tsigcorr', 'Tpowcorr', 'Tfrac'
+    '''
     if extdata is None or len(extdata) == 0:
-        print('msfun_ica_meg_signalcorrestimate_trialwise - WARNING : No external data supplied... Skipping the correlation analysis.')
+        msfun_ica_print('msfun_ica_meg_signalcorrestimate_trialwise - WARNING : No external data supplied... Skipping the correlation analysis.')
         return IC
 
     if 'S' not in IC or not isinstance(IC['S'], np.ndarray) or IC['S'].ndim not in [2, 3]:
         raise ValueError('msfun_ica_meg_signalcorrestimate_trialwise - ERROR : IC structure missing elements or inconsistent.')
 
-    if IC['S'].ndim == 2:
-        epoching = False
-        numofic, T = IC['S'].shape
-    else:
-        epoching = True
-        K, numofic, T = IC['S'].shape
-
     extdata = np.asarray(extdata)
     if extdata.ndim != IC['S'].ndim:
         raise ValueError('msfun_ica_meg_signalcorrestimate_trialwise - ERROR : External data array inconsistent.')
 
-    if epoching:
-        if extdata.shape != (K, extdata.shape[1], T):
-            raise ValueError('msfun_ica_meg_signalcorrestimate_trialwise - ERROR : External data not consistent with IC.')
-        S = extdata.shape[1]
+    if IC['S'].ndim == 2:
+        icasig = IC['S'][np.newaxis]
+        extdata = extdata[np.newaxis]
     else:
-        if extdata.shape[1] != T:
-            raise ValueError('msfun_ica_meg_signalcorrestimate_trialwise - ERROR : External data not consistent with IC.')
-        S = extdata.shape[0]
+        icasig = IC['S']
+    K, numofic, T = icasig.shape
+    if extdata.shape != (K, extdata.shape[1], T):
+        raise ValueError('msfun_ica_meg_signalcorrestimate_trialwise - ERROR : External data not consistent with IC.')
+    S = extdata.shape[1]
 
     cfg = cfg or {}
     cfg.setdefault('extname', [f'ext{k+1}' for k in range(S)])
     cfg.setdefault('filter', True)
     cfg.setdefault('Tsigcorr', 0.1)
     cfg.setdefault('Tpowcorr', 0.2)
+    cfg.setdefault('Tfrac', 0.5)
+    cfg.setdefault('percentiles', [10, 90])
 
     if cfg['filter']:
         filt = cfg.get('filt', {})
@@ -45,42 +94,59 @@ def msfun_ica_meg_signalcorrestimate_trialwise(IC, extdata, cfg):
         filt.setdefault('freq', [1, 25])
         filt.setdefault('width', [0.5, 5])
         cfg['filt'] = filt
+        # single precision filtering for float32 ICs
+        dtype = np.result_type(icasig.dtype, np.float32)
+        win, F = msfun_filt_cosine_response(filt, T)
+        win = win.astype(dtype, copy=False)
+        F = F[:T // 2 + 1].astype(np.result_type(dtype, np.complex64))
 
-    if epoching:
-        print('msfun_ica_meg_signalcorrestimate_trialwise - Baseline correcting and concatenating epochs...')
-        X = np.zeros((numofic, K * T))
-        Y = np.zeros((S, K * T))
-        for k in range(K):
-            avX = np.mean(IC['S'][k, :, :], axis=1, keepdims=True)
-            avY = np.mean(extdata[k, :, :], axis=1, keepdims=True)
-            X[:, k*T:(k+1)*T] = IC['S'][k, :, :] - avX
-            Y[:, k*T:(k+1)*T] = extdata[k, :, :] - avY
-        IC['S'] = X
-        extdata = Y
-        T *= K
+    chunk = cfg.get('chunk', None) or max(1, (1 << 24) // ((numofic + S) * T))
+    workers = cfg.get('workers', None)
 
+    msfun_ica_print(f'msfun_ica_meg_signalcorrestimate_trialwise - Performing correlation analysis over {K} trials...')
     if cfg['filter']:
-        print('msfun_ica_meg_signalcorrestimate_trialwise - Filtering ICs and external data...')
-        win, F = msfun_filt_preparecosine(cfg['filt'], T, cfg['filt']['sfreq'])
-        IC['S'] = np.real(ifft(fft(IC['S'] * win, axis=1) * F, axis=1))
-        extdata = np.real(ifft(fft(extdata * win, axis=1) * F, axis=1))
-
-    print('msfun_ica_meg_signalcorrestimate_trialwise - Performing correlation analysis...')
-    sigrho = np.corrcoef(extdata, IC['S'])[:S, S:]
-    powrho = np.corrcoef(extdata**2, IC['S']**2)[:S, S:]
+        msfun_ica_print('msfun_ica_meg_signalcorrestimate_trialwise -       baseline correcting and filtering each trial...')
+    sigrho = np.zeros((K, S, numofic))
+    powrho = np.zeros((K, S, numofic))
+    sigacc = msfun_sig_crosscorr_init(S, numofic)
+    powacc = msfun_sig_crosscorr_init(S, numofic)
+    for (k, X), (_, Y) in zip(msfun_sig_epoch_chunks(icasig, chunk, baseline=True), msfun_sig_epoch_chunks(extdata, chunk, baseline=True)):
+        if cfg['filter']:
+            X = irfft(rfft(X * win, axis=2, workers=workers) * F, n=T, axis=2, workers=workers)
+            Y = irfft(rfft(Y * win, axis=2, workers=workers) * F, n=T, axis=2, workers=workers)
+        sigrho[k:k + chunk] = msfun_ica_meg_signalcorrestimate_trialwise_corr(Y, X)
+        powrho[k:k + chunk] = msfun_ica_meg_signalcorrestimate_trialwise_corr(Y ** 2, X ** 2)
+        # whole-signal correlations of the concatenated trials
+        X = X.transpose(1, 0, 2).reshape(numofic, -1)
+        Y = Y.transpose(1, 0, 2).reshape(S, -1)
+        msfun_sig_crosscorr_update(sigacc, Y, X)
+        msfun_sig_crosscorr_update(powacc, Y ** 2, X ** 2)
+        del X, Y
 
     if 'corr' not in IC:
         IC['corr'] = {}
-    IC['corr']['list'] = []
-
-    for k in range(S):
-        extname = cfg['extname'][k]
-        IC['corr'][f'sig_IC_{extname}'] = sigrho[k]
-        IC['corr'][f'pow_IC_{extname}'] = powrho[k]
-        IC['corr']['list'].extend(np.where(np.abs(sigrho[k]) >= cfg['Tsigcorr'])[0])
-        IC['corr']['list'].extend(np.where(np.abs(powrho[k]) >= cfg['Tpowcorr'])[0])
+    IC['corr']['trialwise'] = {}
+    flag = np.zeros(numofic, dtype=bool)
+    for kind, rho, acc, thr in [('sig', sigrho, sigacc, cfg['Tsigcorr']), ('pow', powrho, powacc, cfg['Tpowcorr'])]:
+        whole = msfun_sig_crosscorr_finalize(acc)
+        frac = np.mean(np.abs(rho) >= thr, axis=0)
+        summary = {
+            'rho': rho,
+            'median': np.median(rho, axis=0),
+            'percentiles': np.percentile(rho, cfg['percentiles'], axis=0),
+            'frac': frac
+        }
+        IC['corr']['trialwise'][kind] = summary
+        for s in range(S):
+            IC['corr'][f"{kind}_IC_{cfg['extname'][s]}"] = whole[s]
+            IC['corr'][f"{kind}trial_IC_{cfg['extname'][s]}"] = summary['median'][s]
+        flag |= np.any(frac >= cfg['Tfrac'], axis=0)
 
-    IC['corr']['list'] = sorted(set(IC['corr']['list']))
+    IC['corr']['list'] = list(np.where(flag)[0])
+    IC['corr']['Tsigcorr'] = cfg['Tsigcorr']
+    IC['corr']['Tpowcorr'] = cfg['Tpowcorr']
+    IC['corr']['Tfrac'] = cfg['Tfrac']
 
-    print('msfun_ica_meg_signalcorrestimate_trialwise - Done.')
+    msfun_ica_print(f"msfun_ica_meg_signalcorrestimate_trialwise -       {len(IC['corr']['list'])} ICs flagged...")
+    msfun_ica_print('msfun_ica_meg_signalcorrestimate_trialwise - Done.')
     return IC
@@ -1,6 +1,33 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft
+from scipy.signal import get_window
+from msfun_ica_log import msfun_ica_print
 
 def msfun_ica_meg_spectraldensity(IC, cfg):
+    '''
+    Welch power spectrum of the IC time courses.
+
+    Overlapping windows are taken as a strided view of IC['S'] (no copy) and
+    transformed in chunks of windows with one batched real FFT each; power is
+    accumulated directly into a [numofic x F] float32 buffer, so memory stays
+    bounded for long recordings. For epoched sources the spectrum is averaged
+    over windows and epochs.
+
+    Parameters:
+    - IC: dict with 'S' of shape [numofic x T] or [K x numofic x T]
+    - cfg: dict with optional keys:
+        - 'sfreq': sampling frequency in Hz (default 1000)
+        - 'epoch': window length in samples (default T)
+        - 'overlap': number of windows overlapping each sample (default 2)
+        - 'taper': None (boxcar, default), a scipy.signal.get_window name such as
+          'hann', or an array of length 'epoch'
+        - 'chunk': number of windows per FFT batch (default: about 16M samples per batch)
+        - 'workers': number of scipy.fft workers (default 1)
+
+    Returns:
+    - IC: with 'powspctrm' [numofic x epoch//2] and 'freq' [epoch//2]
+    '''
     if not isinstance(IC, dict) or 'S' not in IC or not isinstance(IC['S'], np.ndarray):
         raise ValueError("msfun_ica_meg_spectraldensity - ERROR: IC structure missing elements or inconsistent... Try again.")
 
@@ -17,6 +44,9 @@ def msfun_ica_meg_spectraldensity(IC, cfg):
     sfreq = cfg.get("sfreq", 1000)
     epoch_len = cfg.get("epoch", T)
     overlap = cfg.get("overlap", 2)
+    taper = cfg.get("taper", None)
+    chunk = cfg.get("chunk", None)
+    workers = cfg.get("workers", None)
 
     if not isinstance(sfreq, (int, float)) or sfreq <= 0:
         raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Sampling frequency must be a positive number.")
@@ -24,40 +54,50 @@ def msfun_ica_meg_spectraldensity(IC, cfg):
         raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Epoch length must be a positive integer.")
     if not isinstance(overlap, int) or overlap <= 0:
         raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Overlap number must be a positive integer.")
+    if chunk is not None and (not isinstance(chunk, int) or chunk <= 0):
+        raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Window chunk size must be a positive integer.")
+
+    msfun_ica_print("msfun_ica_meg_spectraldensity - Computing Fourier power spectrum of ICs...")
+    msfun_ica_print(f"msfun_ica_meg_spectraldensity -       epoch length {epoch_len/sfreq} sec...")
+    msfun_ica_print(f"msfun_ica_meg_spectraldensity -       epochs overlap {overlap}...")
 
-    print("msfun_ica_meg_spectraldensity - Computing Fourier power spectrum of ICs...")
-    print(f"msfun_ica_meg_spectraldensity -       epoch length {epoch_len/sfreq} sec...")
-    print(f"msfun_ica_meg_spectraldensity -       epochs overlap {overlap}...")
-
-    if not epoching:
-        powspctrm = np.zeros((numofic, epoch_len))
-        ti = 0
-        tf = ti + epoch_len
-        nav = 0
-        while tf <= T:
-            epoch = S[:, ti:tf]
-            powspctrm += np.abs(np.fft.fft(epoch, axis=1))**2
-            nav += 1
-            ti += round(epoch_len / overlap)
-            tf = ti + epoch_len
-        powspctrm /= nav
+    step = max(round(epoch_len / overlap), 1)
+    if epoch_len > T:
+        raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Epoch length exceeds IC time course length.")
+    nwin = (T - epoch_len) // step + 1
+    F = epoch_len // 2
+
+    if taper is None:
+        win = None
+        scale = 1.0
     else:
-        powspctrm = np.zeros((K, numofic, epoch_len))
-        ti = 0
-        tf = ti + epoch_len
-        nav = 0
-        while tf <= T:
-            epoch = S[:, :, ti:tf]
-            powspctrm += np.abs(np.fft.fft(epoch, axis=2))**2
-            nav += 1
-            ti += round(epoch_len / overlap)
-            tf = ti + epoch_len
-        powspctrm = np.mean(powspctrm / nav, axis=0)
+        win = get_window(taper, epoch_len) if isinstance(taper, str) else np.asarray(taper, dtype=np.float64)
+        if win.shape != (epoch_len,):
+            raise ValueError("msfun_ica_meg_spectraldensity - ERROR: Taper length must equal the epoch length.")
+        scale = epoch_len / np.sum(win ** 2)
+        win = win.astype(S.dtype if S.dtype == np.float32 else np.float64)
+        msfun_ica_print(f"msfun_ica_meg_spectraldensity -       {taper if isinstance(taper, str) else 'user'} taper...")
+
+    # All overlapping windows as a strided view [.. x numofic x nwin x epoch_len]
+    windows = sliding_window_view(S, epoch_len, axis=-1)[..., ::step, :]
+    if chunk is None:
+        chunk = max(1, (1 << 24) // (numofic * epoch_len))
+
+    powspctrm = np.zeros((numofic, F), dtype=np.float32)
+    for X in (windows[k] for k in range(K)) if epoching else [windows]:
+        for wi in range(0, nwin, chunk):
+            batch = X[:, wi:wi + chunk, :]
+            if win is not None:
+                batch = batch * win
+            spec = rfft(batch, axis=-1, workers=workers)[..., :F]
+            powspctrm += np.sum(spec.real ** 2 + spec.imag ** 2, axis=1)
+    nav = nwin * (K if epoching else 1)
+    powspctrm *= scale / (nav * epoch_len)
 
     freq = sfreq * np.arange(epoch_len // 2) / epoch_len
-    IC['powspctrm'] = powspctrm[:, :epoch_len // 2] / epoch_len
+    IC['powspctrm'] = powspctrm
     IC['freq'] = freq
 
-    print(f"msfun_ica_meg_spectraldensity -       frequency domain [{freq[0]} {freq[-1]}] Hz...")
-    print("msfun_ica_meg_spectraldensity - Done.")
+    msfun_ica_print(f"msfun_ica_meg_spectraldensity -       frequency domain [{freq[0]} {freq[-1]}] Hz...")
+    msfun_ica_print("msfun_ica_meg_spectraldensity - Done.")
     return IC
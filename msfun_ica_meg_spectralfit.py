@@ -1,73 +1,134 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 from typing import Dict
+from msfun_ica_render import msfun_ica_render
 
 def msfun_ica_meg_spectralfit(IC: Dict, cfg: Dict) -> Dict:
+    '''
+    Fits linear or power-law models to the IC power spectra in frequency bands
+    and computes the goodness of fit (relative squared error) of each IC.
+
+    All ICs are fitted at once: linear fits are a single least-squares solve,
+    power-law fits start from a batched log-log solve refined by a few batched
+    Gauss-Newton steps, and gof is computed for the full [numofic x L] matrix.
+
+    Parameters:
+    - IC: dict with 'powspctrm' [numofic x F] and 'freq' [F]
+    - cfg: dict with keys:
+        - 'fit': list [kind1, [fmin1, fmax1], kind2, [fmin2, fmax2], ...] with kind
+          'linear' or 'powlaw'
+        - 'Tgof': list of L gof thresholds (default 0.03 for each band)
+        - 'niter': number of Gauss-Newton steps of power-law fits (default 30)
+        - 'visual': bool, plot the fits in non-blocking grid figures of 'perpage' ICs
+          (default True, see msfun_ica_render)
+        - 'perpage': number of ICs per figure page (default 36)
+
+    Returns:
+    - IC: with 'spectral' dict holding 'fit', 'gof' [numofic x L], 'Tgof' and 'list'
+    '''
     if 'freq' not in IC or 'powspctrm' not in IC:
         raise ValueError("IC structure missing required fields 'freq' and 'powspctrm'")
 
     numofic, F = IC['powspctrm'].shape
-    freq = IC['freq']
-    IC['spectral'] = {}
-    IC['spectral']['fit'] = cfg['fit']
+    freq = np.asarray(IC['freq'])
     L = len(cfg['fit']) // 2
     gof = np.zeros((numofic, L))
+    niter = cfg.get('niter', 30)
 
+    IC['spectral'] = {}
+    IC['spectral']['fit'] = list(cfg['fit'])
+    bands = []
     for k in range(L):
         kind = cfg['fit'][2*k].lower()
+        if kind not in ['linear', 'powlaw']:
+            raise ValueError(f"Unsupported fit type: {cfg['fit'][2*k]}")
         fmin, fmax = cfg['fit'][2*k+1]
         f1 = np.where(freq >= fmin)[0][0]
         f2 = np.where(freq <= fmax)[0][-1]
-        cfg['fit'][2*k+1] = [f1, f2]
+        bands.append((kind, f1, f2))
         IC['spectral']['fit'][2*k+1] = freq[f1:f2+1].tolist()
 
     if 'Tgof' not in cfg:
         cfg['Tgof'] = [0.03] * L
 
-    if cfg.get('visual', True):
-        plt.ion()
-        fig, axes = plt.subplots(2, L, figsize=(5*L, 8))
+    xhats = []
+    for k, (kind, f1, f2) in enumerate(bands):
+        x = np.asarray(IC['powspctrm'][:, f1:f2+1], dtype=np.float64)
+        f = freq[f1:f2+1].astype(np.float64)
+        if kind == 'linear':
+            # x = a + b f for all ICs in one least-squares solve
+            Phi = np.column_stack((np.ones_like(f), f))
+            coef = np.linalg.lstsq(Phi, x.T, rcond=None)[0]
+            xhat = (Phi @ coef).T
+        else:
+            # x = a f^b: batched log-log initialization, then damped Gauss-Newton on the squared error
+            logf = np.log(f)
+            Phi = np.column_stack((np.ones_like(f), logf))
+            coef = np.linalg.lstsq(Phi, np.log(x).T, rcond=None)[0]
+            b = coef[1]
+            g = f[np.newaxis, :] ** b[:, np.newaxis]
+            # Least-squares amplitude for the log-log exponent, closer to the linear-scale optimum
+            a = np.sum(x * g, axis=1) / np.sum(g * g, axis=1)
+            cost = np.sum((x - a[:, np.newaxis] * g) ** 2, axis=1)
+            lam = np.full(numofic, 1e-3)
+            for _ in range(niter):
+                r = x - a[:, np.newaxis] * g
+                J1 = g
+                J2 = a[:, np.newaxis] * g * logf
+                H11 = np.sum(J1 * J1, axis=1)
+                H12 = np.sum(J1 * J2, axis=1)
+                H22 = np.sum(J2 * J2, axis=1)
+                g1 = np.sum(J1 * r, axis=1)
+                g2 = np.sum(J2 * r, axis=1)
+                # Damped 2x2 normal equations, damping adapted per IC (Levenberg-Marquardt)
+                D11 = H11 * (1 + lam)
+                D22 = H22 * (1 + lam)
+                det = D11 * D22 - H12 ** 2
+                det[det <= 0] = np.inf
+                anew = a + (D22 * g1 - H12 * g2) / det
+                bnew = b + (D11 * g2 - H12 * g1) / det
+                gnew = f[np.newaxis, :] ** bnew[:, np.newaxis]
+                newcost = np.sum((x - anew[:, np.newaxis] * gnew) ** 2, axis=1)
+                better = newcost < cost
+                a = np.where(better, anew, a)
+                b = np.where(better, bnew, b)
+                g = np.where(better[:, np.newaxis], gnew, g)
+                cost = np.where(better, newcost, cost)
+                lam = np.where(better, lam / 10, lam * 10)
+            xhat = a[:, np.newaxis] * g
+        gof[:, k] = np.sum((x - xhat) ** 2, axis=1) / np.sum(x ** 2, axis=1)
+        xhats.append(xhat)
 
-    for n in range(numofic):
-        for k in range(L):
-            fidx = cfg['fit'][2*k+1]
-            x = IC['powspctrm'][n, fidx[0]:fidx[1]+1]
-            f = freq[fidx[0]:fidx[1]+1]
-            if cfg['fit'][2*k].lower() == 'linear':
-                def model(f, a, b): return a + b * f
-                popt, _ = curve_fit(model, f, x)
-                xhat = model(f, *popt)
-            elif cfg['fit'][2*k].lower() == 'powlaw':
-                def model(f, a, b): return a * f ** b
-                logf = np.log(f)
-                logx = np.log(x)
-                coef = np.polyfit(logf, logx, 1)
-                a_init = np.exp(coef[1])
-                b_init = coef[0]
-                popt, _ = curve_fit(model, f, x, p0=[a_init, b_init])
-                xhat = model(f, *popt)
-            else:
-                raise ValueError(f"Unsupported fit type: {cfg['fit'][2*k]}")
-            gof[n, k] = np.sum((x - xhat) ** 2) / np.sum(x ** 2)
+    if cfg.get('visual', True):
+        P = IC['powspctrm']
+        perpage = cfg.get('perpage', 36)
+        npage = -(-numofic // perpage)
+        ncol = int(np.ceil(np.sqrt(min(perpage, numofic))))
 
-            if cfg.get('visual', True):
-                ax1, ax2 = axes[0, k], axes[1, k]
-                ax1.clear(); ax2.clear()
-                ax1.plot(f, x, label="data")
-                ax1.plot(f, xhat, 'r', label="fit")
-                ax1.set_title(f"IC {n} - {cfg['fit'][2*k]} fit")
-                ax1.legend()
-                ax2.plot(f, (x - xhat) ** 2 / np.mean(x ** 2), 'rx')
-                ax2.axhline(cfg['Tgof'][k], linestyle='--')
-                ax2.set_title(f"error (mean = {gof[n,k]:.3f})")
-                plt.pause(0.1)
+        def drawer(ics):
+            # one axis per IC with the spectra and fits of all bands, gof in the title
+            def draw(fig):
+                nrow = -(-len(ics) // ncol)
+                axes = fig.subplots(nrow, ncol, squeeze=False).ravel()
+                for ax, n in zip(axes, ics):
+                    for k, (kind, f1, f2) in enumerate(bands):
+                        f = freq[f1:f2+1]
+                        ax.plot(f, P[n, f1:f2+1], 'b', linewidth=0.8)
+                        ax.plot(f, xhats[k][n], 'r', linewidth=0.8)
+                    listed = all(gof[n, k] < cfg['Tgof'][k] for k in range(L))
+                    ax.set_title(f"IC {n} - gof " + "/".join(f"{gof[n, k]:.3f}" for k in range(L)),
+                                 fontsize=8, color='r' if listed else 'k')
+                    ax.tick_params(labelsize=6)
+                for ax in axes[len(ics):]:
+                    ax.axis('off')
+                fig.tight_layout()
+            return draw
+        for p in range(npage):
+            ics = range(p * perpage, min((p + 1) * perpage, numofic))
+            nrow = -(-len(ics) // ncol)
+            msfun_ica_render(drawer(ics), f"spectralfit_{p + 1}of{npage}", (3 * ncol, 2.2 * nrow))
 
-    IC['spectral']['gof'] = gof.tolist()
+    IC['spectral']['gof'] = gof
     IC['spectral']['Tgof'] = cfg['Tgof']
     IC['spectral']['list'] = [i for i in range(numofic) if all(gof[i, j] < cfg['Tgof'][j] for j in range(L))]
 
-    if cfg.get('visual', True):
-        plt.ioff()
-        plt.show()
     return IC
@@ -0,0 +1,159 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+from msfun_ica_fastica import msfun_ica_fastica, msfun_ica_fastica_whiten
+from msfun_ica_meg_decomp import msfun_ica_meg_decomp_whitening
+from msfun_sig_shared import msfun_sig_shared_create, msfun_sig_shared_attach
+from msfun_sys_threadlimit import msfun_sys_threadlimit
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_note
+
+_worker = {}
+
+def msfun_ica_meg_stability_init(meta, nthreads):
+    _worker['limiter'] = msfun_sys_threadlimit(nthreads)
+    _worker['shm'], _worker['Z'] = msfun_sig_shared_attach(meta)
+
+def msfun_ica_meg_stability_run(seed, cfg):
+    run_cfg = dict(cfg, random_state=seed, whiten=False, sources=False)
+    ica = msfun_ica_fastica(_worker['Z'], run_cfg)
+    return ica['W'], ica['niter'], ica['converged']
+
+def msfun_ica_meg_stability(sig, cfg=None):
+    '''
+    ICASSO-style stability analysis of the temporal ICA of an [N x T] signal.
+
+    The data are normalized and whitened once into a shared memory block, then
+    M FastICA runs with different seeds are distributed over a process pool;
+    workers attach to the whitened data instead of receiving a pickled copy.
+    The M x numofic estimated unmixing vectors are clustered by average linkage
+    on their absolute correlation, and each cluster is summarized by its
+    centrotype (the member most similar to the others).
+
+    Parameters:
+    - sig: numpy.ndarray [N x T]
+    - cfg: dict with optional keys:
+        - 'normalize': numpy.ndarray of shape [N] for normalization factors
+        - 'fastica': dict of FastICA parameters ('fun', 'max_iter', 'tol', 'n_components', 'fun_args')
+        - 'dof', 'whitening': subspace of the whitening, as for msfun_ica_meg_decomp
+        - 'stability': dict with keys
+            - 'runs': number M of FastICA runs (default 20)
+            - 'workers': size of the process pool (default: number of cores)
+            - 'seed': seed of the first run, runs use seed, seed+1, ... (default 0)
+
+    Returns:
+    - IC: dict with keys 'S', 'A', 'W' built from the cluster centrotypes, sorted by
+      decreasing stability, and 'stability' with keys
+        - 'index': stability index Iq per component (mean intra-cluster minus mean
+          extra-cluster absolute correlation)
+        - 'size': number of estimates in each cluster
+        - 'runs', 'converged': number of runs and how many of them converged
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(sig, np.ndarray) or sig.ndim != 2:
+        raise ValueError("msfun_ica_meg_stability - ERROR: Signal matrix inconsistent... Try again.")
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_meg_stability - ERROR: Configuration not a structure... Try again.")
+
+    N, T = sig.shape
+    stab = cfg.get("stability", {})
+    if not isinstance(stab, dict):
+        stab = {}
+    M = stab.get("runs", 20)
+    workers = stab.get("workers", None) or os.cpu_count() or 1
+    seed = stab.get("seed", 0)
+    if not isinstance(M, int) or M < 2:
+        raise ValueError("msfun_ica_meg_stability - ERROR: At least two runs are needed... Try again.")
+
+    normalize = cfg.get("normalize", None)
+    if normalize is not None:
+        normalize = np.asarray(normalize)
+        if normalize.ndim != 1 or len(normalize) != N or np.any(normalize <= 0):
+            raise ValueError("msfun_ica_meg_stability - ERROR: Normalization factors inconsistent... Try again.")
+    elif isinstance(cfg.get("dof", None), dict) and cfg["dof"].get("normalize", None) is not None:
+        msfun_ica_print("msfun_ica_meg_stability - using normalization of the degrees of freedom estimate...")
+        normalize = np.asarray(cfg["dof"]["normalize"])
+    else:
+        msfun_ica_print("msfun_ica_meg_stability - using temporal standard deviation of data...")
+        normalize = np.std(sig, axis=1, dtype=np.float64)
+
+    fastica_params = cfg.get("fastica", {})
+    run_cfg = {k: fastica_params[k] for k in ["fun", "max_iter", "tol"] if k in fastica_params}
+    run_cfg["alpha"] = fastica_params.get("fun_args", {}).get("alpha", 1.0)
+    dtype = np.dtype(cfg.get("dtype", None) or (np.float32 if sig.dtype == np.float32 else np.float64))
+    run_cfg["dtype"] = dtype
+
+    msfun_ica_print("msfun_ica_meg_stability - Normalizing and whitening data...")
+    sig_norm = np.divide(sig, normalize[:, np.newaxis], dtype=dtype)
+    wh = msfun_ica_meg_decomp_whitening(sig, normalize, cfg, fastica_params.get("n_components", None))
+    if wh is None:
+        wh = msfun_ica_fastica_whiten(sig_norm, fastica_params.get("n_components", None))
+    n = wh["K"].shape[0]
+
+    shm, Z, meta = msfun_sig_shared_create((n, T), dtype)
+    try:
+        np.matmul(wh["K"].astype(dtype), sig_norm, out=Z)
+        Z -= (wh["K"] @ wh["mean"]).astype(dtype)[:, np.newaxis]
+        del sig_norm
+
+        msfun_ica_print(f"msfun_ica_meg_stability - Running {M} FASTICA decompositions on {min(workers, M)} workers...")
+        nthreads = max(1, (os.cpu_count() or 1) // min(workers, M))
+        with ProcessPoolExecutor(max_workers=min(workers, M), initializer=msfun_ica_meg_stability_init, initargs=(meta, nthreads)) as pool:
+            runs = list(pool.map(msfun_ica_meg_stability_run, range(seed, seed + M), [run_cfg] * M))
+        nconverged = sum(r[2] for r in runs)
+        msfun_ica_log_note(fastica_runs=M, fastica_converged=nconverged, fastica_niter=[int(r[1]) for r in runs])
+        msfun_ica_print(f"msfun_ica_meg_stability -       {nconverged} of {M} runs converged...")
+
+        msfun_ica_print("msfun_ica_meg_stability - Clustering estimated components...")
+        Wall = np.vstack([r[0] for r in runs])
+        R = np.abs(Wall @ Wall.T)
+        np.clip(R, 0, 1, out=R)
+        np.fill_diagonal(R, 1)
+        Z_link = linkage(squareform(1 - R, checks=False), method="average")
+        labels = fcluster(Z_link, t=n, criterion="maxclust") - 1
+        ncluster = labels.max() + 1
+
+        index = np.zeros(ncluster)
+        size = np.zeros(ncluster, dtype=int)
+        Wc = np.zeros((ncluster, n))
+        for c in range(ncluster):
+            members = np.where(labels == c)[0]
+            others = np.where(labels != c)[0]
+            Rc = R[np.ix_(members, members)]
+            size[c] = len(members)
+            intra = Rc.mean()
+            extra = R[np.ix_(members, others)].mean() if len(others) else 0
+            index[c] = intra - extra
+            Wc[c] = Wall[members[np.argmax(Rc.sum(axis=1))]]
+
+        order = np.argsort(-index)
+        index = index[order]
+        size = size[order]
+        Wc = Wc[order]
+
+        msfun_ica_print("msfun_ica_meg_stability - Computing centrotype IC time courses...")
+        S = Wc.astype(dtype) @ Z
+    finally:
+        shm.close()
+        shm.unlink()
+
+    msfun_ica_print("msfun_ica_meg_stability - Restoring original data units...")
+    W = (Wc @ wh["K"]) / normalize[np.newaxis, :]
+    A = (wh["Kinv"] @ np.linalg.pinv(Wc)) * normalize[:, np.newaxis]
+
+    IC = {
+        "S": S,
+        "A": A,
+        "W": W,
+        "stability": {
+            "index": index,
+            "size": size,
+            "runs": M,
+            "converged": nconverged
+        }
+    }
+
+    msfun_ica_print("msfun_ica_meg_stability - Done.")
+    return IC
@@ -1,4 +1,22 @@
+import os
+import copy
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from msfun_sig_shared import msfun_sig_shared_create, msfun_sig_shared_attach
+from msfun_sig_chunks import msfun_sig_chunks
+from msfun_sig_epoch import msfun_sig_epoch_concat, msfun_sig_epoch_split
+from msfun_sys_threadlimit import msfun_sys_threadlimit
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_config, msfun_ica_log_stage, msfun_ica_log_note
+from msfun_ica_render import msfun_ica_render_config, msfun_ica_render_wait
+
+_posthoc_keys = {
+    "nongaussanalysis": ["cumulant"],
+    "signalcorrestimate": ["corr"],
+    "spectraldensity": ["powspctrm", "freq"]
+}
+
+_worker = {}
 
 def msfun_ica_megdecomp(raw, data, extdata=None, cfg=None):
     '''
@@ -11,6 +29,11 @@ def msfun_ica_megdecomp(raw, data, extdata=None, cfg=None):
     - extdata: numpy array, shape matching data (optional)
     - cfg: dict with optional keys:
         - 'ica': config for ICA estimation
+        - 'dtype': computation dtype of the decomposition and of the IC time courses,
+          e.g. 'float32' to keep float32 recordings in single precision end to end
+          (default: float32 for float32 data, float64 otherwise); overridden by cfg['ica']['dtype']
+        - 'dofestimate': config for msfun_ica_meg_dofestimate; when given, ICA runs in the
+          estimated ndof-dimensional subspace
         - 'cumulant': config for cumulant analysis
         - 'corranalysis': bool
         - 'corr': config for correlation analysis
@@ -18,21 +41,50 @@ def msfun_ica_megdecomp(raw, data, extdata=None, cfg=None):
         - 'fft': config for FFT
         - 'spectral': config for spectral analysis
         - 'viewer': config for ICA viewer
+        - 'topoindex': IC topography index of previous sessions (msfun_ica_topoindex_init/load
+          output, or its directory); ICs matching stored artifact topographies are added
+          to the rejected components
+        - 'topo': config for msfun_ica_topoindex_label
+        - 'posthoc': 'sequential' (default), 'thread' or 'process' to run the cumulant,
+          correlation and spectral density analyses concurrently on a thread or process
+          pool (see msfun_ica_megdecomp_posthoc); the spectral fit follows in the main thread
+        - 'workers': cores shared by the concurrent analyses (default: all cores)
+        - 'cache': dict with 'dir' and optional 'maxsize' (bytes) to reuse the decomposition
+          and post-hoc analysis results of previous runs on the same data (see msfun_ica_cache);
+          the IC time courses are not stored but recomputed from the cached unmixing matrix
+        - 'interactive': bool, run the result plots, the ICA viewer and the spectral fit
+          figures (default True); set to False for headless batch processing
+        - 'log': msfun_ica_log_config configuration for this run: 'sink' (callable or
+          JSON lines file) receiving start/end events of every stage with wall and CPU
+          times, peak memory, array shapes and dtypes and FastICA convergence, and
+          'quiet' to silence the progress messages
+        - 'render': msfun_ica_render_config configuration for this run, e.g. {'dir': ...,
+          'background': True} to write the figures to files from a background thread;
+          pending figures are waited for before returning
 
     Returns:
-    - IC: dict containing ICA components and analysis results
+    - IC: dict containing ICA components and analysis results, with the union of the
+      rejected components in IC['artdetect']['list']
     '''
-    from msfun_sig_concat_epoch import msfun_sig_concat_epoch
-    from msfun_ica_meg_decomp import msfun_ica_meg_decomp
-    from msfun_ica_meg_nongaussanalysis import msfun_ica_meg_nongaussanalysis
-    from msfun_ica_meg_signalcorrestimate import msfun_ica_meg_signalcorrestimate
-    from msfun_ica_meg_spectraldensity import msfun_ica_meg_spectraldensity
-    from msfun_ica_meg_spectralfit import msfun_ica_meg_spectralfit
-    from msfun_ica_meg_plot import msfun_ica_meg_plot
-    from msfun_meg_ica_viewer import msfun_meg_ica_viewer
-
     if cfg is None:
         cfg = {}
+    previous = msfun_ica_log_config(cfg["log"]) if cfg.get("log", None) is not None else None
+    previous_render = msfun_ica_render_config(cfg["render"]) if cfg.get("render", None) is not None else None
+    try:
+        with msfun_ica_log_stage("megdecomp", {"data": data, "extdata": extdata}):
+            return msfun_ica_megdecomp_run(raw, data, extdata, cfg)
+    finally:
+        msfun_ica_render_wait()
+        if previous_render is not None:
+            msfun_ica_render_config(previous_render)
+        if previous is not None:
+            msfun_ica_log_config(previous)
+
+def msfun_ica_megdecomp_run(raw, data, extdata, cfg):
+    from msfun_ica_meg_decomp import msfun_ica_meg_decomp
+    from msfun_ica_meg_nongaussanalysis import msfun_ica_meg_nongaussanalysis, msfun_ica_meg_nongaussanalysis_reorder
+    from msfun_ica_cache import msfun_ica_cache_open, msfun_ica_cache_hash, msfun_ica_cache_run, msfun_ica_cache_stats
+
     if extdata is None:
         extdata = np.array([])
 
@@ -56,39 +108,329 @@ def msfun_ica_megdecomp(raw, data, extdata=None, cfg=None):
         raise ValueError("data must be 2D or 3D")
 
     if N != 306:
-        print("msfun_ica_megdecomp - WARNING: Data may not come from Neuromag Elekta MEG system")
+        msfun_ica_print("msfun_ica_megdecomp - WARNING: Data may not come from Neuromag Elekta MEG system")
 
-    print("msfun_ica_megdecomp - Preparing data for ICA...")
+    msfun_ica_print("msfun_ica_megdecomp - Preparing data for ICA...")
 
-    if epoching:
-        print("msfun_ica_megdecomp - Baseline correcting and concatenating epochs...")
-        data = data - np.mean(data, axis=2, keepdims=True)
-        data = msfun_sig_concat_epoch(data, K, "epochnum")
+    interactive = cfg.get("interactive", True)
+
+    cache = None
+    key_decomp = None
+    if cfg.get("cache", None):
+        cache = msfun_ica_cache_open(cfg["cache"])
+        msfun_ica_print("msfun_ica_megdecomp - Hashing input data for the result cache...")
+        key_decomp = msfun_ica_cache_hash("decomp", data, cfg.get("ica", {}), cfg.get("dofestimate", None), str(cfg.get("dtype", None)))
+
+    ica_cfg = cfg.get("ica", {})
+    if cfg.get("dtype", None) is not None and "dtype" not in ica_cfg:
+        ica_cfg = dict(ica_cfg, dtype=cfg["dtype"])
+
+    def concat():
+        if not epoching:
+            return data
+        msfun_ica_print("msfun_ica_megdecomp - Baseline correcting and concatenating epochs...")
+        return msfun_sig_epoch_concat(data, baseline=True)
+
+    def decomp(IC):
+        x = concat()
+        dof_cfg = ica_cfg
+        if cfg.get("dofestimate", None) is not None:
+            from msfun_ica_meg_dofestimate import msfun_ica_meg_dofestimate
+            with msfun_ica_log_stage("dofestimate", {"data": x}):
+                dof_cfg = dict(ica_cfg, dof=msfun_ica_meg_dofestimate(x, dict(cfg["dofestimate"], interactive=False, plot=False)))
+        IC = msfun_ica_meg_decomp(x, dof_cfg)
+        if cache is not None:
+            # the sources are not cached (recording-sized), only their centering
+            IC["center"] = msfun_ica_megdecomp_center(x, IC["W"], ica_cfg.get("chunk", None)).astype(IC["S"].dtype)
+        return IC
+
+    def sources(IC, value):
+        IC.update(value)
+        IC.update(msfun_ica_megdecomp_sources(concat(), IC.pop("center"), IC["W"], ica_cfg))
+        return IC
+
+    def reorder(IC, value):
+        msfun_ica_meg_nongaussanalysis_reorder(IC, value["cumulant"]["order"])
+        IC.update(value)
+        return IC
+
+    executor = cfg.get("posthoc", "sequential")
+    if executor not in ["sequential", "thread", "process"]:
+        raise ValueError("msfun_ica_megdecomp - ERROR: Post-hoc executor not recognized... Try again.")
 
-    IC = msfun_ica_meg_decomp(data, cfg.get("ica", {}))
-    IC = msfun_ica_meg_nongaussanalysis(IC, cfg.get("cumulant", {}))
+    IC = msfun_ica_cache_run(cache, "decomp", key_decomp, decomp, {}, ["A", "W", "center"], sources, inputs={"data": data})
+    IC.pop("center", None)
 
     if cfg.get("corranalysis", False):
-        print("msfun_ica_megdecomp - Preparing external signals for correlation analysis...")
+        msfun_ica_print("msfun_ica_megdecomp - Preparing external signals for correlation analysis...")
         if epoching:
-            print("msfun_ica_megdecomp -       baseline correcting and concatenating epochs...")
-            extdata_new = np.zeros((S, K * T))
-            for k in range(K):
-                av = np.mean(extdata[k, :, :], axis=1)
-                extdata_new[:, k * T:(k + 1) * T] = extdata[k, :, :] - av[:, np.newaxis]
-            extdata = extdata_new
-        IC = msfun_ica_meg_signalcorrestimate(IC, extdata, cfg.get("corr", {}))
+            msfun_ica_print("msfun_ica_megdecomp -       baseline correcting and concatenating epochs...")
+            extdata = msfun_sig_epoch_concat(extdata, baseline=True)
+
+    # post-hoc analyses: stage -> (cache key, configuration)
+    stages = {"nongaussanalysis": (msfun_ica_cache_hash(key_decomp, cfg.get("cumulant", {})) if cache else None, cfg.get("cumulant", {}))}
+    if cfg.get("corranalysis", False):
+        stages["signalcorrestimate"] = (msfun_ica_cache_hash(key_decomp, extdata, cfg.get("corr", {})) if cache else None, cfg.get("corr", {}))
+    if cfg.get("spectralanalysis", False):
+        stages["spectraldensity"] = (msfun_ica_cache_hash(key_decomp, cfg.get("fft", {})) if cache else None, cfg.get("fft", {}))
+
+    if executor == "sequential":
+        key, stage_cfg = stages["nongaussanalysis"]
+        IC = msfun_ica_cache_run(cache, "nongaussanalysis", key,
+                                 lambda IC: msfun_ica_meg_nongaussanalysis(IC, copy.deepcopy(stage_cfg)), IC, ["cumulant"], reorder)
+
+        if "signalcorrestimate" in stages:
+            from msfun_ica_meg_signalcorrestimate import msfun_ica_meg_signalcorrestimate
+            key, stage_cfg = stages["signalcorrestimate"]
+            IC = msfun_ica_cache_run(cache, "signalcorrestimate", key,
+                                     lambda IC: msfun_ica_meg_signalcorrestimate(IC, extdata, copy.deepcopy(stage_cfg)), IC, ["corr"])
+    else:
+        IC = msfun_ica_megdecomp_posthoc(IC, extdata, stages, cache, {"executor": executor, "workers": cfg.get("workers", None),
+                                                                      "epochs": K if epoching else None})
 
     if epoching:
-        print("msfun_ica_megdecomp - Restoring epochs in IC time courses...")
-        IC["S"] = msfun_sig_concat_epoch(IC["S"], K, "epochlength")
+        msfun_ica_print("msfun_ica_megdecomp - Restoring epochs in IC time courses...")
+        IC["S"] = msfun_sig_epoch_split(IC["S"], K)
 
     if cfg.get("spectralanalysis", False):
-        IC = msfun_ica_meg_spectraldensity(IC, cfg.get("fft", {}))
-        IC = msfun_ica_meg_spectralfit(IC, cfg.get("spectral", {}))
+        from msfun_ica_meg_spectralfit import msfun_ica_meg_spectralfit
+        key_fft, fft_cfg = stages["spectraldensity"]
+        if executor == "sequential":
+            from msfun_ica_meg_spectraldensity import msfun_ica_meg_spectraldensity
+            IC = msfun_ica_cache_run(cache, "spectraldensity", key_fft,
+                                     lambda IC: msfun_ica_meg_spectraldensity(IC, copy.deepcopy(fft_cfg)), IC, ["powspctrm", "freq"])
+        spectral_cfg = cfg.get("spectral", {})
+        if not interactive:
+            spectral_cfg = dict(spectral_cfg, visual=False)
+        key = msfun_ica_cache_hash(key_fft, {k: v for k, v in spectral_cfg.items() if k != "visual"}) if cache else None
+        IC = msfun_ica_cache_run(cache, "spectralfit", key,
+                                 lambda IC: msfun_ica_meg_spectralfit(IC, copy.deepcopy(spectral_cfg)), IC, ["spectral"])
+
+    if interactive:
+        from msfun_ica_meg_plot import msfun_ica_meg_plot
+        from msfun_meg_ica_viewer import msfun_meg_ica_viewer
+        with msfun_ica_log_stage("plot"):
+            keep, reject, _ = msfun_ica_meg_plot(IC)
+        with msfun_ica_log_stage("viewer"):
+            cfg.setdefault("viewer", {})["list"] = reject
+            msfun_meg_ica_viewer(IC, cfg["viewer"], raw)
+    else:
+        msfun_ica_print("msfun_ica_megdecomp - Collecting rejected ICs (non-interactive)...")
+        reject = []
+        for key in ["cumulant", "corr", "spectral"]:
+            if key in IC:
+                reject.extend(int(i) for i in IC[key].get("list", []))
+        reject = sorted(set(reject))
+
+    IC.setdefault("artdetect", {})["list"] = reject
+
+    if cfg.get("topoindex", None) is not None:
+        from msfun_ica_topoindex import msfun_ica_topoindex_load, msfun_ica_topoindex_label
+        index = cfg["topoindex"]
+        if isinstance(index, str):
+            index = msfun_ica_topoindex_load(index, {"mmap": True})
+        with msfun_ica_log_stage("topoindex", {"A": IC["A"]}):
+            IC = msfun_ica_topoindex_label(IC, index, copy.deepcopy(cfg.get("topo", {})))
+
+    if cache is not None:
+        stats = msfun_ica_cache_stats(cache)
+        msfun_ica_print(f"msfun_ica_megdecomp - Result cache: {sum(stats['hits'].values())} hits, {sum(stats['misses'].values())} misses, "
+              f"{stats['entries']} entries, {stats['size'] / 1024 ** 2:.1f} MB...")
+
+    return IC
+
+def msfun_ica_megdecomp_center(x, W, chunk=None):
+    '''
+    Offsets W @ mean(x) [numofic] of the sources of the [N x T] signal x,
+    with the channel means accumulated in float64 one chunk at a time.
+    '''
+    total = np.zeros(x.shape[0])
+    for X in msfun_sig_chunks(x, chunk):
+        total += np.sum(X, axis=1, dtype=np.float64)
+    return W @ (total / x.shape[1])
+
+def msfun_ica_megdecomp_sources(x, center, W, cfg):
+    '''
+    Recomputes the IC time courses S = W @ x - center of a cached decomposition,
+    in the dtype of center. Memory-mapped or chunked ('chunk' in cfg) signals are
+    written to a memory-mapped .npy file as by msfun_ica_meg_decomp_outofcore,
+    other signals in memory.
+
+    Returns:
+    - dict with 'S' (and 'Sfile' for memory-mapped sources)
+    '''
+    msfun_ica_print("msfun_ica_megdecomp - Recomputing IC time courses from the cached unmixing matrix...")
+    if isinstance(x, np.memmap) or "chunk" in cfg:
+        from msfun_ica_meg_decomp_outofcore import msfun_ica_meg_decomp_outofcore_sources
+        S, Sfile = msfun_ica_meg_decomp_outofcore_sources(x, W, center, x.shape[1], center.dtype,
+                                                          cfg.get("chunk", 65536), cfg.get("Sfile", None))
+        return {"S": S, "Sfile": Sfile}
+    S = np.empty((W.shape[0], x.shape[1]), dtype=center.dtype)
+    np.subtract(W.astype(center.dtype) @ x, center[:, np.newaxis], out=S, casting="same_kind")
+    return {"S": S}
+
+def msfun_ica_megdecomp_posthoc_init(src, nthreads):
+    _worker['limiter'] = msfun_sys_threadlimit(nthreads)
+    if 'file' in src:
+        _worker['S'] = np.load(src['file'], mmap_mode='r')
+    else:
+        _worker['shm'], _worker['S'] = msfun_sig_shared_attach(src['shared'])
+
+def msfun_ica_megdecomp_posthoc_run(stage, S, extdata, cfg, epochs):
+    '''
+    Runs one post-hoc analysis on the read-only sources S [numofic x T] (the
+    worker's shared sources when S is None), without sorting the ICs.
+
+    Returns:
+    - value: the IC entries written by the analysis
+    - wall: wall time in seconds
+    '''
+    t0 = time.perf_counter()
+    if S is None:
+        S = _worker['S']
+    if stage == "nongaussanalysis":
+        from msfun_ica_meg_nongaussanalysis import msfun_ica_meg_nongaussanalysis
+        IC = msfun_ica_meg_nongaussanalysis({"S": S}, dict(cfg, reorder=False))
+    elif stage == "signalcorrestimate":
+        from msfun_ica_meg_signalcorrestimate import msfun_ica_meg_signalcorrestimate
+        IC = msfun_ica_meg_signalcorrestimate({"S": S}, extdata, cfg)
+    else:
+        from msfun_ica_meg_spectraldensity import msfun_ica_meg_spectraldensity
+        if epochs:
+            S = msfun_sig_epoch_split(S, epochs)
+        IC = msfun_ica_meg_spectraldensity({"S": S}, cfg)
+    return {k: IC[k] for k in _posthoc_keys[stage] if k in IC}, time.perf_counter() - t0
+
+def msfun_ica_megdecomp_permute(value, order, axis):
+    '''
+    Expresses a post-hoc result computed on unsorted ICs in the sorted order:
+    arrays with an IC axis of length len(order) are permuted along axis and
+    the IC index lists ('list') are renumbered. Nested dicts are followed.
+    '''
+    inv = np.argsort(order)
+    out = {}
+    for k, v in value.items():
+        if isinstance(v, dict):
+            out[k] = msfun_ica_megdecomp_permute(v, order, axis)
+        elif k == "list":
+            out[k] = sorted(int(i) for i in inv[np.asarray(v, dtype=int)])
+        elif isinstance(v, np.ndarray) and v.ndim > 0 and v.shape[axis] == len(order):
+            out[k] = np.take(v, order, axis=axis)
+        else:
+            out[k] = v
+    return out
+
+def msfun_ica_megdecomp_posthoc(IC, extdata, stages, cache, cfg):
+    '''
+    Runs the cumulant, correlation and spectral density analyses of
+    msfun_ica_megdecomp concurrently, so that the post-hoc phase takes about as
+    long as the slowest analysis.
+
+    All analyses only read IC['S']: thread workers share the array itself (a
+    read-only view), process workers memory-map the sources file of an
+    out-of-core decomposition or attach to one shared memory copy of in-memory
+    sources. The cores are split between the analyses (BLAS threads and
+    scipy.fft workers), so that they do not oversubscribe the machine.
+
+    The analyses run on the ICs in decomposition order. Once all have finished,
+    the ICs are sorted by kurtosis and the correlation and spectral results are
+    permuted accordingly, in a fixed stage order, so that the merged IC equals
+    the one of the sequential pipeline whatever the completion order. Stages
+    found in the result cache are not run.
+
+    Parameters:
+    - IC: dict with 'S' [numofic x T], 'A' and 'W' (and 'Sfile' for memory-mapped sources)
+    - extdata: external signals [S x T] of the correlation analysis
+    - stages: dict of stage name ('nongaussanalysis', 'signalcorrestimate',
+      'spectraldensity') -> (cache key, stage configuration)
+    - cache: result cache of msfun_ica_cache_open, or None
+    - cfg: dict with keys:
+        - 'executor': 'thread' or 'process'
+        - 'workers': number of cores to share (default: all cores)
+        - 'epochs': number of epochs K concatenated in S, or None
+
+    Returns:
+    - IC: sorted by decreasing kurtosis, with 'cumulant', 'corr', 'powspctrm' and 'freq'
+    '''
+    from msfun_ica_cache import msfun_ica_cache_get, msfun_ica_cache_put
+    from msfun_ica_meg_nongaussanalysis import msfun_ica_meg_nongaussanalysis_reorder
+
+    executor = cfg.get("executor", "thread")
+    if executor not in ["thread", "process"]:
+        raise ValueError("msfun_ica_megdecomp_posthoc - ERROR: Executor must be 'thread' or 'process'... Try again.")
+    workers = cfg.get("workers", None) or os.cpu_count() or 1
+
+    with msfun_ica_log_stage("posthoc", {"S": IC["S"]}):
+        values = {}
+        cached = []
+        for stage, (key, _) in stages.items():
+            value = msfun_ica_cache_get(cache, stage, key) if cache is not None else None
+            if value is not None:
+                msfun_ica_print(f"msfun_ica_cache - {stage} restored from cache...")
+                values[stage] = value
+                cached.append(stage)
+        todo = [stage for stage in stages if stage not in values]
+
+        walls = {}
+        if todo:
+            nthreads = max(1, workers // len(todo))
+            msfun_ica_print(f"msfun_ica_megdecomp - Running {', '.join(todo)} on a {executor} pool, {nthreads} threads each...")
+            jobs = {}
+            for stage in todo:
+                stage_cfg = copy.deepcopy(stages[stage][1])
+                if stage != "nongaussanalysis":
+                    stage_cfg.setdefault("workers", nthreads)
+                jobs[stage] = (stage_cfg, extdata if stage == "signalcorrestimate" else None)
 
-    keep, reject, _ = msfun_ica_meg_plot(IC)
-    cfg.setdefault("viewer", {})["list"] = reject
-    msfun_meg_ica_viewer(IC, cfg["viewer"], raw)
+            if executor == "thread":
+                S = IC["S"].view()
+                S.flags.writeable = False
+                # threadpoolctl only: the caller's environment is left untouched
+                limiter = msfun_sys_threadlimit(nthreads, environ=False)
+                try:
+                    with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+                        futures = {stage: pool.submit(msfun_ica_megdecomp_posthoc_run, stage, S, ext, stage_cfg, cfg.get("epochs", None))
+                                   for stage, (stage_cfg, ext) in jobs.items()}
+                        results = {stage: future.result() for stage, future in futures.items()}
+                finally:
+                    if limiter is not None:
+                        limiter.restore_original_limits()
+            else:
+                shm = None
+                if isinstance(IC["S"], np.memmap) and IC.get("Sfile", None):
+                    IC["S"].flush()
+                    src = {"file": IC["Sfile"]}
+                else:
+                    shm, X, meta = msfun_sig_shared_create(IC["S"].shape, IC["S"].dtype)
+                    X[...] = IC["S"]
+                    del X
+                    src = {"shared": meta}
+                try:
+                    with ProcessPoolExecutor(max_workers=len(todo), initializer=msfun_ica_megdecomp_posthoc_init, initargs=(src, nthreads)) as pool:
+                        futures = {stage: pool.submit(msfun_ica_megdecomp_posthoc_run, stage, None, ext, stage_cfg, cfg.get("epochs", None))
+                                   for stage, (stage_cfg, ext) in jobs.items()}
+                        results = {stage: future.result() for stage, future in futures.items()}
+                finally:
+                    if shm is not None:
+                        shm.close()
+                        shm.unlink()
+            for stage in todo:
+                values[stage], walls[stage] = results[stage]
 
+        msfun_ica_print("msfun_ica_megdecomp - Sorting ICs and merging the post-hoc results...")
+        order = values["nongaussanalysis"]["cumulant"]["order"]
+        IC = msfun_ica_meg_nongaussanalysis_reorder(IC, order)
+        for stage in _posthoc_keys:
+            if stage not in values:
+                continue
+            value = values[stage]
+            if stage in todo:
+                if stage == "signalcorrestimate":
+                    value = {"corr": msfun_ica_megdecomp_permute(value["corr"], order, -1)}
+                elif stage == "spectraldensity":
+                    value = dict(value, powspctrm=value["powspctrm"][order])
+                if cache is not None:
+                    msfun_ica_cache_put(cache, stage, stages[stage][0], value)
+            IC.update(value)
+        msfun_ica_log_note(executor=executor, cached=cached, walls=walls)
     return IC
@@ -0,0 +1,151 @@
+import os
+import csv
+import json
+import time
+import traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from msfun_sys_threadlimit import msfun_sys_threadlimit
+from msfun_ica_io import msfun_ica_save
+from msfun_ica_log import msfun_ica_print, msfun_ica_log_config
+
+_worker = {}
+
+def msfun_ica_megdecomp_batch_init(nthreads):
+    import matplotlib
+    matplotlib.use("Agg")
+    _worker['limiter'] = msfun_sys_threadlimit(nthreads)
+
+def msfun_ica_megdecomp_batch_load(entry, key, mmap):
+    x = entry.get(key, None)
+    if x is None or isinstance(x, np.ndarray):
+        return x
+    return np.load(x, mmap_mode="r" if mmap else None)
+
+def msfun_ica_megdecomp_batch_run(entry, outdir, mmap, save_cfg, log=None):
+    from msfun_ica_megdecomp import msfun_ica_megdecomp
+
+    name = entry["name"]
+    row = {"name": name, "status": "ok", "walltime": np.nan, "cputime": np.nan,
+           "numofic": 0, "nreject": 0, "reject": [], "outfile": ""}
+    t0 = time.perf_counter()
+    c0 = time.process_time()
+    if log is not None:
+        msfun_ica_log_config(log)
+    try:
+        data = msfun_ica_megdecomp_batch_load(entry, "data", mmap)
+        extdata = msfun_ica_megdecomp_batch_load(entry, "extdata", mmap)
+        cfg = dict(entry.get("cfg", {}), interactive=False)
+        IC = msfun_ica_megdecomp(entry.get("raw", {}), data, extdata, cfg)
+
+        outfile = os.path.join(outdir, f"{name}_IC")
+        if isinstance(entry["data"], str):
+            save_cfg = dict(save_cfg, datafile=entry["data"])
+        msfun_ica_save(IC, outfile, save_cfg)
+
+        row["numofic"] = IC["A"].shape[1]
+        row["reject"] = IC["artdetect"]["list"]
+        row["nreject"] = len(row["reject"])
+        row["outfile"] = outfile
+    except Exception as err:
+        row["status"] = f"error: {err!r}"
+        row["traceback"] = traceback.format_exc()
+    row["walltime"] = time.perf_counter() - t0
+    row["cputime"] = time.process_time() - c0
+    return row
+
+def msfun_ica_megdecomp_batch(manifest, cfg=None):
+    '''
+    Runs the full msfun_ica_megdecomp pipeline headless over many recordings.
+
+    Each recording is processed in a worker of a process pool with its own BLAS
+    thread limit, with all interactive and GUI stages disabled (plots, viewer and
+    spectral fit figures). Each IC result is written to disk with msfun_ica_save
+    (directory outdir/<name>_IC, reloaded with msfun_ica_load) and a summary table
+    is written to outdir/summary.csv. Errors are reported per recording and do
+    not stop the batch.
+
+    Parameters:
+    - manifest: list of dicts, or path to a JSON file holding such a list, with keys
+        - 'data': path to a .npy file ([N x T] or [K x N x T]) or numpy.ndarray
+        - 'extdata': path or numpy.ndarray of external signals (optional)
+        - 'cfg': msfun_ica_megdecomp configuration (optional)
+        - 'raw': header dict (optional, default {})
+        - 'name': identifier used for output files (default: data file name or index)
+    - cfg: dict with optional keys:
+        - 'outdir': output directory (default 'msfun_ica_batch')
+        - 'workers': size of the process pool (default: number of cores)
+        - 'threads': BLAS threads per worker (default: cores // workers)
+        - 'mmap': bool, memory-map .npy inputs (default True)
+        - 'save': msfun_ica_save configuration, e.g. {'sources': 'lazy'} to not store
+          the IC time courses (recomputed from the data file on load)
+        - 'log': msfun_ica_log_config configuration for the batch, e.g. {'quiet': True};
+          the workers use its 'quiet' flag and its file sinks (callable sinks only get the
+          events of this process); an entry cfg 'log' still applies to its pipeline
+
+    Returns:
+    - summary: list of dicts, one per recording, with keys 'name', 'status',
+      'walltime', 'cputime', 'numofic', 'nreject', 'reject' and 'outfile'
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_megdecomp_batch - ERROR: Configuration not a structure... Try again.")
+
+    if isinstance(manifest, str):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    if not isinstance(manifest, list) or not all(isinstance(e, dict) and "data" in e for e in manifest):
+        raise ValueError("msfun_ica_megdecomp_batch - ERROR: Manifest must be a list of entries with a 'data' key... Try again.")
+
+    entries = []
+    for k, e in enumerate(manifest):
+        e = dict(e)
+        if "name" not in e:
+            e["name"] = os.path.splitext(os.path.basename(e["data"]))[0] if isinstance(e["data"], str) else f"rec{k + 1}"
+        entries.append(e)
+    names = [e["name"] for e in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("msfun_ica_megdecomp_batch - ERROR: Recording names must be unique... Try again.")
+
+    outdir = cfg.get("outdir", "msfun_ica_batch")
+    os.makedirs(outdir, exist_ok=True)
+    ncores = os.cpu_count() or 1
+    workers = min(cfg.get("workers", None) or ncores, len(entries))
+    threads = cfg.get("threads", None) or max(1, ncores // workers)
+    mmap = cfg.get("mmap", True)
+
+    log = cfg.get("log", None)
+    previous = msfun_ica_log_config(log) if log is not None else None
+    worker_log = None
+    if log is not None:
+        # callable sinks cannot be sent to the worker processes
+        sinks = log.get("sink", None) or []
+        sinks = sinks if isinstance(sinks, list) else [sinks]
+        worker_log = {"quiet": log.get("quiet", False), "sink": [sink for sink in sinks if isinstance(sink, str)]}
+    try:
+        msfun_ica_print(f"msfun_ica_megdecomp_batch - Processing {len(entries)} recordings on {workers} workers with {threads} BLAS threads each...")
+        ctx = multiprocessing.get_context("spawn")
+        summary = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=msfun_ica_megdecomp_batch_init, initargs=(threads,)) as pool:
+            futures = [pool.submit(msfun_ica_megdecomp_batch_run, e, outdir, mmap, cfg.get("save", {}), worker_log) for e in entries]
+            for e, fut in zip(entries, futures):
+                row = fut.result()
+                msfun_ica_print(f"msfun_ica_megdecomp_batch -       {row['name']}: {row['status']} in {row['walltime']:.1f} s, {row['nreject']} ICs rejected...")
+                summary.append(row)
+
+        sumfile = os.path.join(outdir, "summary.csv")
+        msfun_ica_print(f"msfun_ica_megdecomp_batch - Writing summary table to {sumfile}...")
+        with open(sumfile, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "status", "walltime", "cputime", "numofic", "nreject", "reject", "outfile"])
+            for row in summary:
+                writer.writerow([row["name"], row["status"], f"{row['walltime']:.3f}", f"{row['cputime']:.3f}",
+                                 row["numofic"], row["nreject"], " ".join(str(i) for i in row["reject"]), row["outfile"]])
+
+        msfun_ica_print("msfun_ica_megdecomp_batch - Done.")
+        return summary
+    finally:
+        if previous is not None:
+            msfun_ica_log_config(previous)
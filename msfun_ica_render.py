@@ -0,0 +1,162 @@
+import os
+import sys
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+
+_render = {
+    'dir': None,
+    'format': 'png',
+    'dpi': 100,
+    'width': 2000,
+    'background': False,
+    'pool': None,
+    'pending': [],
+    'warned': False
+}
+
+def msfun_ica_render_config(cfg=None):
+    '''
+    Configures the rendering of the pipeline figures.
+
+    Parameters:
+    - cfg: dict with optional keys:
+        - 'dir': directory where figures are written as files instead of being
+          shown (default: none; figures are then shown when a display is available
+          and not rendered at all when running headless)
+        - 'format': file format (default 'png')
+        - 'dpi': file resolution (default 100)
+        - 'width': number of horizontal pixels traces are reduced to (default 2000)
+        - 'background': bool, render files in a background thread so that the
+          pipeline does not wait for the figures (default False); see msfun_ica_render_wait
+
+    Returns:
+    - previous: the previous configuration, to restore it with msfun_ica_render_config(previous)
+    '''
+    if cfg is None:
+        cfg = {}
+    if not isinstance(cfg, dict):
+        raise ValueError("msfun_ica_render_config - ERROR: Configuration not a structure... Try again.")
+    previous = {k: _render[k] for k in ['dir', 'format', 'dpi', 'width', 'background']}
+    width = cfg.get('width', 2000)
+    if not isinstance(width, (int, np.integer)) or width <= 0:
+        raise ValueError("msfun_ica_render_config - ERROR: Width must be a positive integer... Try again.")
+    _render['dir'] = cfg.get('dir', None)
+    _render['format'] = cfg.get('format', 'png')
+    _render['dpi'] = cfg.get('dpi', 100)
+    _render['width'] = int(width)
+    _render['background'] = bool(cfg.get('background', False))
+    _render['warned'] = False
+    return previous
+
+def msfun_ica_render_headless():
+    '''
+    True when figures cannot be shown: non-interactive matplotlib backend
+    (e.g. Agg) or no display on Linux.
+    '''
+    backend = matplotlib.get_backend().lower()
+    if backend in ['agg', 'pdf', 'pgf', 'ps', 'svg', 'cairo', 'template']:
+        return True
+    if backend.startswith('module://'):
+        return False
+    return sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY')
+
+def msfun_ica_render_envelope(y, width=None):
+    '''
+    Reduces a long trace to its min/max envelope at screen resolution: the
+    samples are split into width bins and each bin is drawn as a vertical
+    segment from its minimum to its maximum, which looks the same as plotting
+    every sample. Traces shorter than 2 * width samples are returned as is.
+
+    Parameters:
+    - y: 1D array (e.g. a memory-mapped channel), read once
+    - width: number of bins (default: configured width, 2000)
+
+    Returns:
+    - x: sample positions [2 * width] (or [T])
+    - y: envelope values [2 * width] (or the trace)
+    '''
+    if width is None:
+        width = _render['width']
+    y = np.asarray(y)
+    T = y.shape[0]
+    if T <= 2 * width:
+        return np.arange(T), y
+    edges = np.linspace(0, T, width + 1).astype(np.int64)
+    lo = np.minimum.reduceat(y, edges[:-1])
+    hi = np.maximum.reduceat(y, edges[:-1])
+    x = np.repeat((edges[:-1] + edges[1:] - 1) / 2, 2)
+    return x, np.stack([lo, hi], axis=1).ravel()
+
+def msfun_ica_render_save(draw, figsize, path):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    draw(fig)
+    fig.savefig(path, dpi=_render['dpi'])
+    return path
+
+def msfun_ica_render(draw, name, figsize=None):
+    '''
+    Renders one figure without blocking the pipeline.
+
+    draw(fig) fills a matplotlib Figure through its object interface
+    (fig.add_subplot, ...). With a display and no configured directory, the
+    figure is opened with pyplot and shown without blocking. With a configured
+    directory it is rendered with the Agg canvas to <dir>/<name>.<format>, in the
+    background thread when 'background' is set. Headless without a configured
+    directory, nothing is rendered and a UserWarning (not silenced by the quiet
+    mode of msfun_ica_log_config) is issued on the first figure.
+
+    Parameters:
+    - draw: callable taking the Figure
+    - name: figure name (file name without extension, or window title)
+    - figsize: figure size in inches (default matplotlib's)
+
+    Returns:
+    - the pyplot figure, the written file path, a concurrent.futures.Future of
+      the file path in background mode, or None when headless without directory
+    '''
+    folder = _render['dir']
+    if folder is None and msfun_ica_render_headless():
+        if not _render['warned']:
+            # a warning rather than msfun_ica_print, so that quiet mode does not hide it
+            warnings.warn("msfun_ica_render - No display, figures are not rendered; set a directory with "
+                          "msfun_ica_render_config({'dir': ...}) or msfun_ica_megdecomp cfg['render']", stacklevel=2)
+            _render['warned'] = True
+        return None
+    if folder is None:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(name, figsize=figsize)
+        draw(fig)
+        plt.show(block=False)
+        plt.pause(0.001)
+        return fig
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{name}.{_render['format']}")
+    if not _render['background']:
+        return msfun_ica_render_save(draw, figsize, path)
+    if _render['pool'] is None:
+        _render['pool'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='msfun_ica_render')
+    future = _render['pool'].submit(msfun_ica_render_save, draw, figsize, path)
+    _render['pending'].append(future)
+    return future
+
+def msfun_ica_render_wait():
+    '''
+    Waits for the figures submitted to the background thread.
+
+    Returns:
+    - files: paths of the figures written since the last call
+    '''
+    files = []
+    pending, _render['pending'] = _render['pending'], []
+    for future in pending:
+        try:
+            files.append(future.result())
+        except Exception as err:
+            warnings.warn(f"msfun_ica_render - Figure rendering failed ({err!r})", stacklevel=2)
+    return files
@@ -0,0 +1,217 @@
+import os
+import json
+import numpy as np
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_topoindex_init(N, capacity=1024):
+    '''
+    Creates an empty index of IC topographies (mixing matrix columns) of
+    N-channel recordings.
+
+    Topographies are stored centered and unit-norm as the rows of a float32
+    matrix, so that the absolute spatial correlation with a query is one
+    product. Storage grows by doubling, so inserts are amortized O(N).
+
+    Returns:
+    - index: dict with 'N', 'n' (number of stored topographies), 'X' [capacity x N],
+      'labels' (label of each stored topography, None for unlabeled/brain
+      components) and 'session', 'ic' (origin of each topography)
+    '''
+    if not isinstance(N, (int, np.integer)) or N <= 0:
+        raise ValueError("msfun_ica_topoindex_init - ERROR: Number of channels must be a positive integer... Try again.")
+    return {
+        'N': int(N),
+        'n': 0,
+        'X': np.zeros((max(int(capacity), 1), int(N)), dtype=np.float32),
+        'labels': [],
+        'session': [],
+        'ic': []
+    }
+
+def msfun_ica_topoindex_normalize(A):
+    '''
+    Centered, unit-norm columns of A [N x n], returned as float32 rows [n x N]
+    (zero rows for constant columns).
+    '''
+    A = np.asarray(A, dtype=np.float64)
+    if A.ndim == 1:
+        A = A[:, np.newaxis]
+    X = (A - np.mean(A, axis=0, keepdims=True)).T
+    norm = np.linalg.norm(X, axis=1, keepdims=True)
+    return np.divide(X, norm, out=np.zeros_like(X), where=norm > 0).astype(np.float32)
+
+def msfun_ica_topoindex_labels(IC, label='artifact'):
+    '''
+    Labels of the ICs of an IC result for msfun_ica_topoindex_add: label for the
+    rejected ICs of IC['artdetect']['list'], None for the others.
+    '''
+    rejected = set(int(i) for i in IC.get('artdetect', {}).get('list', []))
+    return [label if k in rejected else None for k in range(IC['A'].shape[1])]
+
+def msfun_ica_topoindex_add(index, A, labels, session=None):
+    '''
+    Inserts the topographies of the columns of A [N x n] with their labels
+    (modified in place).
+
+    Parameters:
+    - index: msfun_ica_topoindex_init output
+    - A: mixing matrix [N x n], e.g. IC['A']
+    - labels: list of n labels (e.g. 'ecg', 'eog', None for brain components);
+      see msfun_ica_topoindex_labels
+    - session: identifier of the recording (default: running number)
+
+    Returns:
+    - index
+    '''
+    A = np.asarray(A)
+    if A.ndim != 2 or A.shape[0] != index['N']:
+        raise ValueError("msfun_ica_topoindex_add - ERROR: Mixing matrix inconsistent with index channels... Try again.")
+    n = A.shape[1]
+    if len(labels) != n:
+        raise ValueError("msfun_ica_topoindex_add - ERROR: One label per IC must be given... Try again.")
+    if session is None:
+        session = len(set(index['session']))
+
+    if index['n'] + n > index['X'].shape[0]:
+        capacity = max(index['X'].shape[0], 1)
+        while capacity < index['n'] + n:
+            capacity *= 2
+        X = np.zeros((capacity, index['N']), dtype=np.float32)
+        X[:index['n']] = index['X'][:index['n']]
+        index['X'] = X
+    index['X'][index['n']:index['n'] + n] = msfun_ica_topoindex_normalize(A)
+    index['n'] += n
+    index['labels'].extend(None if l is None else str(l) for l in labels)
+    index['session'].extend([str(session)] * n)
+    index['ic'].extend(range(n))
+    return index
+
+def msfun_ica_topoindex_query(index, A, k=1, chunk=None):
+    '''
+    Nearest stored topographies of the columns of A [N x n] by absolute spatial
+    correlation, computed as batched float32 products over chunks of the index.
+
+    Parameters:
+    - index: msfun_ica_topoindex_init output
+    - A: mixing matrix [N x n]
+    - k: number of neighbors (default 1)
+    - chunk: stored topographies per product (default: about 16M values per product)
+
+    Returns:
+    - match: indices of the neighbors in the index [n x k], best first (-1 if none)
+    - corr: their absolute correlations [n x k]
+    '''
+    A = np.asarray(A)
+    if A.ndim != 2 or A.shape[0] != index['N']:
+        raise ValueError("msfun_ica_topoindex_query - ERROR: Mixing matrix inconsistent with index channels... Try again.")
+    Q = msfun_ica_topoindex_normalize(A)
+    nq, nstored = Q.shape[0], index['n']
+    match = np.full((nq, k), -1, dtype=np.int64)
+    corr = np.zeros((nq, k), dtype=np.float32)
+    if chunk is None:
+        chunk = max(k, (1 << 24) // max(nq, 1))
+    for i in range(0, nstored, chunk):
+        C = np.abs(Q @ index['X'][i:min(i + chunk, nstored)].T)
+        # merge the best k of this chunk with the best k so far
+        cand = np.concatenate([corr, C], axis=1)
+        ids = np.concatenate([match, np.broadcast_to(np.arange(i, i + C.shape[1]), C.shape)], axis=1)
+        best = np.argpartition(-cand, k - 1, axis=1)[:, :k]
+        corr = np.take_along_axis(cand, best, axis=1)
+        match = np.take_along_axis(ids, best, axis=1)
+    order = np.argsort(-corr, axis=1, kind='stable')
+    return np.take_along_axis(match, order, axis=1), np.take_along_axis(corr, order, axis=1)
+
+def msfun_ica_topoindex_label(IC, index, cfg=None):
+    '''
+    Labels the ICs of a new decomposition from their nearest stored topographies
+    and pre-populates the artifact list used by msfun_ica_artifactrejection.
+
+    An IC is flagged when the majority label of its k nearest topographies with
+    absolute correlation >= cfg['Tcorr'] is an artifact label.
+
+    Parameters:
+    - IC: dict with 'A' [N x numofic]
+    - index: msfun_ica_topoindex_init / msfun_ica_topoindex_load output
+    - cfg: dict with optional keys:
+        - 'Tcorr': absolute spatial correlation threshold (default 0.9)
+        - 'k': number of neighbors voting (default 1)
+        - 'labels': labels counted as artifacts (default: all non-None labels)
+
+    Returns:
+    - IC: with 'artdetect' 'list' extended by the flagged ICs and 'topo' holding
+      the 'label' of each IC (None when unmatched), the best 'corr' and the
+      index entry of the best 'match' and 'Tcorr'
+    '''
+    if cfg is None:
+        cfg = {}
+    if 'A' not in IC:
+        raise ValueError("msfun_ica_topoindex_label - ERROR: IC structure missing mixing matrix... Try again.")
+    Tcorr = cfg.get('Tcorr', 0.9)
+    k = cfg.get('k', 1)
+    artlabels = cfg.get('labels', None)
+
+    msfun_ica_print(f"msfun_ica_topoindex_label - Matching {IC['A'].shape[1]} IC topographies against {index['n']} stored ones...")
+    match, corr = msfun_ica_topoindex_query(index, IC['A'], k)
+    labels = []
+    for m, c in zip(match, corr):
+        votes = [index['labels'][j] for j, r in zip(m, c) if j >= 0 and r >= Tcorr]
+        if not votes:
+            labels.append(None)
+            continue
+        counts = {}
+        for v in votes:
+            counts[v] = counts.get(v, 0) + 1
+        # ties go to the nearest neighbor's label
+        labels.append(max(counts, key=lambda v: (counts[v], -votes.index(v))))
+    flagged = [i for i, l in enumerate(labels) if l is not None and (artlabels is None or l in artlabels)]
+
+    artdetect = IC.setdefault('artdetect', {})
+    artdetect['list'] = sorted(set(int(i) for i in artdetect.get('list', [])) | set(flagged))
+    artdetect['topo'] = {
+        'label': labels,
+        'corr': corr[:, 0],
+        'match': match[:, 0],
+        'Tcorr': Tcorr
+    }
+    msfun_ica_print(f"msfun_ica_topoindex_label -       {len(flagged)} ICs labeled as artifacts...")
+    return IC
+
+def msfun_ica_topoindex_save(index, dirname):
+    '''
+    Saves the index to the directory dirname (X.npy and index.json).
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, 'X.npy'), index['X'][:index['n']])
+    with open(os.path.join(dirname, 'index.json'), 'w') as f:
+        json.dump({'version': 1, 'N': index['N'], 'labels': index['labels'], 'session': index['session'], 'ic': index['ic']}, f)
+    return dirname
+
+def msfun_ica_topoindex_load(dirname, cfg=None):
+    '''
+    Loads an index saved by msfun_ica_topoindex_save.
+
+    Parameters:
+    - dirname: index directory
+    - cfg: dict with optional keys:
+        - 'mmap': bool, memory-map the topographies read-only instead of loading
+          them, for lookups only (default False; inserts then copy them to memory)
+
+    Returns:
+    - index
+    '''
+    if cfg is None:
+        cfg = {}
+    fname = os.path.join(dirname, 'index.json')
+    if not os.path.exists(fname):
+        raise ValueError("msfun_ica_topoindex_load - ERROR: No topography index found in directory... Try again.")
+    with open(fname) as f:
+        meta = json.load(f)
+    X = np.load(os.path.join(dirname, 'X.npy'), mmap_mode='r' if cfg.get('mmap', False) else None)
+    return {
+        'N': meta['N'],
+        'n': X.shape[0],
+        'X': X,
+        'labels': meta['labels'],
+        'session': meta['session'],
+        'ic': meta['ic']
+    }
@@ -0,0 +1,200 @@
+import numpy as np
+from msfun_sig_epoch import msfun_sig_epoch_concat
+from msfun_ica_log import msfun_ica_print
+
+def msfun_ica_whatif_init(data, IC, chunk=None):
+    '''
+    Precomputes, in one chunked pass over the data and the sources, the moments
+    needed to evaluate the removal of any subset of ICs without reconstructing
+    the cleaned data: the Gram matrix of the topographies A.T @ A, the source
+    covariance, the data/source cross-covariance and the per-channel data variance.
+
+    Removing the ICs L from x gives x - A[:, L] @ S[L], whose variance on channel c is
+    var(x_c) - 2 sum_{i in L} A[c, i] Cxs[c, i] + sum_{i, j in L} A[c, i] Css[i, j] A[c, j],
+    so every candidate subset only costs products of [N x k] and [k x k] matrices.
+
+    Parameters:
+    - data: numpy.ndarray or numpy.memmap, [N x T] or [K x N x T]
+    - IC: dict with 'A' [N x numofic] and 'S' [numofic x T] or [K x numofic x T] (S may
+      be a memory map or the lazy sources of msfun_ica_load)
+    - chunk: samples (2D) or trials (3D) per chunk (default: about 16M values per chunk)
+
+    Returns:
+    - model: dict with 'A' [N x numofic], 'G' (A.T @ A) and 'Css' [numofic x numofic],
+      'Cxs' [N x numofic], 'var' [N] and 'T' (number of samples)
+    '''
+    if not isinstance(IC, dict) or "A" not in IC or "S" not in IC:
+        raise ValueError("msfun_ica_whatif_init - ERROR: IC structure missing mixing matrix or sources... Try again.")
+    A = np.asarray(IC["A"], dtype=np.float64)
+    S = IC["S"]
+    N, n = A.shape
+    if data.ndim == 2:
+        if data.shape[0] != N or S.shape != (n, data.shape[1]):
+            raise ValueError("msfun_ica_whatif_init - ERROR: Input data and IC inconsistent for 2D case... Try again.")
+        T = data.shape[1]
+        if chunk is None:
+            chunk = max(1, (1 << 24) // (N + n))
+        blocks = ((data[:, ti:ti + chunk], S[:, ti:ti + chunk]) for ti in range(0, T, chunk))
+    elif data.ndim == 3:
+        if data.shape[1] != N or S.shape != (data.shape[0], n, data.shape[2]):
+            raise ValueError("msfun_ica_whatif_init - ERROR: Input data and IC inconsistent for 3D case... Try again.")
+        K = data.shape[0]
+        T = K * data.shape[2]
+        if chunk is None:
+            chunk = max(1, (1 << 24) // ((N + n) * data.shape[2]))
+        blocks = ((msfun_sig_epoch_concat(data[k:k + chunk]), msfun_sig_epoch_concat(np.asarray(S[k:k + chunk]))) for k in range(0, K, chunk))
+    else:
+        raise ValueError("msfun_ica_whatif_init - ERROR: First input data must be array with 2 or 3 dimensions... Try again.")
+
+    msfun_ica_print(f"msfun_ica_whatif_init - Accumulating data and source moments over {T} samples...")
+    # moments around the means of the first block, to avoid cancellation with large offsets
+    shiftx = shifts = None
+    sx = np.zeros(N)
+    ss = np.zeros(n)
+    sxx = np.zeros(N)
+    sxs = np.zeros((N, n))
+    sss = np.zeros((n, n))
+    for X, Sb in blocks:
+        X = np.asarray(X, dtype=np.float64)
+        Sb = np.asarray(Sb, dtype=np.float64)
+        if shiftx is None:
+            shiftx = np.mean(X, axis=1)
+            shifts = np.mean(Sb, axis=1)
+        X = X - shiftx[:, np.newaxis]
+        Sb = Sb - shifts[:, np.newaxis]
+        sx += np.sum(X, axis=1)
+        ss += np.sum(Sb, axis=1)
+        sxx += np.einsum('ij,ij->i', X, X)
+        sxs += X @ Sb.T
+        sss += Sb @ Sb.T
+    mx = sx / T
+    ms = ss / T
+
+    return {
+        "A": A,
+        "G": A.T @ A,
+        "Css": sss / T - np.outer(ms, ms),
+        "Cxs": sxs / T - np.outer(mx, ms),
+        "var": sxx / T - mx**2,
+        "T": T
+    }
+
+def msfun_ica_whatif_subsets(subsets, n):
+    # candidate subsets as padded index lists [B x k] with weights 1 (IC) / 0 (padding)
+    if isinstance(subsets, np.ndarray) and subsets.dtype == bool:
+        masks = np.atleast_2d(subsets)
+        if masks.shape[1] != n:
+            raise ValueError("msfun_ica_whatif - ERROR: Subset masks inconsistent with number of ICs... Try again.")
+        subsets = [np.flatnonzero(m) for m in masks]
+    elif len(subsets) > 0 and np.ndim(subsets[0]) == 0:
+        subsets = [subsets]
+    subsets = [np.asarray(s, dtype=np.int64).ravel() for s in subsets]
+    if any(np.any((s < 0) | (s >= n)) or len(np.unique(s)) != len(s) for s in subsets):
+        raise ValueError("msfun_ica_whatif - ERROR: Subsets must hold distinct IC indices... Try again.")
+    k = max([len(s) for s in subsets] + [1])
+    idx = np.zeros((len(subsets), k), dtype=np.int64)
+    w = np.zeros((len(subsets), k))
+    for b, s in enumerate(subsets):
+        idx[b, :len(s)] = s
+        w[b, :len(s)] = 1
+    return idx, w
+
+def msfun_ica_whatif(model, subsets, cfg=None):
+    '''
+    Removal metrics of a batch of candidate artifact lists, from the moments of
+    msfun_ica_whatif_init, without reconstructing the data.
+
+    Parameters:
+    - model: msfun_ica_whatif_init output
+    - subsets: one list of IC indices, a list of B lists, or a boolean mask array [B x numofic]
+    - cfg: dict with optional keys:
+        - 'perchannel': bool, compute the per-channel metrics (default True); the
+          totals alone only need the [k x k] blocks of A.T @ A
+
+    Returns:
+    - metrics: dict with, for each subset b:
+        - 'removed': variance of the removed signal A[:, L] @ S[L] per channel [B x N]
+        - 'residual': variance of the cleaned data per channel [B x N]
+        - 'explained': fraction of the total data variance removed by the cleaning,
+          1 - sum(residual) / sum(var) [B]
+      (without 'perchannel', 'removed' and 'residual' are the totals over channels [B])
+    '''
+    if cfg is None:
+        cfg = {}
+    A = model["A"]
+    N, n = A.shape
+    idx, w = msfun_ica_whatif_subsets(subsets, n)
+    Cg = model["Css"][idx[:, :, np.newaxis], idx[:, np.newaxis, :]] * w[:, :, np.newaxis] * w[:, np.newaxis, :]
+
+    if cfg.get("perchannel", True):
+        P = A[:, idx].transpose(1, 0, 2) * w[:, np.newaxis, :]
+        removed = np.einsum('bck,bck->bc', P @ Cg, P)
+        cross = np.einsum('bck,bck->bc', P, model["Cxs"][:, idx].transpose(1, 0, 2))
+        residual = model["var"][np.newaxis, :] - 2 * cross + removed
+        total = np.sum(residual, axis=1)
+    else:
+        # sum over channels of the quadratic forms: A.T @ A and diag(A.T @ Cxs) blocks
+        removed = np.einsum('bkl,bkl->b', model["G"][idx[:, :, np.newaxis], idx[:, np.newaxis, :]], Cg)
+        cross = (np.einsum('ci,ci->i', A, model["Cxs"])[idx] * w).sum(axis=1)
+        residual = np.sum(model["var"]) - 2 * cross + removed
+        total = residual
+
+    return {
+        "removed": removed,
+        "residual": residual,
+        "explained": 1 - total / np.sum(model["var"])
+    }
+
+def msfun_ica_whatif_greedy(model, cfg=None):
+    '''
+    Greedy forward selection of the ICs whose removal explains the most data
+    variance: at each step the IC with the largest decrease of the total residual
+    variance is added, evaluating all candidates at once in O(numofic).
+
+    Parameters:
+    - model: msfun_ica_whatif_init output
+    - cfg: dict with optional keys:
+        - 'candidates': IC indices allowed in the selection (default: all)
+        - 'k': maximal number of selected ICs (default 10)
+        - 'explained': stop once this fraction of the data variance is removed (default: none)
+
+    Returns:
+    - greedy: dict with 'list' (selected ICs in selection order) and 'explained'
+      (fraction of the data variance removed after each step)
+    '''
+    if cfg is None:
+        cfg = {}
+    n = model["A"].shape[1]
+    candidates = np.asarray(cfg.get("candidates", np.arange(n)), dtype=np.int64)
+    if np.any((candidates < 0) | (candidates >= n)):
+        raise ValueError("msfun_ica_whatif_greedy - ERROR: Candidate ICs inconsistent... Try again.")
+    k = min(cfg.get("k", 10), len(candidates))
+    target = cfg.get("explained", None)
+
+    # residual(L + j) = residual(L) - gain(j), with the quadratic terms of A.T @ A o Css
+    Q = model["G"] * model["Css"]
+    x = np.einsum('ci,ci->i', model["A"], model["Cxs"])
+    total = np.sum(model["var"])
+    inter = np.zeros(n)
+    available = np.zeros(n, dtype=bool)
+    available[candidates] = True
+    selected = []
+    explained = []
+    residual = total
+    for _ in range(k):
+        gain = np.where(available, 2 * x - np.diag(Q) - 2 * inter, -np.inf)
+        j = int(np.argmax(gain))
+        selected.append(j)
+        available[j] = False
+        inter += Q[j]
+        residual -= gain[j]
+        explained.append(1 - residual / total)
+        if target is not None and explained[-1] >= target:
+            break
+
+    if selected:
+        msfun_ica_print(f"msfun_ica_whatif_greedy - {len(selected)} ICs selected, {100 * explained[-1]:.1f}% of the data variance removed...")
+    return {
+        "list": selected,
+        "explained": np.asarray(explained)
+    }
@@ -0,0 +1,35 @@
+import numpy as np
+
+def msfun_sig_chunks(sig, chunk=None):
+    '''
+    Iterates over an [N x T] signal in blocks of consecutive samples.
+
+    Parameters:
+    - sig: one of
+        - numpy.ndarray or numpy.memmap of shape [N x T]
+        - callable returning a fresh iterator over [N x t] blocks
+        - iterable of [N x t] blocks (a one-shot iterator can only be read once)
+    - chunk: int, number of samples per block when sig is an array (default 65536)
+
+    Yields:
+    - numpy.ndarray blocks of shape [N x t]; array inputs yield views
+    '''
+    if chunk is None:
+        chunk = 65536
+    if not isinstance(chunk, (int, np.integer)) or chunk <= 0:
+        raise ValueError("msfun_sig_chunks - ERROR: Chunk length must be a positive integer... Try again.")
+
+    if isinstance(sig, np.ndarray):
+        if sig.ndim != 2:
+            raise ValueError("msfun_sig_chunks - ERROR: Signal matrix inconsistent... Try again.")
+        T = sig.shape[1]
+        for ti in range(0, T, chunk):
+            yield sig[:, ti:ti + chunk]
+        return
+
+    blocks = sig() if callable(sig) else sig
+    for block in blocks:
+        block = np.asarray(block)
+        if block.ndim != 2:
+            raise ValueError("msfun_sig_chunks - ERROR: Signal blocks must be [N x t] arrays... Try again.")
+        yield block
@@ -0,0 +1,72 @@
+import numpy as np
+
+def msfun_sig_covstats_init(N):
+    '''
+    Creates an empty accumulator for one-pass channel mean, standard deviation
+    and covariance estimation over [N x t] blocks.
+
+    Sums are kept in float64 around a shift (the mean of the first block) so
+    that long recordings with a large DC offset do not lose precision.
+    '''
+    return {
+        'n': 0,
+        'shift': None,
+        'sum': np.zeros(N),
+        'sxx': np.zeros((N, N))
+    }
+
+def msfun_sig_covstats_update(stats, X):
+    '''
+    Adds the [N x t] block X to the accumulator stats (modified in place).
+    '''
+    X = np.asarray(X)
+    if X.ndim != 2 or X.shape[0] != stats['sum'].shape[0]:
+        raise ValueError("msfun_sig_covstats_update - ERROR: Block inconsistent with accumulator... Try again.")
+    if X.shape[1] == 0:
+        return stats
+    if stats['shift'] is None:
+        stats['shift'] = np.mean(X, axis=1, dtype=np.float64)
+    Xc = X.astype(np.float64) - stats['shift'][:, np.newaxis]
+    stats['n'] += X.shape[1]
+    stats['sum'] += np.sum(Xc, axis=1)
+    stats['sxx'] += Xc @ Xc.T
+    return stats
+
+def msfun_sig_covstats_merge(stats, other):
+    '''
+    Merges the accumulator other into stats (modified in place), e.g. to
+    combine partial statistics computed on separate shards.
+    '''
+    if other['n'] == 0:
+        return stats
+    if stats['n'] == 0:
+        stats['n'] = other['n']
+        stats['shift'] = other['shift'].copy()
+        stats['sum'] = other['sum'].copy()
+        stats['sxx'] = other['sxx'].copy()
+        return stats
+    d = other['shift'] - stats['shift']
+    stats['sxx'] += other['sxx'] + np.outer(d, other['sum']) + np.outer(other['sum'], d) + other['n'] * np.outer(d, d)
+    stats['sum'] += other['sum'] + other['n'] * d
+    stats['n'] += other['n']
+    return stats
+
+def msfun_sig_covstats_finalize(stats):
+    '''
+    Returns a dict with keys:
+    - 'n': number of samples
+    - 'mean': channel means [N]
+    - 'std': channel standard deviations [N] (normalized by n, as numpy.std)
+    - 'cov': channel covariance [N x N] (normalized by n-1, as numpy.cov)
+    '''
+    n = stats['n']
+    if n < 2:
+        raise ValueError("msfun_sig_covstats_finalize - ERROR: At least two samples are needed... Try again.")
+    m = stats['sum'] / n
+    C = stats['sxx'] / n - np.outer(m, m)
+    return {
+        'n': n,
+        'mean': stats['shift'] + m,
+        'std': np.sqrt(np.maximum(np.diag(C), 0)),
+        'cov': C * (n / (n - 1))
+    }
@@ -0,0 +1,157 @@
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+from msfun_sig_chunks import msfun_sig_chunks
+
+def msfun_sig_crosscorr_init(S, n):
+    '''
+    Creates an empty accumulator of the Pearson correlations between S
+    reference signals and n other signals, updated over [S x t] / [n x t]
+    block pairs. Only the [S x n] cross products are accumulated, never the
+    full (S+n) x (S+n) correlation matrix. Sums are kept in float64 around a
+    shift (the means of the first block).
+    '''
+    return {
+        'n': 0,
+        'shift_y': None,
+        'shift_x': None,
+        'sy': np.zeros(S),
+        'sx': np.zeros(n),
+        'syy': np.zeros(S),
+        'sxx': np.zeros(n),
+        'sxy': np.zeros((S, n))
+    }
+
+def msfun_sig_crosscorr_update(acc, Y, X):
+    '''
+    Adds the block pair Y [S x t], X [n x t] to the accumulator acc (modified in place).
+    '''
+    if Y.ndim != 2 or X.ndim != 2 or Y.shape[0] != acc['sy'].shape[0] or X.shape[0] != acc['sx'].shape[0] or Y.shape[1] != X.shape[1]:
+        raise ValueError("msfun_sig_crosscorr_update - ERROR: Blocks inconsistent with accumulator... Try again.")
+    if X.shape[1] == 0:
+        return acc
+    if acc['shift_y'] is None:
+        acc['shift_y'] = np.mean(Y, axis=1, dtype=np.float64)
+        acc['shift_x'] = np.mean(X, axis=1, dtype=np.float64)
+    Yc = Y.astype(np.float64) - acc['shift_y'][:, np.newaxis]
+    Xc = X.astype(np.float64) - acc['shift_x'][:, np.newaxis]
+    acc['n'] += X.shape[1]
+    acc['sy'] += np.sum(Yc, axis=1)
+    acc['sx'] += np.sum(Xc, axis=1)
+    acc['syy'] += np.einsum('ij,ij->i', Yc, Yc)
+    acc['sxx'] += np.einsum('ij,ij->i', Xc, Xc)
+    acc['sxy'] += Yc @ Xc.T
+    return acc
+
+def msfun_sig_crosscorr_merge(acc, other):
+    '''
+    Merges the accumulator other into acc (modified in place).
+    '''
+    if other['n'] == 0:
+        return acc
+    if acc['n'] == 0:
+        for key in acc:
+            acc[key] = np.copy(other[key]) if key != 'n' else other['n']
+        return acc
+    n = other['n']
+    dy = other['shift_y'] - acc['shift_y']
+    dx = other['shift_x'] - acc['shift_x']
+    acc['sxy'] += other['sxy'] + np.outer(dy, other['sx']) + np.outer(other['sy'], dx) + n * np.outer(dy, dx)
+    acc['syy'] += other['syy'] + 2 * dy * other['sy'] + n * dy * dy
+    acc['sxx'] += other['sxx'] + 2 * dx * other['sx'] + n * dx * dx
+    acc['sy'] += other['sy'] + n * dy
+    acc['sx'] += other['sx'] + n * dx
+    acc['n'] += n
+    return acc
+
+def msfun_sig_crosscorr_finalize(acc):
+    '''
+    Returns the correlation matrix rho [S x n], as np.corrcoef(Y, X)[:S, S:]
+    (NaN for constant signals).
+    '''
+    n = acc['n']
+    if n < 2:
+        raise ValueError("msfun_sig_crosscorr_finalize - ERROR: At least two samples are needed... Try again.")
+    my = acc['sy'] / n
+    mx = acc['sx'] / n
+    cov = acc['sxy'] / n - np.outer(my, mx)
+    vy = np.maximum(acc['syy'] / n - my * my, 0)
+    vx = np.maximum(acc['sxx'] / n - mx * mx, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = cov / np.sqrt(np.outer(vy, vx))
+    return np.clip(rho, -1, 1)
+
+def msfun_sig_crosscorr(Y, X, chunk=None):
+    '''
+    Correlations rho [S x n] between the rows of Y [S x T] and of X [n x T],
+    computed over blocks of chunk samples (see msfun_sig_chunks).
+    '''
+    if Y.ndim != 2 or X.ndim != 2 or Y.shape[1] != X.shape[1]:
+        raise ValueError("msfun_sig_crosscorr - ERROR: Signal matrices inconsistent... Try again.")
+    acc = msfun_sig_crosscorr_init(Y.shape[0], X.shape[0])
+    for y, x in zip(msfun_sig_chunks(Y, chunk), msfun_sig_chunks(X, chunk)):
+        msfun_sig_crosscorr_update(acc, y, x)
+    return msfun_sig_crosscorr_finalize(acc)
+
+def msfun_sig_crosscorr_lagged(Y, X, maxlag, cfg=None):
+    '''
+    Lagged correlations between the rows of Y [S x T] and of X [n x T].
+
+    For every (Y row, X row) pair, the normalized cross-correlation
+    sum_t y(t) x(t + lag) / sqrt(sum y^2 sum x^2) of the centered signals is
+    computed for all lags in [-maxlag, maxlag] with one batched real FFT per
+    block of X rows, and the lag of maximal absolute correlation is kept.
+    At lag 0 the value is the Pearson correlation.
+
+    Parameters:
+    - Y: numpy.ndarray [S x T] (e.g. filtered external signals)
+    - X: numpy.ndarray or numpy.memmap [n x T] (e.g. IC time courses)
+    - maxlag: maximal lag in samples
+    - cfg: dict with optional keys:
+        - 'block': number of X rows per FFT batch (default: about 32M
+          correlation values per batch)
+        - 'prepare': callable applied to each [b x T] block of X rows before
+          correlating (e.g. a filter)
+        - 'workers': number of scipy.fft workers (default 1)
+
+    Returns:
+    - rho: correlation at the best lag [S x n] (signed)
+    - lag: best lag in samples [S x n]; a positive lag means that the X row
+      follows the Y row
+    '''
+    if cfg is None:
+        cfg = {}
+    if Y.ndim != 2 or X.ndim != 2 or Y.shape[1] != X.shape[1]:
+        raise ValueError("msfun_sig_crosscorr_lagged - ERROR: Signal matrices inconsistent... Try again.")
+    S, T = Y.shape
+    n = X.shape[0]
+    if not isinstance(maxlag, (int, np.integer)) or not 0 <= maxlag < T:
+        raise ValueError("msfun_sig_crosscorr_lagged - ERROR: Maximal lag must be an integer in [0, T)... Try again.")
+    nfft = next_fast_len(T + maxlag, real=True)
+    block = cfg.get("block", None) or max(1, (1 << 25) // (S * nfft))
+    prepare = cfg.get("prepare", None)
+    workers = cfg.get("workers", None)
+    lags = np.arange(-maxlag, maxlag + 1)
+
+    Yc = Y - np.mean(Y, axis=1, keepdims=True)
+    ny = np.sqrt(np.einsum('ij,ij->i', Yc, Yc))
+    FY = np.conj(rfft(Yc, n=nfft, axis=1, workers=workers))
+    del Yc
+
+    rho = np.zeros((S, n))
+    lag = np.zeros((S, n), dtype=int)
+    for i in range(0, n, block):
+        Xb = X[i:i + block]
+        if prepare is not None:
+            Xb = prepare(Xb)
+        Xb = Xb - np.mean(Xb, axis=1, keepdims=True)
+        nx = np.sqrt(np.einsum('ij,ij->i', Xb, Xb))
+        FX = rfft(Xb, n=nfft, axis=1, workers=workers)
+        del Xb
+        # c[s, j, k] = sum_t y_s(t) x_j(t + k), negative lags wrapped at the end
+        c = irfft(FY[:, np.newaxis, :] * FX[np.newaxis, :, :], n=nfft, axis=2, workers=workers)
+        c = np.take(c, lags, axis=2, mode='wrap')
+        best = np.argmax(np.abs(c), axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho[:, i:i + block] = np.take_along_axis(c, best[..., np.newaxis], axis=2)[..., 0] / np.outer(ny, nx)
+        lag[:, i:i + block] = lags[best]
+    return np.clip(rho, -1, 1), lag
@@ -0,0 +1,100 @@
+import numpy as np
+
+def msfun_sig_epoch_baseline(X, out=None):
+    '''
+    Subtracts from every epoch of X [K x N x T] (or from X [N x T]) its
+    temporal mean, channel by channel. Means are computed in float64.
+
+    Parameters:
+    - X: numpy.ndarray [K x N x T] or [N x T]
+    - out: output array of the same shape, or X itself for in-place correction
+      (default: a new array of the floating dtype of X)
+
+    Returns:
+    - out: baseline corrected epochs
+    '''
+    if X.ndim not in [2, 3]:
+        raise ValueError("msfun_sig_epoch_baseline - ERROR: Epochs must be [K x N x T] or [N x T] arrays... Try again.")
+    if out is None:
+        out = np.empty(X.shape, dtype=np.result_type(X.dtype, np.float32))
+    elif out.shape != X.shape:
+        raise ValueError("msfun_sig_epoch_baseline - ERROR: Output array inconsistent with epochs... Try again.")
+    mean = np.mean(X, axis=-1, dtype=np.float64, keepdims=True)
+    np.subtract(X, mean.astype(out.dtype), out=out, casting="same_kind")
+    return out
+
+def msfun_sig_epoch_concat(X, baseline=False, out=None, chunk=None):
+    '''
+    Concatenates the epochs of X [K x N x T] along time into the [N x K*T]
+    layout (epoch k in columns k*T .. (k+1)*T), optionally baseline correcting
+    each epoch on the fly. The data are read once and written once into out,
+    seen as [N x K x T]; memory-mapped epochs are processed in chunks of epochs.
+
+    Parameters:
+    - X: numpy.ndarray or numpy.memmap [K x N x T]
+    - baseline: bool, subtract the temporal mean of each epoch and channel (default False)
+    - out: caller-supplied [N x K*T] buffer, e.g. a memory map (default: a new array
+      of the floating dtype of X, or of the dtype of X without baseline correction)
+    - chunk: epochs per chunk (default: about 16M values per chunk)
+
+    Returns:
+    - out: concatenated epochs [N x K*T]
+    '''
+    if X.ndim != 3:
+        raise ValueError("msfun_sig_epoch_concat - ERROR: Epochs must be a [K x N x T] array... Try again.")
+    K, N, T = X.shape
+    if out is None:
+        out = np.empty((N, K * T), dtype=np.result_type(X.dtype, np.float32) if baseline else X.dtype)
+    elif out.shape != (N, K * T):
+        raise ValueError("msfun_sig_epoch_concat - ERROR: Output array inconsistent with epochs... Try again.")
+    view = out.reshape(N, K, T)
+    if chunk is None:
+        chunk = K if not isinstance(X, np.memmap) else max(1, (1 << 24) // max(N * T, 1))
+    for k in range(0, K, chunk):
+        E = X[k:k + chunk].transpose(1, 0, 2)
+        if baseline:
+            mean = np.mean(E, axis=2, dtype=np.float64, keepdims=True)
+            np.subtract(E, mean.astype(out.dtype), out=view[:, k:k + chunk], casting="same_kind")
+        else:
+            view[:, k:k + chunk] = E
+    return out
+
+def msfun_sig_epoch_split(X, K):
+    '''
+    Maps concatenated epochs X [N x K*T] back to the [K x N x T] layout, as a
+    (non-contiguous) view of X without copy.
+    '''
+    if X.ndim != 2 or K <= 0 or X.shape[1] % K != 0:
+        raise ValueError("msfun_sig_epoch_split - ERROR: Signal length not a multiple of the number of epochs... Try again.")
+    N, KT = X.shape
+    return X.reshape(N, K, KT // K).transpose(1, 0, 2)
+
+def msfun_sig_epoch_chunks(X, chunk=None, baseline=False, concat=False):
+    '''
+    Iterates over the epochs of X [K x N x T] in chunks of consecutive epochs,
+    e.g. to accumulate statistics over memory-mapped epochs.
+
+    Parameters:
+    - X: numpy.ndarray or numpy.memmap [K x N x T]
+    - chunk: epochs per chunk (default: about 16M values per chunk)
+    - baseline: bool, baseline correct each epoch (default False)
+    - concat: bool, yield the chunk in the [N x k*T] layout (default False)
+
+    Yields:
+    - (k0, E): first epoch index and epochs [k x N x T] ([N x k*T] with concat);
+      views of X without baseline correction nor concatenation, new arrays otherwise
+    '''
+    if X.ndim != 3:
+        raise ValueError("msfun_sig_epoch_chunks - ERROR: Epochs must be a [K x N x T] array... Try again.")
+    K, N, T = X.shape
+    if chunk is None:
+        chunk = max(1, (1 << 24) // max(N * T, 1))
+    if not isinstance(chunk, (int, np.integer)) or chunk <= 0:
+        raise ValueError("msfun_sig_epoch_chunks - ERROR: Chunk length must be a positive integer... Try again.")
+    for k in range(0, K, chunk):
+        E = X[k:k + chunk]
+        if concat:
+            E = msfun_sig_epoch_concat(E, baseline)
+        elif baseline:
+            E = msfun_sig_epoch_baseline(E)
+        yield k, E
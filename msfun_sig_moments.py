@@ -0,0 +1,90 @@
+import numpy as np
+
+def msfun_sig_moments_init(n):
+    '''
+    Creates an empty accumulator of the central moments of order 2 to 4 of
+    n signals, updated block by block and mergeable across shards.
+    All sums are kept in float64.
+    '''
+    return {
+        'n': 0,
+        'mean': np.zeros(n),
+        'M2': np.zeros(n),
+        'M3': np.zeros(n),
+        'M4': np.zeros(n)
+    }
+
+def msfun_sig_moments_merge(mom, other):
+    '''
+    Merges the accumulator other into mom (modified in place), using the
+    pairwise update formulas for central moments (Chan et al., Pebay).
+    '''
+    nb = other['n']
+    if nb == 0:
+        return mom
+    na = mom['n']
+    if na == 0:
+        for key in ['n', 'mean', 'M2', 'M3', 'M4']:
+            mom[key] = np.copy(other[key]) if key != 'n' else nb
+        return mom
+
+    n = na + nb
+    d = other['mean'] - mom['mean']
+    d2 = d * d
+    M2a, M3a = mom['M2'], mom['M3']
+    M2b, M3b = other['M2'], other['M3']
+
+    mom['M4'] = (mom['M4'] + other['M4'] + d2 * d2 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+                 + 6 * d2 * (na * na * M2b + nb * nb * M2a) / n ** 2 + 4 * d * (na * M3b - nb * M3a) / n)
+    mom['M3'] = M3a + M3b + d2 * d * na * nb * (na - nb) / n ** 2 + 3 * d * (na * M2b - nb * M2a) / n
+    mom['M2'] = M2a + M2b + d2 * na * nb / n
+    mom['mean'] = mom['mean'] + d * nb / n
+    mom['n'] = n
+    return mom
+
+def msfun_sig_moments_update(mom, X, baseline=False):
+    '''
+    Adds the [n x t] block X to the accumulator mom (modified in place).
+    With baseline=True the block mean is removed first, as for the baseline
+    correction of an epoch.
+    '''
+    X = np.asarray(X)
+    if X.ndim != 2 or X.shape[0] != mom['mean'].shape[0]:
+        raise ValueError("msfun_sig_moments_update - ERROR: Block inconsistent with accumulator... Try again.")
+    t = X.shape[1]
+    if t == 0:
+        return mom
+
+    m = np.mean(X, axis=1, dtype=np.float64)
+    d = X - m[:, np.newaxis]
+    d2 = d * d
+    block = {
+        'n': t,
+        'mean': np.zeros_like(m) if baseline else m,
+        'M2': np.sum(d2, axis=1),
+        'M3': np.einsum('ij,ij->i', d2, d),
+        'M4': np.einsum('ij,ij->i', d2, d2)
+    }
+    return msfun_sig_moments_merge(mom, block)
+
+def msfun_sig_moments_finalize(mom):
+    '''
+    Returns the unbiased sample skewness and excess kurtosis of the accumulated
+    signals (same estimators as scipy.stats.skew/kurtosis with bias=False).
+
+    Returns:
+    - skew: numpy.ndarray [n]
+    - kurt: numpy.ndarray [n]
+    '''
+    n = mom['n']
+    if n < 4:
+        raise ValueError("msfun_sig_moments_finalize - ERROR: At least four samples are needed... Try again.")
+    m2 = mom['M2'] / n
+    m3 = mom['M3'] / n
+    m4 = mom['M4'] / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g1 = m3 / m2 ** 1.5
+        g2 = m4 / m2 ** 2 - 3
+    skew = g1 * np.sqrt(n * (n - 1)) / (n - 2)
+    kurt = ((n + 1) * g2 + 6) * (n - 1) / ((n - 2) * (n - 3))
+    return skew, kurt
@@ -0,0 +1,51 @@
+import numpy as np
+
+def msfun_sig_reservoir_init(N, size, seed=0):
+    '''
+    Creates an empty reservoir keeping a uniform random subset of at most
+    size columns out of a stream of [N x t] blocks (Algorithm R).
+    '''
+    if not isinstance(size, (int, np.integer)) or size <= 0:
+        raise ValueError("msfun_sig_reservoir_init - ERROR: Reservoir size must be a positive integer... Try again.")
+    return {
+        'n': 0,
+        'fill': 0,
+        'X': None,
+        'N': N,
+        'size': int(size),
+        'rng': np.random.default_rng(seed)
+    }
+
+def msfun_sig_reservoir_update(res, X, dtype=None):
+    '''
+    Offers the columns of the [N x t] block X to the reservoir res (modified in place).
+    '''
+    X = np.asarray(X)
+    if X.ndim != 2 or X.shape[0] != res['N']:
+        raise ValueError("msfun_sig_reservoir_update - ERROR: Block inconsistent with reservoir... Try again.")
+    t = X.shape[1]
+    if res['X'] is None:
+        res['X'] = np.empty((res['N'], res['size']), dtype=dtype or X.dtype)
+
+    nfill = min(res['size'] - res['fill'], t)
+    if nfill > 0:
+        res['X'][:, res['fill']:res['fill'] + nfill] = X[:, :nfill]
+        res['fill'] += nfill
+
+    if nfill < t:
+        # Sample j of the stream (0-based) replaces a random slot with probability size/(j+1)
+        seen = res['n'] + np.arange(nfill, t) + 1
+        slot = np.floor(res['rng'].random(t - nfill) * seen).astype(np.int64)
+        hit = slot < res['size']
+        res['X'][:, slot[hit]] = X[:, nfill:][:, hit]
+
+    res['n'] += t
+    return res
+
+def msfun_sig_reservoir_get(res):
+    '''
+    Returns the current reservoir content as an [N x fill] array (a view).
+    '''
+    if res['X'] is None:
+        return np.empty((res['N'], 0))
+    return res['X'][:, :res['fill']]
@@ -0,0 +1,32 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+def msfun_sig_shared_create(shape, dtype=np.float64):
+    '''
+    Allocates an array in a named shared memory block so that worker processes
+    can attach to it without pickling the data.
+
+    Returns:
+    - shm: multiprocessing.shared_memory.SharedMemory, to be closed and unlinked by the caller
+    - X: numpy.ndarray of the given shape and dtype backed by shm
+    - meta: small picklable dict to pass to msfun_sig_shared_attach in the workers
+    '''
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    X = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    meta = {'name': shm.name, 'shape': tuple(shape), 'dtype': dtype.str}
+    return shm, X, meta
+
+def msfun_sig_shared_attach(meta):
+    '''
+    Attaches to a shared array created by msfun_sig_shared_create.
+
+    Returns:
+    - shm: multiprocessing.shared_memory.SharedMemory, to be closed (not unlinked) by the worker
+    - X: read-only numpy.ndarray view of the shared data
+    '''
+    shm = shared_memory.SharedMemory(name=meta['name'])
+    X = np.ndarray(meta['shape'], dtype=np.dtype(meta['dtype']), buffer=shm.buf)
+    X.flags.writeable = False
+    return shm, X
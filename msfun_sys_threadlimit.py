@@ -0,0 +1,33 @@
+import os
+
+def msfun_sys_threadlimit(nthreads, environ=True):
+    '''
+    Limits the number of BLAS/OpenMP threads used by numpy and scipy in the
+    current process, e.g. inside pool workers so that several workers do not
+    oversubscribe the cores.
+
+    Uses threadpoolctl when it is installed. With environ, the thread count
+    environment variables are also set, which takes effect for libraries loaded
+    afterwards and is inherited by subprocesses: only meant for pool worker
+    initializers, not for the caller's own process.
+
+    Parameters:
+    - nthreads: number of threads
+    - environ: bool, also set the environment variables (default True)
+
+    Returns:
+    - limiter: threadpoolctl limiter (keep a reference while the limit must hold,
+      restore_original_limits() lifts it) or None
+    '''
+    if not isinstance(nthreads, int) or nthreads <= 0:
+        raise ValueError("msfun_sys_threadlimit - ERROR: Number of threads must be a positive integer... Try again.")
+
+    if environ:
+        for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]:
+            os.environ[var] = str(nthreads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=nthreads)